@@ -170,6 +170,20 @@ CREATE TABLE pos_bucket_variantfile_association (
 	FOREIGN KEY(pos_bucket_id) REFERENCES pos_bucket (id),
 	FOREIGN KEY(variantfile_id) REFERENCES variantfile (id)
 );
+CREATE TABLE pos_bucket_array (
+	variantfile_id VARCHAR NOT NULL,
+	contig_id VARCHAR NOT NULL,
+	bucket_ids BYTEA,
+	bucket_counts BYTEA,
+	PRIMARY KEY (variantfile_id, contig_id),
+	FOREIGN KEY(variantfile_id) REFERENCES variantfile (id),
+	FOREIGN KEY(contig_id) REFERENCES contig (id)
+);
+CREATE TABLE dataset_version (
+	id INTEGER PRIMARY KEY,
+	version INTEGER
+);
+INSERT INTO dataset_version VALUES(1, 0);
 CREATE TABLE sample (
 	id SERIAL PRIMARY KEY,
 	sample_id VARCHAR,
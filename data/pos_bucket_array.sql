@@ -0,0 +1,23 @@
+-- converts the pos_bucket rows of already-indexed variantfiles into packed pos_bucket_arrays:
+-- run this once before switching to BucketStorage = packed in config.ini
+-- (or re-index the variantfiles after switching instead).
+CREATE TABLE IF NOT EXISTS pos_bucket_array (
+	variantfile_id VARCHAR NOT NULL,
+	contig_id VARCHAR NOT NULL,
+	bucket_ids BYTEA,
+	bucket_counts BYTEA,
+	PRIMARY KEY (variantfile_id, contig_id),
+	FOREIGN KEY(variantfile_id) REFERENCES variantfile (id),
+	FOREIGN KEY(contig_id) REFERENCES contig (id)
+);
+
+INSERT INTO pos_bucket_array (variantfile_id, contig_id, bucket_ids, bucket_counts)
+    SELECT a.variantfile_id, b.contig_id,
+        string_agg(int4send(b.pos_bucket_id), ''::bytea ORDER BY b.pos_bucket_id),
+        string_agg(int4send(a.bucket_count), ''::bytea ORDER BY b.pos_bucket_id)
+    FROM pos_bucket_variantfile_association a
+    JOIN pos_bucket b ON b.id = a.pos_bucket_id
+    WHERE a.bucket_count > 0
+    GROUP BY a.variantfile_id, b.contig_id
+ON CONFLICT (variantfile_id, contig_id) DO UPDATE
+    SET bucket_ids = EXCLUDED.bucket_ids, bucket_counts = EXCLUDED.bucket_counts;
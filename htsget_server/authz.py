@@ -1,5 +1,9 @@
+import hashlib
 import json
-from config import AUTHZ, TEST_KEY
+import threading
+import time
+from collections import OrderedDict
+from config import AUTHZ, TEST_KEY, AUTHZ_CACHE_TTL, AUTHZ_CACHE_SIZE
 from flask import Flask
 import database
 import authx.auth
@@ -11,6 +15,10 @@ logger = CanDIGLogger(__file__)
 
 app = Flask(__name__)
 
+# {(lookup, token digest, ...): (expiry time, result)}, least recently used first
+authz_cache = OrderedDict()
+authz_cache_lock = threading.Lock()
+
 
 def is_testing(request):
     if request.headers.get("Authorization") == f"Bearer {TEST_KEY}":
@@ -43,7 +51,7 @@ def get_authorized_cohorts(request):
     if is_testing(request):
         return ["test-htsget"]
     try:
-        return authx.auth.get_opa_datasets(request)
+        return cached_lookup(request, ("opa_datasets", request.method, request.path), authx.auth.get_opa_datasets, request)
     except Exception as e:
         logger.warning(f"Couldn't authorize cohorts: {type(e)} {str(e)}")
         return []
@@ -54,7 +62,7 @@ def is_cohort_authorized(request, cohort_id):
         return True
     if request_is_from_ingest(request):
         return True
-    return authx.auth.is_action_allowed_for_program(authx.auth.get_auth_token(request), method=request.method, path=request.path, program=cohort_id)
+    return cached_lookup(request, ("action_allowed", request.method, request.path, cohort_id), authx.auth.is_action_allowed_for_program, authx.auth.get_auth_token(request), method=request.method, path=request.path, program=cohort_id)
 
 
 def is_site_admin(request):
@@ -67,7 +75,7 @@ def is_site_admin(request):
         return True
     if "Authorization" in request.headers:
         try:
-            return authx.auth.is_site_admin(request)
+            return cached_lookup(request, ("site_admin",), authx.auth.is_site_admin, request)
         except Exception as e:
             logger.warning(f"Couldn't authorize site_admin: {type(e)} {str(e)}")
             return False
@@ -80,11 +88,38 @@ def get_s3_url(s3_endpoint=None, bucket=None, object_id=None, access_key=None, s
 
 def request_is_from_query(request):
     if "X-Service-Token" in request.headers:
-        return authx.auth.verify_service_token(service="query", token=request.headers["X-Service-Token"])
+        return cached_lookup(request, ("service_token", "query"), authx.auth.verify_service_token, service="query", token=request.headers["X-Service-Token"])
     return False
 
 
 def request_is_from_ingest(request):
     if "X-Service-Token" in request.headers:
-        return authx.auth.verify_service_token(service="candig-ingest", token=request.headers["X-Service-Token"])
+        return cached_lookup(request, ("service_token", "candig-ingest"), authx.auth.verify_service_token, service="candig-ingest", token=request.headers["X-Service-Token"])
     return False
+
+
+def cached_lookup(request, lookup, func, *args, **kwargs):
+    """
+    Returns func(*args, **kwargs), an authorization lookup described by the tuple lookup, for the request's tokens.
+    Results are memoized for the rest of the request, and for AUTHZ_CACHE_TTL seconds for other requests
+    with the same tokens. Exceptions aren't cached.
+    """
+    tokens = f"{request.headers.get('Authorization')}\t{request.headers.get('X-Service-Token')}"
+    key = (lookup[0], hashlib.sha256(tokens.encode()).hexdigest()) + lookup[1:]
+    memo = request.environ.setdefault("htsget.authz", {})
+    if key in memo:
+        return memo[key]
+    now = time.monotonic()
+    with authz_cache_lock:
+        if key in authz_cache and authz_cache[key][0] > now:
+            authz_cache.move_to_end(key)
+            memo[key] = authz_cache[key][1]
+            return memo[key]
+    memo[key] = func(*args, **kwargs)
+    if AUTHZ_CACHE_TTL > 0:
+        with authz_cache_lock:
+            authz_cache[key] = (now + AUTHZ_CACHE_TTL, memo[key])
+            authz_cache.move_to_end(key)
+            while len(authz_cache) > AUTHZ_CACHE_SIZE:
+                authz_cache.popitem(last=False)
+    return memo[key]
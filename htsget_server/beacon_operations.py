@@ -3,12 +3,22 @@ import variants
 import drs_operations
 import htsget_operations
 import database
+import refseq
+import base64
+import copy
+import hashlib
+import heapq
+import itertools
 import json
+import numpy
 import re
+import threading
 import connexion
 from functools import reduce
+from collections import OrderedDict
 import authz
-from config import AGGREGATE_COUNT_THRESHOLD
+import streaming
+from config import AGGREGATE_COUNT_THRESHOLD, ANNOTATE_GENES, BEACON_CACHE_SIZE, STREAM_RESPONSES
 from candigv2_logging.logging import CanDIGLogger
 
 
@@ -26,6 +36,15 @@ SCHEMA = [
     }
 ]
 
+# the largest batch of variant records that filter_variants is applied to at once
+FILTER_BATCH_SIZE = 1024
+
+# {normalized search parameters: {'version', 'resultset', 'drs_obj_ids'}}, least recently used first
+beacon_cache = OrderedDict()
+beacon_cache_lock = threading.Lock()
+# the number of variations in all of the cached resultsets
+beacon_cache_count = 0
+
 # Endpoints
 def get_beacon_service_info():
     return {
@@ -48,7 +67,7 @@ def get_beacon_service_info():
 # req = {
 #     include_result_set_responses: string,
 #     pagination: {
-#         currentPage: string,
+#         currentPage: string, # the nextPage token from meta.returnedPagination of the previous page
 #         limit: int,
 #         nextPage: string,
 #         previousPage: string,
@@ -65,6 +84,7 @@ def get_beacon_service_info():
 def get_search(
     skip=None,
     limit=None,
+    current_page=None,
     include_result_set_responses=False,
     start=None,
     end=None,
@@ -78,6 +98,9 @@ def get_search(
     gene_id=None,
     filters=None
 ):
+    # GET searches used to return all of their results: the schema's default limit only applies if the client asks for pages
+    if 'limit' not in connexion.request.args and current_page is None:
+        limit = 0
     req = {
         "includeResultsetResponses": include_result_set_responses,
         "pagination": {
@@ -91,6 +114,8 @@ def get_search(
             "requestedGranularity": "record"
         }
     }
+    if current_page is not None:
+        req['pagination']['currentPage'] = current_page
     if alternate_bases is not None:
         req['query']['requestParameters']['alternate_bases'] = alternate_bases
     if assembly_id is not None:
@@ -113,8 +138,13 @@ def get_search(
         req['query']['requestParameters']['variant_min_length'] = variant_min_length
 
     try:
-        result = search(req)
+        result = search(req, stream=STREAM_RESPONSES)
+        if STREAM_RESPONSES and 'response' in result:
+            # this only catches errors from before the response starts: streaming.log_errors logs the ones after
+            return streaming.json_response(result, 'response')
         return result, 200
+    except database.DatabaseUnavailable:
+        raise
     except Exception as e:
         return {'message': f"{type(e)}: {str(e)}"}, 500
 
@@ -134,20 +164,153 @@ def post_search():
     if 'requestedGranularity' not in req['meta']:
         req['meta']['requestedGranularity'] = 'record'
 
-    params = list(req['query']['requestParameters'].keys())
+    snake_case_parameters(req['query']['requestParameters'])
+
+    try:
+        result = search(req, stream=STREAM_RESPONSES)
+        if STREAM_RESPONSES and 'response' in result:
+            return streaming.json_response(result, 'response')
+        return result, 200
+    except database.DatabaseUnavailable:
+        raise
+    except Exception as e:
+        return {'message': f"{type(e)}: {str(e)}"}, 500
+
+
+def post_batch_search():
+    req = connexion.request.json
+    # like post_search, but requestParameters is a list, with one set of parameters for each search
+    if 'requestedGranularity' not in req['meta']:
+        req['meta']['requestedGranularity'] = 'record'
+    for request_parameters in req['query']['requestParameters']:
+        snake_case_parameters(request_parameters)
+
+    try:
+        result = batch_search(req)
+        return result, 200
+    except database.DatabaseUnavailable:
+        raise
+    except Exception as e:
+        return {'message': f"{type(e)}: {str(e)}"}, 500
+
+
+def snake_case_parameters(request_parameters):
+    params = list(request_parameters.keys())
     for param in params:
         # change all names of parameters to snake case from camel case
         new_param = reduce(lambda x, y: x + ('_' if y.isupper() else '') + y, param).lower()
-        req['query']['requestParameters'][new_param] = req['query']['requestParameters'].pop(param)
+        request_parameters[new_param] = request_parameters.pop(param)
 
+
+def search(raw_req, stream=False):
+    response, actual_params = get_search_params(raw_req)
+    if actual_params is None:
+        return response
+    return search_region(raw_req, response, actual_params, stream=stream)
+
+
+def batch_search(raw_batch_req):
+    """
+    Runs a search for each of the requestParameters in the batch, and returns their responses in the same order.
+    The regions are counted in a single database search, and the files are only opened and read once for all
+    of the regions that need their records, instead of once for each search.
+    """
+    raw_reqs = []
+    for request_parameters in raw_batch_req['query']['requestParameters']:
+        raw_req = {
+            'meta': dict(raw_batch_req['meta']),
+            'query': {'requestParameters': request_parameters}
+        }
+        if 'pagination' in raw_batch_req:
+            raw_req['pagination'] = raw_batch_req['pagination']
+        raw_reqs.append(raw_req)
+    searches = []
+    for raw_req in raw_reqs:
+        response, actual_params = get_search_params(raw_req)
+        searches.append({'raw_req': raw_req, 'response': response, 'actual_params': actual_params})
+    regions = [query['actual_params'] for query in searches if query['actual_params'] is not None]
+    authed_cohorts = authz.get_authorized_cohorts(request)
+    counts_by_region = variants.count_variants_in_regions(regions, cohorts=authed_cohorts)
+
+    # work out which files each search still needs to read
+    version = database.get_dataset_version()
+    to_read = []
+    for query in searches:
+        if query['actual_params'] is None:
+            continue
+        query['counts'] = counts_by_region.pop(0)
+        actual_params = query['actual_params']
+        granularity = query['response']['meta'].get('returnedGranularity')
+        if granularity in ['boolean', 'count'] and len(get_variant_filters(actual_params)) == 0:
+            indexed_response = search_bucket_index(actual_params, copy.deepcopy(query['response']), query['counts'])
+            if indexed_response is not None:
+                query['response'] = indexed_response
+                query['done'] = True
+                continue
+        if granularity == 'record' and (query['raw_req'].get('pagination') or {}).get('limit'):
+            # paged searches only read as far as their page
+            continue
+        # the files whose records are compiled, or None for all of them, and, like in search_region,
+        # the files of the other cohorts, which are only counted
+        record_obj_ids = None
+        counted_obj_ids = []
+        if granularity == 'record':
+            record_obj_ids = [count['drs_object_id'] for count in query['counts'] if count['records']]
+            counted_obj_ids = [count['drs_object_id'] for count in query['counts'] if not count['records'] and count['variantcount'] > 0]
+        query['record_obj_ids'] = record_obj_ids
+        query['read_obj_ids'] = []
+        if record_obj_ids is None or len(record_obj_ids) > 0:
+            if get_cached_resultset(get_beacon_cache_key(actual_params, record_obj_ids), version) is None:
+                query['read_obj_ids'] = record_obj_ids
+                if record_obj_ids is None:
+                    query['read_obj_ids'] = [count['drs_object_id'] for count in query['counts']]
+        query['counted_obj_ids'] = []
+        if len(counted_obj_ids) > 0 and get_cached_resultset(get_beacon_cache_key(actual_params, counted_obj_ids, counted=True), version) is None:
+            query['counted_obj_ids'] = counted_obj_ids
+        if len(query['read_obj_ids']) > 0 or len(query['counted_obj_ids']) > 0:
+            to_read.append(query)
+
+    regions = []
+    for query in to_read:
+        regions.append({
+            'reference_name': query['actual_params']['reference_name'],
+            'start': query['actual_params']['start'],
+            'end': query['actual_params']['end'],
+            'drs_object_ids': query['read_obj_ids'] + query['counted_obj_ids']
+        })
     try:
-        result = search(req)
-        return result, 200
+        # beacon results only use the samples' genotypes and any VEP annotations
+        variants_by_region = variants.find_variants_in_regions(regions, format_keys=['GT'], info_keys=['CSQ'], genotypes=True)
+    except database.DatabaseUnavailable:
+        raise
     except Exception as e:
-        return {'message': f"{type(e)}: {str(e)}"}, 500
+        raise Exception(f"exception in find_variants_in_regions for {regions}: {type(e)} {str(e)}")
+    for query, variants_by_file in zip(to_read, variants_by_region):
+        query['preloaded'] = {}
+        if len(query['read_obj_ids']) > 0:
+            query['preloaded']['drs_obj_ids'] = query['record_obj_ids']
+            query['preloaded']['variants_by_file'] = {k: v for k, v in variants_by_file.items() if k in query['read_obj_ids']}
+        if len(query['counted_obj_ids']) > 0:
+            query['preloaded']['counted'] = {
+                'drs_obj_ids': query['counted_obj_ids'],
+                'variants_by_file': {k: v for k, v in variants_by_file.items() if k in query['counted_obj_ids']}
+            }
+
+    responses = []
+    for query in searches:
+        if query['actual_params'] is None or 'done' in query:
+            responses.append(query['response'])
+        else:
+            responses.append(search_region(query['raw_req'], query['response'], query['actual_params'], counts=query['counts'], preloaded=query.get('preloaded')))
+    return {'responses': responses}
 
 
-def search(raw_req):
+def get_search_params(raw_req):
+    """
+    Returns the response to start from for the request, and the search parameters for it: reference_genome,
+    reference_name, start, end and any allele filters. If the request can't be searched, the search parameters
+    are None and the response is an error.
+    """
     req = raw_req['query']['requestParameters']
     # pass req in as an htsget search:
     # if we have regions, they would be in reference_name/start/end
@@ -200,9 +363,15 @@ def search(raw_req):
 
     if 'end' in req and len(req['end']) > 0:
         actual_params['end'] = req['end'].pop(0)
+
+    if 'reference_bases' in req:
+        actual_params['ref'] = req['reference_bases']
+
+    if 'alternate_bases' in req:
+        actual_params['alt'] = req['alternate_bases']
     if 'gene_id' in req:
         try:
-            genes = database.search_refseqs(req['gene_id'].upper(), 'gene_name')
+            genes = refseq.refseq_index.search(req['gene_id'].upper(), 'gene_name')
             if len(genes) > 0:
                 for gene in genes:
                     if gene['reference_genome'] == actual_params['reference_genome']:
@@ -219,12 +388,16 @@ def search(raw_req):
                         },
                         'meta': meta
                     }
-                return response
+                return response, None
+        except database.DatabaseUnavailable:
+            raise
         except Exception as e:
             raise Exception(f"exception finding refseq for {req['gene_id']}: {type(e)} {str(e)}")
     if 'genomic_allele_short_form' in req:
         try:
             allele_loc = variants.convert_hgvsid_to_location(req['genomic_allele_short_form'], reference_genome=actual_params['reference_genome'])
+        except database.DatabaseUnavailable:
+            raise
         except Exception as e:
             raise Exception(f"exception in convert_hgvsid_to_location for {req['genomic_allele_short_form']}: {type(e)} {str(e)}")
         if allele_loc is not None:
@@ -239,110 +412,469 @@ def search(raw_req):
             if 'alt' in allele_loc:
                 actual_params['alt'] = allele_loc['alt']
 
-    if 'reference_name' in actual_params and actual_params['reference_name'] is not None:
-        # if there is no end specified, assume the end is same as start:
-        if 'end' not in actual_params:
-            actual_params['end'] = actual_params['start']
+    if 'reference_name' not in actual_params or actual_params['reference_name'] is None:
+        response = {
+            'error': {
+                'errorMessage': 'no referenceName was provided',
+                'errorCode': 404
+            },
+            'meta': meta
+        }
+        return response, None
+    # if there is no end specified, assume the end is same as start:
+    if 'end' not in actual_params:
+        actual_params['end'] = actual_params['start']
+    return response, actual_params
+
+
+def search_region(raw_req, response, actual_params, counts=None, preloaded=None, stream=False):
+    """
+    Completes the response for the search parameters from get_search_params. batch_search passes in the
+    count_variants_in_region results for the region, with the user's authorized cohorts, and the variant
+    records it has already read, as {'drs_obj_ids', 'variants_by_file'}, with the other cohorts' files in the
+    same shape in 'counted'. If stream is True, the response's records are an iterator, to be serialized as
+    they're generated.
+    """
+    meta = response['meta']
+    # boolean and count answers can often come straight from the pos_bucket counts
+    if meta.get('returnedGranularity') in ['boolean', 'count'] and len(get_variant_filters(actual_params)) == 0:
+        indexed_response = search_bucket_index(actual_params, response, counts)
+        if indexed_response is not None:
+            return indexed_response
+    # if the request granularity was "record", check to see that the user is actually authorized to see any cohorts:
+    authed_cohorts = authz.get_authorized_cohorts(request)
+    page = None
+    # files from cohorts the user isn't authorized for are only counted
+    counted_obj_ids = []
+    if meta.get('returnedGranularity') == 'record':
         try:
-            variants_by_file = variants.find_variants_in_region(reference_name=actual_params['reference_name'], start=actual_params['start'], end=actual_params['end'])
-        except Exception as e:
-            raise Exception(f"exception in find_variants_in_region for {actual_params}: {type(e)} {str(e)}")
+            pagination = get_pagination(raw_req, actual_params)
+        except ValueError as e:
+            return {
+                'error': {
+                    'errorMessage': str(e),
+                    'errorCode': 400
+                },
+                'meta': meta
+            }
+        # only the records in the files of the authorized cohorts are returned, so only they are compiled
+        if counts is None:
+            counts = variants.count_variants_in_region(reference_name=actual_params['reference_name'], start=actual_params['start'], end=actual_params['end'], cohorts=authed_cohorts)
+        record_obj_ids = [count['drs_object_id'] for count in counts if count['records']]
+        counted_obj_ids = [count for count in counts if not count['records'] and count['variantcount'] > 0]
+        resultset = []
+        drs_obj_ids = []
+        total = 0
+        # the variantInternalIds of all of the authorized results, if they're known
+        result_ids = []
+        if len(record_obj_ids) > 0:
+            if pagination is not None:
+                page = get_beacon_page(actual_params, record_obj_ids, **pagination)
+                resultset = page['resultset']
+                drs_obj_ids = page['drs_obj_ids']
+                total = page['total']
+                known = page.get('count')
+                result_ids = None
+                if total is not None:
+                    cached = get_cached_resultset(get_beacon_cache_key(actual_params, record_obj_ids), database.get_dataset_version())
+                    if cached is not None:
+                        result_ids = [result.hgvsid for result in cached[0]]
+            else:
+                resultset, drs_obj_ids = get_beacon_resultset(actual_params, record_obj_ids, preloaded)
+                total = len(resultset)
+                result_ids = [result.hgvsid for result in resultset]
+        # the other cohorts' variations count towards the total, and towards whether any exist, without being compiled:
+        # if the page has already shown that there are more results, they aren't needed
+        if total is not None and len(counted_obj_ids) > 0:
+            counted = None
+            if preloaded is not None:
+                counted = preloaded.get('counted')
+            counted_ids = count_beacon_variations(actual_params, [count['drs_object_id'] for count in counted_obj_ids], counted)
+            if result_ids is not None:
+                total = len(set(result_ids).union(counted_ids))
+            elif len(counted_ids) > 0:
+                # without the ids of the authorized results, the variations they share can't be told apart
+                known = max(total, len(counted_ids))
+                total = None
+    else:
+        resultset, drs_obj_ids = get_beacon_resultset(actual_params, preloaded=preloaded)
+        total = len(resultset)
+
+    if total is None or total > 0:
+        if total is None:
+            response['responseSummary']['numTotalResults'] = f">={known}"
+        elif total < int(AGGREGATE_COUNT_THRESHOLD):
+            response['responseSummary']['numTotalResults'] = f"<{AGGREGATE_COUNT_THRESHOLD}"
+        else:
+            response['responseSummary']['numTotalResults'] = total
+        response['responseSummary']['exists'] = True
+
+    response['beaconHandovers'] = []
+    drs_objs = database.get_drs_objects(drs_obj_ids)
+    # look for samples and cohorts for all drs objects, even if user is not authorized
+    query_info = compile_query_info(drs_objs, drs_obj_ids)
+    for drs_obj_id in drs_obj_ids:
+        drs_obj = drs_objs[drs_obj_id]
+        if "cohort" in drs_obj:
+            if drs_obj["cohort"] in authed_cohorts:
+                # fill in handover data
+                try:
+                    handover, status_code = htsget_operations._get_urls("variant", drs_obj_id, reference_name=actual_params['reference_name'], start=actual_params['start'], end=actual_params['end'])
+                except database.DatabaseUnavailable:
+                    raise
+                except Exception as e:
+                    raise Exception(f"exception in get_variants for {drs_obj_id}: {type(e)} {str(e)}")
+                if handover is not None:
+                    handover['handoverType'] = {'id': 'CUSTOM', 'label': 'HTSGET'}
+                    response['beaconHandovers'].append(handover)
+    if len(response['beaconHandovers']) > 0 and meta['returnedGranularity'] == 'record':
+        if stream:
+            response['response'] = iterate_case_level_data(resultset, authed_cohorts)
+        else:
+            response['response'] = add_case_level_data(resultset, authed_cohorts)
+        if total is not None and total > 0: # use true number if we're authorized, even if below AGGREGATE_COUNT_THRESHOLD
+            response['responseSummary']['numTotalResults'] = total
+        if page is not None:
+            meta['returnedPagination'] = dict(meta['receivedRequestSummary']['pagination'])
+            if 'next_page' in page:
+                meta['returnedPagination']['nextPage'] = page['next_page']
+
+    else:
+        response.pop('beaconHandovers')
+        if meta['returnedGranularity'] == 'boolean':
+            response['responseSummary'].pop('numTotalResults')
+    # if the requester is the query microservice, add query info to the results
+    if authz.request_is_from_query(connexion.request):
+        if len(counted_obj_ids) > 0:
+            # the counted files only have their records read if the pos_bucket counts can't tell that they're in the region
+            counted_obj_ids = [count['drs_object_id'] for count in counted_obj_ids if count['innercount'] > 0 or variants.has_variants_in_region(count['drs_object_id'], reference_name=actual_params['reference_name'], start=actual_params['start'], end=actual_params['end'])]
+            drs_objs.update(database.get_drs_objects(counted_obj_ids))
+            query_info = compile_query_info(drs_objs, list(drs_obj_ids) + counted_obj_ids)
+        response["query_info"] = query_info
+    return response
+
+
+def get_beacon_resultset(actual_params, drs_obj_ids=None, preloaded=None):
+    """
+    Returns the beacon resultset for the region and alleles in actual_params, and the ids of the drs objects
+    it was found in. If drs_obj_ids is given, only those drs objects are searched. Resultsets are cached until
+    the dataset version changes. They don't depend on the user's authorization, which add_case_level_data
+    applies: don't modify them.
+    """
+    key = get_beacon_cache_key(actual_params, drs_obj_ids)
+    version = database.get_dataset_version()
+    cached = get_cached_resultset(key, version)
+    if cached is not None:
+        return cached
+    resultset, drs_obj_ids = find_beacon_resultset(actual_params, drs_obj_ids, preloaded)
+    cache_resultset(key, version, resultset, drs_obj_ids)
+    return resultset, drs_obj_ids
+
+
+def get_beacon_cache_key(actual_params, drs_obj_ids=None, counted=False):
+    key = {k: actual_params.get(k) for k in ['reference_genome', 'reference_name', 'start', 'end', 'ref', 'alt', 'variant_min_length', 'variant_max_length']}
+    if drs_obj_ids is not None:
+        key['drs_obj_ids'] = sorted(drs_obj_ids)
+    if counted:
+        key['counted'] = True
+    return json.dumps(key, sort_keys=True)
+
+
+def get_cached_resultset(key, version):
+    # returns the cached (resultset, drs_obj_ids) for the key, or None
+    with beacon_cache_lock:
+        if key in beacon_cache and beacon_cache[key]['version'] == version:
+            beacon_cache.move_to_end(key)
+            return beacon_cache[key]['resultset'], beacon_cache[key]['drs_obj_ids']
+    return None
+
+
+def cache_resultset(key, version, resultset, drs_obj_ids):
+    global beacon_cache_count
+    if len(resultset) > BEACON_CACHE_SIZE:
+        return
+    with beacon_cache_lock:
+        if key in beacon_cache:
+            beacon_cache_count -= len(beacon_cache.pop(key)['resultset'])
+        beacon_cache[key] = {'version': version, 'resultset': resultset, 'drs_obj_ids': drs_obj_ids}
+        beacon_cache_count += len(resultset)
+        while beacon_cache_count > BEACON_CACHE_SIZE:
+            beacon_cache_count -= len(beacon_cache.popitem(last=False)[1]['resultset'])
+
+
+def get_beacon_page(actual_params, drs_obj_ids=None, skip=0, limit=0, after=None):
+    """
+    Returns a page of the beacon resultset for actual_params, with the limit results that follow the first skip
+    pages, starting after the page token after if it's given. If drs_obj_ids is given, only those drs objects are searched:
+    {
+        'resultset': the results in the page,
+        'drs_obj_ids': the ids of the drs objects the results were searched for in,
+        'total': the number of results in the resultset, or None if it wasn't all read,
+        'count': if total is None, the number of results that are known to be in the resultset,
+        'next_page': the page token for the results after the page, if there are any
+    }
+    If the whole resultset isn't cached, results are only compiled until the page is full.
+    """
+    key = get_beacon_cache_key(actual_params, drs_obj_ids)
+    version = database.get_dataset_version()
+    cached = get_cached_resultset(key, version)
+    # the results in the resultset up to the page, if they're all read, so they can be cached
+    read = None
+    if cached is not None:
+        resultset, drs_obj_ids = cached
+        results = iter(resultset)
+    else:
+        start = actual_params['start']
+        if after is not None:
+            # the results after the token start at its position
+            start = min(max(int(start), after['start'] + 1), int(actual_params['end']))
         try:
-            resultset = compile_beacon_resultset(variants_by_file, reference_genome=actual_params['reference_genome'])
+            records_by_obj = variants.open_variants_in_region(reference_name=actual_params['reference_name'], start=start, end=actual_params['end'], format_keys=['GT'], info_keys=['CSQ'], genotypes=True, drs_object_ids=drs_obj_ids)
+        except database.DatabaseUnavailable:
+            raise
         except Exception as e:
-            raise Exception(f"exception in compile_beacon_resultset for {actual_params}: {type(e)} {str(e)}")
-        # others are for filtering after:
-        #         aminoacidChange: string,
-        #         alternate_bases: string,
-        #         reference_bases: string,
-        #         variant_max_length: integer
-        #         variant_min_length: integer
-        #         variantType: string
-
-        if actual_params['start'] == actual_params['end']:
-            filtered_resultset = []
-            for variant in resultset:
-                if variant['variation']['location']['interval']['start']['value'] == actual_params['start'] - 1:
-                    if variant['variation']['location']['interval']['end']['value'] == actual_params['end']:
-                        filtered_resultset.append(variant)
-            resultset = filtered_resultset
-        if 'alt' in actual_params:
-            filtered_resultset = []
-            for variant in resultset:
-                if variant['variantInternalId'].endswith('='):
-                    filtered_resultset.append(variant) # don't filter out ref seqs
-                elif variants.seq_match(variant['variation']['state']['sequence'], actual_params['alt']):
-                    filtered_resultset.append(variant)
-            resultset = filtered_resultset
-        if 'ref' in actual_params:
-            filtered_resultset = []
-            for variant in resultset:
-                if variant['variantInternalId'].endswith('='):
-                    if variants.seq_match(variant['variation']['state']['sequence'], actual_params['ref']):
-                        filtered_resultset.append(variant)
-                else:
-                    filtered_resultset.append(variant)
-            resultset = filtered_resultset
+            raise Exception(f"exception in open_variants_in_region for {actual_params}: {type(e)} {str(e)}")
+        drs_obj_ids = list(records_by_obj.keys())
+        results = iterate_beacon_resultset(records_by_obj, reference_genome=actual_params['reference_genome'], filters=get_variant_filters(actual_params))
+        if after is None:
+            read = []
+    count = 0
+    if after is not None:
+        count = after['count']
+        results = itertools.dropwhile(lambda x: get_result_order(x) <= (after['start'], after['id']), results)
+    first = count + skip * limit
+    page = {
+        'resultset': [],
+        'drs_obj_ids': drs_obj_ids,
+        'total': None
+    }
+    for result in results:
+        count += 1
+        if count > first + limit:
+            # there's at least one more result
+            page['count'] = count
+            page['next_page'] = encode_page_token(get_beacon_cache_key(actual_params), first + limit, page['resultset'][-1])
+            return page
+        if read is not None:
+            read.append(result)
+        if count > first:
+            page['resultset'].append(result)
+    page['total'] = count
+    if read is not None:
+        cache_resultset(key, version, read, drs_obj_ids)
+    return page
 
 
-        if len(resultset) > 0:
-            if len(resultset) < int(AGGREGATE_COUNT_THRESHOLD):
-                response['responseSummary']['numTotalResults'] = f"<{AGGREGATE_COUNT_THRESHOLD}"
-            else:
-                response['responseSummary']['numTotalResults'] = len(resultset)
-            response['responseSummary']['exists'] = True
-
-        # if the request granularity was "record", check to see that the user is actually authorized to see any cohorts:
-        authed_cohorts = authz.get_authorized_cohorts(request)
-        response['beaconHandovers'] = []
-        query_info = {} # program_id and submitter_sample_id
-        for drs_obj_id in variants_by_file.keys():
-            # look for samples and cohorts for all drs objects, even if user is not authorized
-            drs_obj = database.get_drs_object(drs_obj_id)
-            if "cohort" in drs_obj:
-                if drs_obj["cohort"] not in query_info:
-                    query_info[drs_obj["cohort"]] = []
-                for c in drs_obj["contents"]:
-                    if c["id"] not in ["variant", "read", "index"]:
-                        # this is a SampleContentObject
-                        if c["name"] not in query_info[drs_obj["cohort"]]:
-                            query_info[drs_obj["cohort"]].append(c["name"])
-
-                if drs_obj["cohort"] in authed_cohorts:
-                    # fill in handover data
-                    try:
-                        handover, status_code = htsget_operations._get_urls("variant", drs_obj_id, reference_name=actual_params['reference_name'], start=actual_params['start'], end=actual_params['end'])
-                    except Exception as e:
-                        raise Exception(f"exception in get_variants for {drs_obj_id}: {type(e)} {str(e)}")
-                    if handover is not None:
-                        handover['handoverType'] = {'id': 'CUSTOM', 'label': 'HTSGET'}
-                        response['beaconHandovers'].append(handover)
-        if len(response['beaconHandovers']) > 0 and meta['returnedGranularity'] == 'record':
-            response['response'] = resultset
-            if len(resultset) > 0: # use true number if we're authorized, even if below AGGREGATE_COUNT_THRESHOLD
-                response['responseSummary']['numTotalResults'] = len(resultset)
+def get_result_order(result):
+    # results are ordered by the start of their variation, then by their variantInternalId
+    return (result.start, result.hgvsid)
 
+
+def encode_page_token(key, count, result):
+    # the token for the results after result, which is the count-th result of the search with the cache key
+    start, id = get_result_order(result)
+    token = [count, start, id, hashlib.sha1(key.encode()).hexdigest()[0:8]]
+    return base64.urlsafe_b64encode(json.dumps(token).encode()).decode()
+
+
+def decode_page_token(token, key):
+    # returns {'count', 'start', 'id'} for a page token from encode_page_token
+    try:
+        count, start, id, digest = json.loads(base64.urlsafe_b64decode(token.encode()))
+        if isinstance(count, int) and isinstance(start, int) and isinstance(id, str) and digest == hashlib.sha1(key.encode()).hexdigest()[0:8]:
+            return {'count': count, 'start': start, 'id': id}
+    except Exception:
+        pass
+    raise ValueError(f"invalid page token for this search: {token}")
+
+
+def get_pagination(raw_req, actual_params):
+    """
+    Returns the skip, limit and after arguments for get_beacon_page from the request's pagination,
+    or None if the results aren't paged: a limit of 0 returns all of the results.
+    """
+    pagination = raw_req.get('pagination') or {}
+    limit = pagination.get('limit') or 0
+    if limit == 0:
+        if pagination.get('skip'):
+            raise ValueError("skip is a number of pages, so it needs a limit")
+        return None
+    after = None
+    if pagination.get('currentPage') is not None:
+        after = decode_page_token(pagination['currentPage'], get_beacon_cache_key(actual_params))
+    return {'skip': pagination.get('skip') or 0, 'limit': limit, 'after': after}
+
+
+def find_beacon_resultset(actual_params, drs_obj_ids=None, preloaded=None):
+    # search the files for the region, keeping the variations that pass the filters in actual_params
+    try:
+        # beacon results only use the samples' genotypes and any VEP annotations
+        if preloaded is not None and 'variants_by_file' in preloaded and preloaded['drs_obj_ids'] == drs_obj_ids:
+            variants_by_file = preloaded['variants_by_file']
         else:
-            response.pop('beaconHandovers')
-            if meta['returnedGranularity'] == 'boolean':
-                response['responseSummary'].pop('numTotalResults')
-        # if the requester is the query microservice, add query info to the results
-        if authz.request_is_from_query(connexion.request):
-            response["query_info"] = query_info
+            variants_by_file = variants.find_variants_in_region(reference_name=actual_params['reference_name'], start=actual_params['start'], end=actual_params['end'], format_keys=['GT'], info_keys=['CSQ'], genotypes=True, drs_object_ids=drs_obj_ids)
+    except database.DatabaseUnavailable:
+        raise
+    except Exception as e:
+        raise Exception(f"exception in find_variants_in_region for {actual_params}: {type(e)} {str(e)}")
+    try:
+        resultset = compile_beacon_resultset(variants_by_file, reference_genome=actual_params['reference_genome'], filters=get_variant_filters(actual_params))
+    except Exception as e:
+        raise Exception(f"exception in compile_beacon_resultset for {actual_params}: {type(e)} {str(e)}")
+    return resultset, list(variants_by_file.keys())
+
+
+def count_beacon_variations(actual_params, drs_obj_ids, preloaded=None):
+    """
+    Returns the sorted variantInternalIds of the variations in the beacon resultset for actual_params that are
+    found in the drs objects. This is for files whose records aren't returned, so they're never compiled into
+    results: only the alleles that pass the filters and are carried by a sample are needed. Like resultsets,
+    they're cached until the dataset version changes.
+    """
+    key = get_beacon_cache_key(actual_params, drs_obj_ids, counted=True)
+    version = database.get_dataset_version()
+    cached = get_cached_resultset(key, version)
+    if cached is not None:
+        return cached[0]
+    try:
+        if preloaded is not None and preloaded['drs_obj_ids'] == drs_obj_ids:
+            variants_by_file = preloaded['variants_by_file']
+        else:
+            variants_by_file = variants.find_variants_in_region(reference_name=actual_params['reference_name'], start=actual_params['start'], end=actual_params['end'], format_keys=['GT'], info_keys=[], genotypes=True, drs_object_ids=drs_obj_ids)
+    except database.DatabaseUnavailable:
+        raise
+    except Exception as e:
+        raise Exception(f"exception in find_variants_in_region for {actual_params}: {type(e)} {str(e)}")
+    varfiles = database.get_variantfiles(variants_by_file.keys())
+    filters = get_variant_filters(actual_params)
+    hgvsids = set()
+    for drs_obj in variants_by_file.keys():
+        if varfiles[drs_obj]['reference_genome'] != actual_params['reference_genome']:
+            continue
+        for variant, passes in filter_variants(variants_by_file[drs_obj]['variants'], filters):
+            if 'genotypes' not in variant or 0 in variant['genotypes']['alleles'].shape:
+                continue
+            called = set(numpy.concatenate(get_allele_pairs(variant['genotypes']['alleles'])).tolist())
+            variations = compile_variations_from_record(ref=variant['ref'], alt=variant['alt'], chrom=variant['chrom'], pos=variant['pos'], reference_genome=actual_params['reference_genome'])
+            for i in range(len(variations)):
+                if passes[i] and i in called:
+                    hgvsids.add(variations[i]['hgvsid'])
+    hgvsids = sorted(hgvsids)
+    cache_resultset(key, version, hgvsids, list(variants_by_file.keys()))
+    return hgvsids
+
+
+def get_variant_filters(actual_params):
+    """
+    The filters that filter_variants applies to the variant records found for a search:
+    others, like aminoacidChange and variantType, aren't supported yet.
+    """
+    filters = {}
+    # if the search is for a single position, only variants starting there are returned
+    if actual_params['start'] == actual_params['end']:
+        filters['pos'] = int(actual_params['start'])
+    for k in ['ref', 'alt']:
+        if k in actual_params:
+            filters[k] = actual_params[k]
+    if 'variant_min_length' in actual_params:
+        filters['min_length'] = int(actual_params['variant_min_length'])
+    if 'variant_max_length' in actual_params:
+        filters['max_length'] = int(actual_params['variant_max_length'])
+    return filters
+
+
+def filter_variants(variant_records, filters):
+    """
+    Applies the filters from get_variant_filters to VcfJson variant records, before they're made into variations.
+    Returns [(variant record, [whether each allele passes, ref first])] for the records with any alleles that pass.
+    Ref alleles are only filtered by ref; alt alleles are filtered by alt and the length of the variation.
+    """
+    if 'pos' in filters:
+        variant_records = [variant for variant in variant_records if int(variant['pos']) == filters['pos']]
+    refs = [variant['ref'] for variant in variant_records]
+    alts = [[alt_sequence(variant['ref'], a) for a in variant['alt']] for variant in variant_records]
+    all_alts = [a for record_alts in alts for a in record_alts]
+    ref_passes = [True] * len(refs)
+    if 'ref' in filters:
+        ref_passes = variants.seq_matches(refs, filters['ref'])
+    alt_passes = [True] * len(all_alts)
+    if 'alt' in filters:
+        alt_passes = variants.seq_matches(all_alts, filters['alt'])
+    if 'min_length' in filters or 'max_length' in filters:
+        i = 0
+        for ref, record_alts in zip(refs, alts):
+            for a in record_alts:
+                # a variation's length is the longer of the sequence it replaces and its own sequence
+                length = max(len(ref), len(a))
+                if 'min_length' in filters and length < filters['min_length']:
+                    alt_passes[i] = False
+                if 'max_length' in filters and length > filters['max_length']:
+                    alt_passes[i] = False
+                i += 1
+    result = []
+    i = 0
+    for variant, ref_pass, record_alts in zip(variant_records, ref_passes, alts):
+        passes = [ref_pass] + alt_passes[i:i + len(record_alts)]
+        i += len(record_alts)
+        if any(passes):
+            result.append((variant, passes))
+    return result
+
+
+def search_bucket_index(actual_params, response, counts=None):
+    """
+    Answers a boolean or count region query from the indexed pos_bucket counts, without opening any files.
+    A count of variations found this way is the lower bound ">=1". Returns None if the counts can't tell
+    whether there are any variations in the region.
+    """
+    if counts is None:
+        counts = variants.count_variants_in_region(reference_name=actual_params['reference_name'], start=actual_params['start'], end=actual_params['end'])
+    counts = list(filter(lambda x: x['variantcount'] > 0, counts))
+    if len(counts) > 0:
+        # a file with variants only in the partly overlapping buckets at the ends of the region might not have any in the region
+        if any(map(lambda x: x['innercount'] == 0, counts)):
+            return None
+        drs_objs = database.get_drs_objects(map(lambda x: x['drs_object_id'], counts))
+        for count in counts:
+            if count['reference_genome'] != actual_params['reference_genome']:
+                continue
+            # the variants need samples with genotypes to be counted as variations
+            if any(map(lambda c: c["id"] not in ["variant", "read", "index"], drs_objs.get(count['drs_object_id'], {}).get("contents", []))):
+                response['responseSummary']['exists'] = True
+                break
+        if not response['responseSummary']['exists']:
+            return None
+        # the number of variations can't be counted from the number of variant records, but there's at least one
+        response['responseSummary']['numTotalResults'] = ">=1"
     else:
-        response = {
-            'error': {
-                'errorMessage': 'no referenceName was provided',
-                'errorCode': 404
-            },
-            'meta': meta
-        }
+        drs_objs = {}
+    if response['meta']['returnedGranularity'] == 'boolean':
+        response['responseSummary'].pop('numTotalResults')
+    if authz.request_is_from_query(connexion.request):
+        response["query_info"] = compile_query_info(drs_objs, map(lambda x: x['drs_object_id'], counts))
     return response
 
 
-def compile_beacon_resultset(variants_by_obj, reference_genome="hg38"):
+def compile_query_info(drs_objs, drs_obj_ids):
+    # {cohort: [names of the samples in the drs_objs]}, in the order of drs_obj_ids
+    query_info = {} # program_id and submitter_sample_id
+    for drs_obj_id in drs_obj_ids:
+        drs_obj = drs_objs[drs_obj_id]
+        if "cohort" in drs_obj:
+            if drs_obj["cohort"] not in query_info:
+                query_info[drs_obj["cohort"]] = []
+            for c in drs_obj["contents"]:
+                if c["id"] not in ["variant", "read", "index"]:
+                    # this is a SampleContentObject
+                    if c["name"] not in query_info[drs_obj["cohort"]]:
+                        query_info[drs_obj["cohort"]].append(c["name"])
+    return query_info
+
+
+def compile_beacon_resultset(variants_by_obj, reference_genome="hg38", filters=None):
     """
-    Each beacon result describes a variation at a specific position:
+    Each beacon result describes a variation at a specific position. Results are kept as BeaconResults,
+    which add_case_level_data turns into this shape:
     resultset = [
         {
           "caseLevelData": [...],
@@ -375,74 +907,200 @@ def compile_beacon_resultset(variants_by_obj, reference_genome="hg38"):
         }
       ]
     """
-    resultset = {}
-    authed_cohorts = authz.get_authorized_cohorts(request)
-    for drs_obj in variants_by_obj.keys():
-        # check to see if this drs_object is authorized:
-        x = database.get_drs_object(drs_obj)
-        is_authed = False
-        if x["cohort"] in authed_cohorts:
-            is_authed = True
-        if database.get_variantfile(drs_obj)['reference_genome'] != reference_genome:
+    records_by_obj = {drs_obj: variants_by_obj[drs_obj]['variants'] for drs_obj in variants_by_obj}
+    return list(iterate_beacon_resultset(records_by_obj, reference_genome=reference_genome, filters=filters))
+
+
+def iterate_beacon_resultset(records_by_obj, reference_genome="hg38", filters=None):
+    """
+    Generates the results of compile_beacon_resultset from {drs_obj: iterable of variant records in position order},
+    ordered by the variations' positions and then their variantInternalIds. The records of all of the drs objects
+    are merged by position, so each position's results can be returned as soon as its records have been read.
+    """
+    drs_objs = database.get_drs_objects(records_by_obj.keys())
+    varfiles = database.get_variantfiles(records_by_obj.keys())
+    streams = []
+    for drs_obj in records_by_obj.keys():
+        if varfiles[drs_obj]['reference_genome'] != reference_genome:
             continue
-        for variant in variants_by_obj[drs_obj]['variants']:
+        streams.append(map(lambda x, drs_obj=drs_obj: (int(x[0]['pos']), drs_obj, x[0], x[1]), iterate_filtered_variants(records_by_obj[drs_obj], filters or {})))
+    # records at the same position stay in the order of their drs objects
+    merged = heapq.merge(*streams, key=lambda x: x[0])
+    for pos, records in itertools.groupby(merged, key=lambda x: x[0]):
+        resultset = {}
+        # {hgvsid: names of genes overlapping the variation}
+        gene_ids = {}
+        for _, drs_obj, variant, passes in records:
             # parse the variants beacon-style
+            genes = None
+            if ANNOTATE_GENES:
+                genes = list(dict.fromkeys(gene['gene_name'] for gene in refseq.refseq_index.overlapping(reference_genome, variant['chrom'], pos - 1, pos - 1 + len(variant['ref']))))
             variant['variations'] = compile_variations_from_record(ref=variant.pop('ref'), alt=variant.pop('alt'), chrom=variant.pop('chrom'), pos=variant.pop('pos'), reference_genome=reference_genome)
             assign_info_to_variations(variant)
 
             # the variations in each variant need to be copied out first:
-            resultset[drs_obj] = []
-            for var in variant['variations']:
-                resultset[drs_obj].append(var['hgvsid'])
+            allele_ids = []
+            for var, var_passes in zip(variant['variations'], passes):
+                allele_ids.append(var['hgvsid'])
+                if not var_passes:
+                    continue
                 if var['hgvsid'] not in resultset:
-                    resultset[var['hgvsid']] = {
-                        'variation': {
-                            "location": var.pop('location'),
-                            "state": var.pop('state'),
-                            "type": var.pop('type')
-                        },
-                        "identifiers": {
-                            "genomicHGVSId": var['hgvsid']
-                        }
-                    }
+                    interval = var['location']['interval']
+                    resultset[var['hgvsid']] = BeaconResult(var['hgvsid'], interval['start']['value'], interval['end']['value'], var['location']['sequence_id'], var['state']['sequence'])
+                    if genes:
+                        gene_ids[var['hgvsid']] = genes
                 # move allele-specific info to the variant, like CSQ annotations
                 if 'info' in var:
                     if 'CSQ' in var['info']:
-                        if 'molecularAttributes' not in resultset[var['hgvsid']]:
-                            compile_molecular_attributes_from_csq(resultset[var['hgvsid']], var['info'].pop('CSQ'))
-
-            # now process the samples into the variations:
-            if 'samples' in variant and len(variant['samples']) > 0:
-                for k in variant['samples'].keys():
-                    sample = variant['samples'][k]
-                    # Begin creating a Case Level Data object
-                    cld = {
-                        'genotype': {
-                            'value': sample['GT']
-                        }
+                        if resultset[var['hgvsid']].molecular_attributes is None:
+                            resultset[var['hgvsid']].molecular_attributes = compile_molecular_attributes_from_csq(var['info'].pop('CSQ'))
+
+            # now process the samples' genotypes into the variations:
+            if 'genotypes' in variant:
+                add_genotypes_to_variations(resultset, allele_ids, passes, variant['genotypes'], drs_obj, drs_objs[drs_obj]['cohort'])
+        # only include variants that are actually seen in the data (not things like ref alleles that are not in any samples)
+        for variant in sorted(resultset.keys()):
+            if len(resultset[variant].carriers) > 0:
+                # VEP annotations are more specific, so only fall back to overlapping genes without them
+                if variant in gene_ids and resultset[variant].molecular_attributes is None:
+                    resultset[variant].molecular_attributes = {'geneIds': gene_ids[variant]}
+                yield resultset[variant]
+
+
+def iterate_filtered_variants(variant_records, filters):
+    # filter_variants, in batches of records: small at first, so that a short page doesn't read far ahead
+    batch_size = 16
+    batch = []
+    for variant in variant_records:
+        batch.append(variant)
+        if len(batch) >= batch_size:
+            yield from filter_variants(batch, filters)
+            batch = []
+            batch_size = min(batch_size * 2, FILTER_BATCH_SIZE)
+    yield from filter_variants(batch, filters)
+
+
+class BeaconResult:
+    """
+    A result of compile_beacon_resultset. The variation's position is kept like its interval: start is interbase,
+    so it's one less than the VCF position. carriers is a list of (RecordGenotypes, index of the allele, array of the
+    indices of the samples that carry it), for each record the variation was found in.
+    """
+    __slots__ = ('hgvsid', 'start', 'end', 'sequence_id', 'sequence', 'molecular_attributes', 'carriers')
+
+    def __init__(self, hgvsid, start, end, sequence_id, sequence):
+        self.hgvsid = hgvsid
+        self.start = start
+        self.end = end
+        self.sequence_id = sequence_id
+        self.sequence = sequence
+        self.molecular_attributes = None
+        self.carriers = []
+
+    def to_json(self):
+        # the result in the shape of a beacon response, without its caseLevelData
+        result = {
+            'variation': new_variation(self.start, self.end, self.sequence_id, self.sequence),
+            'identifiers': {
+                'genomicHGVSId': self.hgvsid
+            },
+            'variantInternalId': self.hgvsid
+        }
+        if self.molecular_attributes is not None:
+            result['molecularAttributes'] = self.molecular_attributes
+        return result
+
+
+class RecordGenotypes:
+    """
+    The genotype_arrays of a variant record, with the zygosity of each sample, shared by the carriers of all of its alleles.
+    """
+    __slots__ = ('drs_obj', 'cohort', 'allele_ids', 'genotypes', 'first', 'second', 'homozygous', 'simple')
+
+    def __init__(self, drs_obj, cohort, allele_ids, genotypes, first, second, homozygous, simple):
+        self.drs_obj = drs_obj
+        self.cohort = cohort
+        self.allele_ids = allele_ids
+        self.genotypes = genotypes
+        self.first = first
+        self.second = second
+        self.homozygous = homozygous
+        self.simple = simple
+
+
+def add_genotypes_to_variations(resultset, allele_ids, passes, genotypes, drs_obj, cohort):
+    """
+    Finds the samples that carry each of a record's alleles that passed the filters, using the genotype_arrays of the record.
+    The samples are kept as arrays in the BeaconResult's carriers: add_case_level_data turns them into caseLevelData.
+    Zygosity is judged from the first two alleles of each genotype only: a polyploid sample carrying an allele
+    in its third or later position isn't counted as a carrier.
+    """
+    alleles = genotypes['alleles']
+    if alleles.shape[0] == 0 or alleles.shape[1] == 0:
+        return
+    first, second = get_allele_pairs(alleles)
+    homozygous = first == second
+    simple = ~homozygous & ((first == 0) | (second == 0))
+    record = RecordGenotypes(drs_obj, cohort, allele_ids, genotypes, first, second, homozygous, simple)
+    for i in range(len(allele_ids)):
+        if not passes[i]:
+            continue
+        samples = numpy.flatnonzero((first == i) | (second == i))
+        if len(samples) == 0:
+            continue
+        resultset[allele_ids[i]].carriers.append((record, i, samples))
+
+
+def get_allele_pairs(alleles):
+    # the first and second allele of each sample in a genotype_arrays alleles array: haploid samples are counted as homozygous
+    first = alleles[:, 0]
+    second = first
+    if alleles.shape[1] > 1:
+        second = numpy.where(alleles[:, 1] == -2, first, alleles[:, 1])
+    return first, second
+
+
+def add_case_level_data(resultset, authed_cohorts):
+    """
+    Returns the resultset in the shape of a beacon response, with the carriers of each variation turned into its
+    caseLevelData: one entry per sample carrying the variation, identified only if the sample's cohort is in authed_cohorts.
+    """
+    return list(iterate_case_level_data(resultset, authed_cohorts))
+
+
+def iterate_case_level_data(resultset, authed_cohorts):
+    # generates the results of add_case_level_data one at a time
+    for variation in resultset:
+        case_level_data = []
+        for record, allele, samples in variation.carriers:
+            is_authed = record.cohort in authed_cohorts
+            genotypes = record.genotypes
+            allele_ids = record.allele_ids
+            for j in samples.tolist():
+                cld = {
+                    'genotype': {
+                        'value': variants.format_genotype(genotypes['alleles'][j].tolist(), genotypes['phased'][j])
+                    }
+                }
+                if is_authed:
+                    cld['analysisId'] = record.drs_obj
+                    cld['biosampleId'] = f"{record.cohort}~{genotypes['samples'][j]}"
+                if record.homozygous[j]:
+                    cld['genotype']['zygosity'] = {
+                        'id': 'GENO:0000136',
+                        'label': 'homozygous'
                     }
-                    # check to see that we should be processing the actual sample data:
-                    if is_authed:
-                        cld['analysisId'] = drs_obj
-                        cld['biosampleId'] = f"{x['cohort']}~{k}"
-                    alleles = sample['GT'].split('/')
-                    if len(alleles) < 2:
-                        alleles = sample['GT'].split('|')
-                    # put a copy of this cld in each variation:
-                    cld['genotype']['secondaryAlleleIds'] = [resultset[drs_obj][int(alleles[0])], resultset[drs_obj][int(alleles[1])]]
-                    if alleles[0] == alleles[1]:
+                else:
+                    other = int(record.second[j] if record.first[j] == allele else record.first[j])
+                    if other < 0:
+                        # the other allele wasn't called (e.g. ./1), so all we know is that it's a heterozygous call
                         cld['genotype']['zygosity'] = {
-                            'id': 'GENO:0000136',
-                            'label': 'homozygous'
+                            'id': 'GENO:0000135',
+                            'label': 'heterozygous'
                         }
-                        cld['genotype'].pop('secondaryAlleleIds')
-                        if alleles[0].isdigit():
-                            var = resultset[drs_obj][int(alleles[0])]
-                            if 'caseLevelData' not in resultset[var]:
-                                resultset[var]['caseLevelData'] = []
-                            resultset[var]['caseLevelData'].append(json.loads(json.dumps(cld)))
                     else:
-                        if alleles[0] == '0' or alleles[1] == '0':
+                        cld['genotype']['secondaryAlleleIds'] = [allele_ids[other]] if other < len(allele_ids) else []
+                        if record.simple[j]:
                             cld['genotype']['zygosity'] = {
                                 'id': 'GENO:0000458',
                                 'label': 'simple heterozygous'
@@ -452,67 +1110,29 @@ def compile_beacon_resultset(variants_by_obj, reference_genome="hg38"):
                                 'id': 'GENO:0000402',
                                 'label': 'compound heterozygous'
                             }
-                        for a in alleles:
-                            if a.isdigit():
-                                var = resultset[drs_obj][int(a)]
-                                # make a copy cld for the other allele's variant
-                                second_cld = json.loads(json.dumps(cld))
-                                # this allele should not be in cld's secondaryAlleleIds,
-                                # and the second allele should not be in second_cld's secondaryAlleleIds
-                                second_cld['genotype']['secondaryAlleleIds'].remove(resultset[drs_obj][int(a)])
-                                if 'caseLevelData' not in resultset[var]:
-                                    resultset[var]['caseLevelData'] = []
-                                resultset[var]['caseLevelData'].append(second_cld)
-        resultset.pop(drs_obj)
-    final_resultset = []
-    # only include variants that are actually seen in the data (not things like ref alleles that are not in any samples)
-    for variant in resultset.keys():
-        if 'caseLevelData' in resultset[variant] and len(resultset[variant]['caseLevelData']) > 0:
-            resultset[variant]['variantInternalId'] = variant
-            final_resultset.append(resultset[variant])
-    final_resultset.sort(key=lambda x: x['variantInternalId'])
-    return final_resultset
+                case_level_data.append(cld)
+        variation_json = variation.to_json()
+        variation_json['caseLevelData'] = case_level_data
+        yield variation_json
 
 
 def compile_variations_from_record(ref="", alt=[""], chrom="", pos="", reference_genome="hg38"):
     start = int(pos)
     end = int(pos)
-    variations = [
-        {
-            "type": "Allele",
-            "location": {
-                "interval": {
-                    "start": {
-                        "value": start - 1, # interbase count, so start is from 0
-                        "type": "Number"
-                    },
-                    "end": {
-                        "value": end,
-                        "type": "Number"
-                    },
-                    "type": "SequenceInterval"
-                },
-                "type": "SequenceLocation",
-                "sequence_id": ""
-            },
-            "state": {
-                "type": "LiteralSequenceExpression",
-                "sequence": ref
-            }
-        }
-    ]
 
     # find the correct sequence_id for the chromosome:
-    seqid = database.get_refseq_for_chromosome(reference_genome=reference_genome, contig=database.normalize_contig(chrom))
+    seqid = refseq.refseq_index.chromosome(reference_genome, chrom)
+    sequence_id = ""
     hgvsid_base = ""
     if seqid is not None:
-        variations[0]['location']['sequence_id'] = "refseq:" + seqid
+        sequence_id = "refseq:" + seqid
         hgvsid_base = f"{seqid}:g.{start}"
+    # interbase count, so start is from 0
+    variations = [new_variation(start - 1, end, sequence_id, ref)]
 
     # alt is a list of alt alleles
     for a in alt:
-        # make a copy of the ref variation
-        alt_variation = json.loads(json.dumps(variations[0]))
+        alt_variation = new_variation(start - 1, end, sequence_id, ref)
         variations.append(alt_variation)
         if len(ref) == 1 and len(a) == 1: # snp
             alt_variation['state']['sequence'] = a
@@ -523,7 +1143,7 @@ def compile_variations_from_record(ref="", alt=[""], chrom="", pos="", reference
             cn_parse = re.match(r"<CN(\d+)>", a)
             if cn_parse is not None:
                 copynum = int(cn_parse.group(1))
-                alt_variation['state']['sequence'] = ref * copynum
+                alt_variation['state']['sequence'] = alt_sequence(ref, a)
                 alt_variation['hgvsid'] = f"{hgvsid_base}{ref}[{copynum}]"
                 continue
 
@@ -538,6 +1158,40 @@ def compile_variations_from_record(ref="", alt=[""], chrom="", pos="", reference
     return variations
 
 
+def new_variation(start, end, sequence_id, sequence):
+    return {
+        "type": "Allele",
+        "location": {
+            "interval": {
+                "start": {
+                    "value": start,
+                    "type": "Number"
+                },
+                "end": {
+                    "value": end,
+                    "type": "Number"
+                },
+                "type": "SequenceInterval"
+            },
+            "type": "SequenceLocation",
+            "sequence_id": sequence_id
+        },
+        "state": {
+            "type": "LiteralSequenceExpression",
+            "sequence": sequence
+        }
+    }
+
+
+def alt_sequence(ref, alt):
+    # the sequence of the variation for an alt allele: copy number variations repeat the ref
+    if '<CN' in alt:
+        cn_parse = re.match(r"<CN(\d+)>", alt)
+        if cn_parse is not None:
+            return ref * int(cn_parse.group(1))
+    return alt
+
+
 def assign_info_to_variations(variant):
     if 'info' not in variant:
         return None
@@ -584,7 +1238,7 @@ def assign_info_to_variations(variant):
                     info_obj.pop(k)
 
 
-def compile_molecular_attributes_from_csq(g_variant, csq_list):
+def compile_molecular_attributes_from_csq(csq_list):
     aa_changes = set()
     gene_ids = set()
     mol_effects = set()
@@ -600,15 +1254,16 @@ def compile_molecular_attributes_from_csq(g_variant, csq_list):
             for c in csq['Consequence'].split('&'):
                 mol_effects.add(c)
 
-    g_variant['molecularAttributes'] = {}
+    molecular_attributes = {}
     if len(aa_changes) > 0:
-        g_variant['molecularAttributes']['aminoacidChanges'] = list(aa_changes)
+        molecular_attributes['aminoacidChanges'] = list(aa_changes)
     if len(gene_ids) > 0:
-        g_variant['molecularAttributes']['geneIds'] = list(gene_ids)
+        molecular_attributes['geneIds'] = list(gene_ids)
     if len(mol_effects) > 0:
-        g_variant['molecularAttributes']['molecularEffects'] = []
+        molecular_attributes['molecularEffects'] = []
         for c in mol_effects:
-            g_variant['molecularAttributes']['molecularEffects'].append(get_mol_effect_from_consequence(c))
+            molecular_attributes['molecularEffects'].append(get_mol_effect_from_consequence(c))
+    return molecular_attributes
 
 
 def get_mol_effect_from_consequence(consequence):
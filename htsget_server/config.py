@@ -23,12 +23,61 @@ CHUNK_SIZE = int(config['DEFAULT']['ChunkSize'])
 
 BUCKET_SIZE = int(config['DEFAULT']['BucketSize'])
 
+# "rows" stores a row for each pos_bucket in each variantfile;
+# "packed" stores a row of packed pos_bucket arrays for each contig in each variantfile
+PACKED_BUCKETS = config['DEFAULT']['BucketStorage'] == "packed"
+
 PORT = config['DEFAULT']['Port']
 
 AGGREGATE_COUNT_THRESHOLD = config['DEFAULT']['AGGREGATE_COUNT_THRESHOLD']
 
+# add the RefSeq genes that overlap each beacon variation to its molecularAttributes,
+# if the variation's file wasn't annotated with VEP
+ANNOTATE_GENES = config['DEFAULT'].getboolean('AnnotateGenes', fallback=False)
+
 MAX_TRIES = int(config['DEFAULT']['MaxTries'])
 
+# seconds that a request can spend retrying database operations, in total
+RETRY_DEADLINE = float(config['DEFAULT']['RetryDeadline'])
+
+# number of consecutive failed database connections before failing fast,
+# and the number of seconds to wait before trying the database again
+CIRCUIT_BREAKER_THRESHOLD = int(config['DEFAULT']['CircuitBreakerThreshold'])
+CIRCUIT_BREAKER_RESET = float(config['DEFAULT']['CircuitBreakerReset'])
+
+# each worker reads variant files for region searches on a pool of VCF_FETCH_THREADS threads;
+# a single request uses at most VCF_FETCH_CONCURRENCY of them at a time
+VCF_FETCH_THREADS = int(config['DEFAULT']['VcfFetchThreads'])
+VCF_FETCH_CONCURRENCY = max(1, min(VCF_FETCH_THREADS, int(config['DEFAULT']['VcfFetchConcurrency'])))
+
+# gunicorn runs WORKERS processes of THREADS threads each (see gunicorn.conf.py),
+# and every process keeps its own connection pool, shared by its request threads and
+# its VCF fetch threads. DB_MAX_CONNECTIONS is the most connections this container
+# should hold open to postgres, across all of its workers.
+WORKERS = int(os.getenv("WORKERS", 4))
+THREADS = int(os.getenv("THREADS", 4))
+DB_MAX_CONNECTIONS = int(os.getenv("DB_MAX_CONNECTIONS", 2 * WORKERS * THREADS))
+POOL_SIZE = max(1, min(THREADS + VCF_FETCH_THREADS, DB_MAX_CONNECTIONS // WORKERS))
+POOL_MAX_OVERFLOW = max(0, DB_MAX_CONNECTIONS // WORKERS - POOL_SIZE)
+POOL_TIMEOUT = float(config['DEFAULT']['PoolTimeout'])
+POOL_RECYCLE = int(config['DEFAULT']['PoolRecycle'])
+
+# number of variantfiles whose parsed headers each worker keeps
+HEADER_CACHE_SIZE = int(config['DEFAULT']['HeaderCacheSize'])
+
+# number of beacon variations each worker keeps in its cache of beacon search results
+BEACON_CACHE_SIZE = int(config['DEFAULT']['BeaconCacheSize'])
+
+# each worker reuses OPA decisions and service token verifications for the same tokens for AUTHZ_CACHE_TTL seconds,
+# for up to AUTHZ_CACHE_SIZE lookups; a TTL of 0 only reuses them within a request
+AUTHZ_CACHE_TTL = float(config['DEFAULT']['AuthzCacheTTL'])
+AUTHZ_CACHE_SIZE = int(config['DEFAULT']['AuthzCacheSize'])
+
+# stream large JSON responses (beacon records and DRS object lists) as they're serialized, instead of building them
+# all at once; JSON_ENCODER is "json", or "orjson" to use orjson if it's installed
+STREAM_RESPONSES = config['DEFAULT'].getboolean('StreamResponses', fallback=False)
+JSON_ENCODER = config['DEFAULT'].get('JsonEncoder', fallback="json")
+
 TEST_KEY = os.getenv("HTSGET_TEST_KEY", "testtesttest")
 
 DEBUG_MODE = False
@@ -1,19 +1,93 @@
-from sqlalchemy.orm import declarative_base, relationship, sessionmaker, aliased
-from sqlalchemy import Column, Integer, String, Boolean, MetaData, ForeignKey, Table, create_engine, select
+from sqlalchemy.orm import declarative_base, relationship, sessionmaker, aliased, joinedload, selectinload
+from sqlalchemy import Column, Integer, String, Boolean, LargeBinary, MetaData, ForeignKey, Table, create_engine, select
+import sqlalchemy.exc
+import sqlalchemy.event
+import functools
 import json
+import numpy
 import re
+import threading
 from datetime import datetime
-from random import randint
-from time import sleep
-from config import DB_PATH, BUCKET_SIZE, HTSGET_URL, MAX_TRIES
-from flask import Flask
+from random import uniform
+from time import sleep, monotonic
+from sqlalchemy.pool import QueuePool
+from config import DB_PATH, BUCKET_SIZE, HTSGET_URL, MAX_TRIES, RETRY_DEADLINE, CIRCUIT_BREAKER_THRESHOLD, CIRCUIT_BREAKER_RESET
+from config import POOL_SIZE, POOL_MAX_OVERFLOW, POOL_TIMEOUT, POOL_RECYCLE, PACKED_BUCKETS
+import os
+from flask import Flask, g, has_request_context
 from candigv2_logging.logging import CanDIGLogger
 
 
 logger = CanDIGLogger(__file__)
 
 
-engine = create_engine(DB_PATH, echo=False, pool_timeout=5, pool_size=10)
+## Connection pool
+class InstrumentedQueuePool(QueuePool):
+    """
+    A QueuePool that records how long each checkout waited for a connection.
+    """
+    # upper bounds, in seconds, of the checkout wait time histogram buckets
+    wait_buckets = [0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5]
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.metrics_lock = threading.Lock()
+        self.wait_counts = [0] * (len(self.wait_buckets) + 1)
+        self.wait_sum = 0
+        self.timeouts = 0
+
+    def _do_get(self):
+        start = monotonic()
+        try:
+            return super()._do_get()
+        except sqlalchemy.exc.TimeoutError:
+            with self.metrics_lock:
+                self.timeouts += 1
+            raise
+        finally:
+            self.record_wait(monotonic() - start)
+
+    def record_wait(self, wait):
+        i = 0
+        while i < len(self.wait_buckets) and wait > self.wait_buckets[i]:
+            i += 1
+        with self.metrics_lock:
+            self.wait_counts[i] += 1
+            self.wait_sum += wait
+
+    def metrics(self):
+        with self.metrics_lock:
+            histogram = {}
+            total = 0
+            for i in range(len(self.wait_buckets)):
+                total += self.wait_counts[i]
+                histogram[str(self.wait_buckets[i])] = total
+            histogram["+Inf"] = total + self.wait_counts[-1]
+            return {
+                "pid": os.getpid(),
+                "pool_size": self.size(),
+                "max_overflow": self._max_overflow,
+                "checked_out": self.checkedout(),
+                "checked_in": self.checkedin(),
+                "overflow": max(0, self.overflow()),
+                "timeouts": self.timeouts,
+                "checkout_wait_seconds": {
+                    "count": histogram["+Inf"],
+                    "sum": self.wait_sum,
+                    "buckets": histogram
+                }
+            }
+
+
+# each gunicorn worker process gets its own pool, sized for its threads
+# (see config.py); pre-ping and recycle drop connections the server has closed
+engine = create_engine(DB_PATH, echo=False, poolclass=InstrumentedQueuePool,
+    pool_size=POOL_SIZE, max_overflow=POOL_MAX_OVERFLOW, pool_timeout=POOL_TIMEOUT,
+    pool_recycle=POOL_RECYCLE, pool_pre_ping=True)
+
+
+def get_pool_metrics():
+    return engine.pool.metrics()
 
 ObjectDBBase = declarative_base()
 
@@ -135,6 +209,13 @@ class VariantFile(ObjectDBBase):
         back_populates="variantfile",
         cascade="all, delete, delete-orphan"
     )
+
+    # if pos_buckets are packed, a variantfile has a set of them for each contig
+    pos_bucket_arrays = relationship(
+        "PositionBucketArray",
+        back_populates="variantfile",
+        cascade="all, delete, delete-orphan"
+    )
     def __repr__(self):
         result = {
             'id': self.id,
@@ -180,6 +261,62 @@ class PositionBucket(ObjectDBBase):
         return json.dumps(result)
 
 
+# The compact alternative to PositionBucket/PositionBucketVariantFileAssociation
+# (BucketStorage = packed in config.ini): one row per variantfile and contig,
+# with the contig's pos_bucket_ids, in order, and their counts packed as arrays
+# of big-endian int32s (the same encoding as postgres's int4send).
+class PositionBucketArray(ObjectDBBase):
+    __tablename__ = 'pos_bucket_array'
+    variantfile_id = Column(String, ForeignKey('variantfile.id'), primary_key=True)
+    contig_id = Column(String, ForeignKey('contig.id'), primary_key=True)
+    bucket_ids = Column(LargeBinary)
+    bucket_counts = Column(LargeBinary)
+
+    variantfile = relationship(
+        "VariantFile",
+        back_populates="pos_bucket_arrays",
+        uselist=False
+    )
+    def __repr__(self):
+        result = {
+            'variantfile_id': self.variantfile_id,
+            'contig_id': self.contig_id,
+            'pos_bucket_ids': unpack_bucket_array(self.bucket_ids).tolist(),
+            'counts': unpack_bucket_array(self.bucket_counts).tolist()
+        }
+        return json.dumps(result)
+
+
+BUCKET_ARRAY_DTYPE = numpy.dtype('>i4')
+
+
+def pack_bucket_array(values):
+    return numpy.asarray(values, dtype=BUCKET_ARRAY_DTYPE).tobytes()
+
+
+def unpack_bucket_array(packed):
+    if packed is None:
+        return numpy.zeros(0, dtype=BUCKET_ARRAY_DTYPE)
+    return numpy.frombuffer(packed, dtype=BUCKET_ARRAY_DTYPE)
+
+
+def sum_bucket_array(bucket_ids, bucket_counts, start=None, end=None):
+    """
+    Sum the packed counts for the pos_bucket_ids between start and end, inclusive.
+    Returns None if no pos_buckets are in range.
+    """
+    ids = unpack_bucket_array(bucket_ids)
+    first = 0
+    last = len(ids)
+    if start is not None:
+        first = numpy.searchsorted(ids, start, side='left')
+    if end is not None:
+        last = numpy.searchsorted(ids, end, side='right')
+    if last <= first:
+        return None
+    return int(unpack_bucket_array(bucket_counts)[first:last].sum())
+
+
 class Sample(ObjectDBBase):
     __tablename__ = 'sample'
     id = Column(Integer, primary_key=True, autoincrement=True)
@@ -274,10 +411,10 @@ class DrsObject(ObjectDBBase):
     version = Column(String, default='')
     mime_type = Column(String, default='application/octet-stream')
     checksums = Column(String, default='[]') # JSON array of strings
-    access_methods = relationship("AccessMethod", back_populates="drs_object", cascade="all, delete, delete-orphan")
+    access_methods = relationship("AccessMethod", back_populates="drs_object", cascade="all, delete, delete-orphan", order_by="AccessMethod.id")
     description = Column(String, default='')
     aliases = Column(String, default='[]') # JSON array of strings of aliases
-    contents = relationship("ContentsObject", cascade="all, delete, delete-orphan")
+    contents = relationship("ContentsObject", cascade="all, delete, delete-orphan", order_by="ContentsObject.id")
     cohort_id = Column(String, ForeignKey('cohort.id'))
     cohort = relationship("Cohort", back_populates="associated_drs")
     variantfile = relationship("VariantFile", back_populates="drs_object", cascade="all, delete")
@@ -300,7 +437,7 @@ class DrsObject(ObjectDBBase):
             result['contents'] = json.loads(self.contents.__repr__())
         if len(list(self.access_methods)) > 0:
             result['access_methods'] = json.loads(self.access_methods.__repr__())
-        if self.cohort is not None:
+        if self.cohort_id is not None:
             result['cohort'] = self.cohort_id
         if self.variantfile is not None and len(self.variantfile) > 0:
             result['indexed'] = self.variantfile[0].indexed
@@ -357,166 +494,323 @@ class ContentsObject(ObjectDBBase):
         return json.dumps(result)
 
 
+# a single row whose version changes whenever the indexed data does: see bump_dataset_version
+class DatasetVersion(ObjectDBBase):
+    __tablename__ = 'dataset_version'
+    id = Column(Integer, primary_key=True)
+    version = Column(Integer, default=0)
+
+    def __repr__(self):
+        result = {
+            'version': self.version
+        }
+        return json.dumps(result)
+
+
+# the row is created with the table, like in files.sql, so that bump_dataset_version only has to update it
+sqlalchemy.event.listen(DatasetVersion.__table__, 'after_create', sqlalchemy.DDL("INSERT INTO dataset_version (id, version) VALUES (1, 0)"))
+
+
 ObjectDBBase.metadata.create_all(engine)
 Session = sessionmaker(bind=engine)
 
 
+# DrsObject.__repr__ reads contents, access_methods and variantfile: load them
+# up front instead of lazily, one query per relationship per object.
+# A single object is small enough to fetch in one joined query;
+# lists use one extra IN query per relationship, regardless of length.
+DRS_OBJECT_JOINED_LOAD = [
+    joinedload(DrsObject.contents),
+    joinedload(DrsObject.access_methods),
+    joinedload(DrsObject.variantfile)
+]
+DRS_OBJECT_SELECTIN_LOAD = [
+    selectinload(DrsObject.contents),
+    selectinload(DrsObject.access_methods),
+    selectinload(DrsObject.variantfile)
+]
+# streamed lists load this many objects, and their relationships, at a time
+DRS_OBJECT_BATCH_SIZE = 500
+
+
+## Retry policy
+class DatabaseUnavailable(Exception):
+    """
+    Raised instead of trying the database when it has been failing to connect.
+    """
+    pass
+
+
+class RetriesExhausted(Exception):
+    """
+    Raised when a retried database operation has used up its tries or its deadline.
+    """
+    pass
+
+
+class CircuitBreaker:
+    """
+    Counts consecutive connection failures for this worker. After `threshold` of them,
+    the breaker opens and calls fail immediately for `reset_timeout` seconds; after that,
+    a single trial call is let through to see if the database is back.
+    """
+    def __init__(self, threshold=CIRCUIT_BREAKER_THRESHOLD, reset_timeout=CIRCUIT_BREAKER_RESET):
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self.lock = threading.Lock()
+
+    def before_call(self):
+        with self.lock:
+            if self.opened_at is None:
+                return
+            if monotonic() - self.opened_at < self.reset_timeout:
+                raise DatabaseUnavailable(f"database unavailable: {self.failures} failed connections, retrying in {int(self.reset_timeout - (monotonic() - self.opened_at))}s")
+            # half-open: let this call through, but re-open right away if it fails
+            self.opened_at = monotonic()
+
+    def record_success(self):
+        with self.lock:
+            self.failures = 0
+            self.opened_at = None
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.failures >= self.threshold:
+                if self.opened_at is None:
+                    logger.warning(f"database circuit breaker opened after {self.failures} failed connections")
+                self.opened_at = monotonic()
+
+
+circuit_breaker = CircuitBreaker()
+
+
+def _is_connection_error(e):
+    if isinstance(e, (sqlalchemy.exc.DisconnectionError, sqlalchemy.exc.TimeoutError)):
+        return True
+    if isinstance(e, sqlalchemy.exc.DBAPIError) and e.connection_invalidated:
+        return True
+    # serialization failures and deadlocks are also OperationalErrors, but the database is up
+    if isinstance(e, sqlalchemy.exc.OperationalError):
+        return not _is_transaction_conflict(e)
+    return False
+
+
+def _is_transaction_conflict(e):
+    # SQLSTATE class 40: serialization_failure, deadlock_detected
+    pgcode = getattr(getattr(e, 'orig', None), 'pgcode', None)
+    return pgcode is not None and pgcode.startswith('40')
+
+
+def get_retry_deadline():
+    # all of the retries in a single request share a deadline
+    if has_request_context():
+        if 'db_retry_deadline' not in g:
+            g.db_retry_deadline = monotonic() + RETRY_DEADLINE
+        return g.db_retry_deadline
+    return monotonic() + RETRY_DEADLINE
+
+
+def retry(retry_on=(), base_delay=0.05, max_delay=2):
+    """
+    Retry a database operation if it fails for a transient reason: a dropped connection,
+    a pool timeout, or a serialization failure/deadlock, plus any exception types in retry_on.
+    Waits between tries are exponential with full jitter, up to MAX_TRIES tries, and never
+    past the request's retry deadline. Any other exception is raised right away.
+    If a retried operation calls another one, the inner one's failures are retried there,
+    and aren't retried again or counted against the circuit breaker by the outer one.
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            deadline = get_retry_deadline()
+            tries = 1
+            while True:
+                circuit_breaker.before_call()
+                try:
+                    result = func(*args, **kwargs)
+                    circuit_breaker.record_success()
+                    return result
+                except (DatabaseUnavailable, RetriesExhausted):
+                    # raised by a retried operation inside this one: it has already been retried and recorded
+                    raise
+                except Exception as e:
+                    if _is_connection_error(e):
+                        circuit_breaker.record_failure()
+                    else:
+                        # the database answered, even if it was with an error
+                        circuit_breaker.record_success()
+                        if not _is_transaction_conflict(e) and not isinstance(e, retry_on):
+                            raise
+                    delay = uniform(0, min(max_delay, base_delay * 2 ** tries))
+                    if tries >= MAX_TRIES or monotonic() + delay > deadline:
+                        raise RetriesExhausted(f"Exception in {func.__name__}, too many tries: {type(e)} {str(e)}") from e
+                    logger.debug(f"Exception in {func.__name__}: {str(e)}, trying again")
+                    sleep(delay)
+                    tries += 1
+        return wrapper
+    return decorator
+
+
 """ Helper Functions"""
-def get_drs_object(object_id, expand=False, tries=1):
-    if tries > MAX_TRIES:
-        raise Exception(f"Exception in get_drs_object {object_id}, too many tries")
-    elif tries > 1:
-        # if this isn't the first try, pause for a bit and then try again
-        sleep(randint(1,10)/2)
-    try:
-        with Session() as session:
-            result = session.query(DrsObject).filter_by(id=object_id).one_or_none()
-            if result is not None:
-                new_obj = json.loads(str(result))
-    #         if expand:
-    #             expand doesn't do anything on this DRS server
-                return new_obj
-    except Exception as e:
-        logger.debug(f"Exception in get_drs_object {object_id}: {str(e)}, trying again")
-        return get_drs_object(object_id, expand, tries=tries+1)
+@retry()
+def get_drs_object(object_id, expand=False):
+    with Session() as session:
+        result = session.query(DrsObject).options(*DRS_OBJECT_JOINED_LOAD).filter_by(id=object_id).one_or_none()
+        if result is not None:
+            new_obj = json.loads(str(result))
+    #     if expand:
+    #         expand doesn't do anything on this DRS server
+            return new_obj
     return None
 
 
+@retry()
+def get_drs_objects(object_ids):
+    # returns {object_id: drs_object} for each of object_ids that exists
+    object_ids = set(object_ids)
+    if len(object_ids) == 0:
+        return {}
+    with Session() as session:
+        result = session.query(DrsObject).options(*DRS_OBJECT_SELECTIN_LOAD).filter(DrsObject.id.in_(object_ids)).all()
+        new_obj = {}
+        for drs_obj in json.loads(str(result)):
+            new_obj[drs_obj['id']] = drs_obj
+        return new_obj
+
+
 def list_drs_objects(cohort_id=None):
     with Session() as session:
+        q = session.query(DrsObject).options(*DRS_OBJECT_SELECTIN_LOAD)
         if cohort_id is not None:
-            result = session.query(DrsObject).filter_by(cohort_id=cohort_id).all()
-        else:
-            result = session.query(DrsObject).all()
+            q = q.filter_by(cohort_id=cohort_id)
+        result = q.all()
         if result is not None:
             new_obj = json.loads(str(result))
             return new_obj
         return None
 
 
-def create_drs_object(obj, tries=1):
+def iterate_drs_objects(cohort_id=None):
+    # the same as list_drs_objects, but generates the objects as they're read, DRS_OBJECT_BATCH_SIZE rows at a time
+    with Session() as session:
+        q = session.query(DrsObject).options(*DRS_OBJECT_SELECTIN_LOAD)
+        if cohort_id is not None:
+            q = q.filter_by(cohort_id=cohort_id)
+        for obj in q.yield_per(DRS_OBJECT_BATCH_SIZE):
+            yield json.loads(str(obj))
+
+
+@retry(retry_on=sqlalchemy.exc.IntegrityError)
+def create_drs_object(obj):
     logger.debug(f"create_drs_object {obj['id']}")
-    if tries > MAX_TRIES:
-        raise Exception(f"Exception in create_drs_object {obj['id']}, too many tries")
-    elif tries > 1:
-        # if this isn't the first try, pause for a bit and then try again
-        sleep(randint(1,10)/2)
-    try:
-        with Session() as session:
-            new_object = session.query(DrsObject).filter_by(id=obj['id']).one_or_none()
-            if new_object is None:
-                new_object = DrsObject()
-
-            # required fields:
-            new_object.id = obj['id']
-            if 'name' in obj:
-                new_object.name = obj['name']
-            else:
-                new_object.name = obj['id']
-
-            # optional string fields
-            new_object.self_uri = f'{HTSGET_URL.replace("http://", "drs://").replace("https://", "drs://")}/{new_object.name}'
-            if 'created_time' in obj:
-                new_object.created_time = obj['created_time']
-            if 'updated_time' in obj:
-                new_object.updated_time = obj['updated_time']
-            if 'mime_type' in obj:
-                new_object.mime_type = obj['mime_type']
-            if 'version' in obj:
-                new_object.version = obj['version']
-            if 'size' in obj:
-                new_object.size = obj['size']
-            if 'description' in obj:
-                new_object.description = obj['description']
-            if 'cohort' in obj:
-                cohort = session.query(Cohort).filter_by(id=obj['cohort']).one_or_none()
-                if cohort is None:
-                    create_cohort({"id": obj["cohort"], "drsobjects": []})
-                new_object.cohort_id = obj['cohort']
-
-            # json arrays stored as strings
-            if 'checksums' in obj:
-                new_object.checksums = json.dumps(obj['checksums'])
-            if 'aliases' in obj:
-                new_object.aliases = json.dumps(obj['aliases'])
-
-            # access methods is special
-            if 'access_methods' not in obj:
-                obj['access_methods'] = []
-            # only add access methods after removing any previous ones
-            if len(new_object.access_methods) != 0:
-                for method in new_object.access_methods:
-                    session.delete(method)
-                    session.commit()
-            for method in obj['access_methods']:
-                new_method = AccessMethod()
-                new_method.drs_object_id = new_object.id
-                new_method.type = method['type']
-                if 'region' in method:
-                    new_method.region = method['region']
-                if 'access_id' in method:
-                    new_method.access_id = method['access_id']
-                if 'access_url' in method:
-                    new_method.url = method['access_url']['url']
-                    if 'headers' in method['access_url']:
-                        new_method.headers = json.dumps(method['access_url']['headers'])
-                session.add(new_method)
-
-            # contents objects are special
-            if 'contents' not in obj:
-                obj['contents'] = []
-            if len(new_object.contents) != 0:
-                for contents in new_object.contents:
-                    session.delete(contents)
-                    session.commit()
-            for contents in obj['contents']:
-                new_contents = ContentsObject()
-                new_contents.drs_object_id = new_object.id
-                new_contents.name = contents['name']
-                if 'drs_uri' in contents:
-                    new_contents.drs_uri = json.dumps(contents['drs_uri'])
-                if 'contents' in contents:
-                    new_contents.contents = json.dumps(contents['contents'])
-                if 'id' in contents:
-                    new_contents.contents_id = contents['id']
-                session.add(new_contents)
-            session.add(new_object)
-            session.commit()
+    with Session() as session:
+        new_object = session.query(DrsObject).filter_by(id=obj['id']).one_or_none()
+        if new_object is None:
+            new_object = DrsObject()
+
+        # required fields:
+        new_object.id = obj['id']
+        if 'name' in obj:
+            new_object.name = obj['name']
+        else:
+            new_object.name = obj['id']
+
+        # optional string fields
+        new_object.self_uri = f'{HTSGET_URL.replace("http://", "drs://").replace("https://", "drs://")}/{new_object.name}'
+        if 'created_time' in obj:
+            new_object.created_time = obj['created_time']
+        if 'updated_time' in obj:
+            new_object.updated_time = obj['updated_time']
+        if 'mime_type' in obj:
+            new_object.mime_type = obj['mime_type']
+        if 'version' in obj:
+            new_object.version = obj['version']
+        if 'size' in obj:
+            new_object.size = obj['size']
+        if 'description' in obj:
+            new_object.description = obj['description']
+        if 'cohort' in obj:
+            cohort = session.query(Cohort).filter_by(id=obj['cohort']).one_or_none()
+            if cohort is None:
+                create_cohort({"id": obj["cohort"], "drsobjects": []})
+            new_object.cohort_id = obj['cohort']
+
+        # json arrays stored as strings
+        if 'checksums' in obj:
+            new_object.checksums = json.dumps(obj['checksums'])
+        if 'aliases' in obj:
+            new_object.aliases = json.dumps(obj['aliases'])
+
+        # access methods is special
+        if 'access_methods' not in obj:
+            obj['access_methods'] = []
+        # only add access methods after removing any previous ones
+        if len(new_object.access_methods) != 0:
+            for method in new_object.access_methods:
+                session.delete(method)
+                session.commit()
+        for method in obj['access_methods']:
+            new_method = AccessMethod()
+            new_method.drs_object_id = new_object.id
+            new_method.type = method['type']
+            if 'region' in method:
+                new_method.region = method['region']
+            if 'access_id' in method:
+                new_method.access_id = method['access_id']
+            if 'access_url' in method:
+                new_method.url = method['access_url']['url']
+                if 'headers' in method['access_url']:
+                    new_method.headers = json.dumps(method['access_url']['headers'])
+            session.add(new_method)
+
+        # contents objects are special
+        if 'contents' not in obj:
+            obj['contents'] = []
+        if len(new_object.contents) != 0:
+            for contents in new_object.contents:
+                session.delete(contents)
+                session.commit()
+        for contents in obj['contents']:
+            new_contents = ContentsObject()
+            new_contents.drs_object_id = new_object.id
+            new_contents.name = contents['name']
+            if 'drs_uri' in contents:
+                new_contents.drs_uri = json.dumps(contents['drs_uri'])
+            if 'contents' in contents:
+                new_contents.contents = json.dumps(contents['contents'])
+            if 'id' in contents:
+                new_contents.contents_id = contents['id']
+            session.add(new_contents)
+        session.add(new_object)
+        session.commit()
 
-            # if we have reference_genome info, it's a GenomicDrsObject and needs a variantfile:
-            if 'reference_genome' in obj:
-                create_variantfile({"id": obj["id"], "reference_genome": obj["reference_genome"]})
+        # if we have reference_genome info, it's a GenomicDrsObject and needs a variantfile:
+        if 'reference_genome' in obj:
+            create_variantfile({"id": obj["id"], "reference_genome": obj["reference_genome"]})
 
-            result = session.query(DrsObject).filter_by(id=obj['id']).one_or_none()
-            logger.debug(f"DONE create_drs_object {obj['id']}")
-            return json.loads(str(result))
-    except Exception as e:
-        logger.debug(f"Exception in create_drs_object {obj['id']}: {str(e)}, trying again")
-        return create_drs_object(obj, tries=tries+1)
-
-
-def delete_drs_object(obj_id, tries=1):
-    if tries > MAX_TRIES:
-        raise Exception(f"Exception in delete_drs_object {obj_id}, too many tries")
-    elif tries > 1:
-        # if this isn't the first try, pause for a bit and then try again
-        sleep(randint(1,10)/2)
-    try:
-        with Session() as session:
-            new_object = session.query(DrsObject).filter_by(id=obj_id).one()
-            cohort = session.query(Cohort).filter_by(id=new_object.cohort_id).one_or_none()
-            if new_object.description in ["wgs", "wts"]:
-                # this is a GenomicDrsObject; we need to delete any indexed variantfiles
-                variantfiles = session.query(VariantFile).filter_by(drs_object_id=new_object.id).all()
-                for vf in variantfiles:
-                    session.delete(vf)
-                    session.commit()
-            session.delete(new_object)
-            session.commit()
-            return json.loads(str(new_object))
-    except Exception as e:
-        logger.debug(f"Exception in delete_drs_object {obj_id}: {str(e)}, trying again")
-        return delete_drs_object(obj_id, tries=tries+1)
+        result = session.query(DrsObject).options(*DRS_OBJECT_JOINED_LOAD).filter_by(id=obj['id']).one_or_none()
+        logger.debug(f"DONE create_drs_object {obj['id']}")
+        return json.loads(str(result))
+
+
+@retry()
+def delete_drs_object(obj_id):
+    with Session() as session:
+        new_object = session.query(DrsObject).filter_by(id=obj_id).one()
+        cohort = session.query(Cohort).filter_by(id=new_object.cohort_id).one_or_none()
+        if new_object.description in ["wgs", "wts"]:
+            # this is a GenomicDrsObject; we need to delete any indexed variantfiles
+            variantfiles = session.query(VariantFile).filter_by(drs_object_id=new_object.id).all()
+            for vf in variantfiles:
+                session.delete(vf)
+                bump_dataset_version(session)
+                session.commit()
+        session.delete(new_object)
+        session.commit()
+        return json.loads(str(new_object))
     return None
 
 
@@ -538,53 +832,37 @@ def list_cohorts():
         return None
 
 
-def create_cohort(obj, tries=1):
-    if tries > MAX_TRIES:
-        raise Exception(f"Exception in create_cohort {obj['id']}, too many tries")
-    elif tries > 1:
-        # if this isn't the first try, pause for a bit and then try again
-        sleep(randint(1,10)/2)
-    try:
-        with Session() as session:
-            new_cohort = session.query(Cohort).filter_by(id=obj['id']).one_or_none()
-            if new_cohort is None:
-                new_cohort = Cohort()
-            new_cohort.id = obj['id']
-            for drs_uri in obj['drsobjects']:
-                new_drs = session.query(DrsObject).filter_by(self_uri=drs_uri).one_or_none()
-                if new_drs is not None:
-                    new_cohort.associated_drs.append(new_drs)
-            session.add(new_cohort)
-            session.commit()
-            result = session.query(Cohort).filter_by(id=obj['id']).one_or_none()
-            if result is not None:
-                return json.loads(str(result))
-    except Exception as e:
-        logger.debug(f"Exception in create_cohort {obj['id']}: {str(e)}, trying again")
-        return create_cohort(obj, tries=tries+1)
+@retry(retry_on=sqlalchemy.exc.IntegrityError)
+def create_cohort(obj):
+    with Session() as session:
+        new_cohort = session.query(Cohort).filter_by(id=obj['id']).one_or_none()
+        if new_cohort is None:
+            new_cohort = Cohort()
+        new_cohort.id = obj['id']
+        for drs_uri in obj['drsobjects']:
+            new_drs = session.query(DrsObject).filter_by(self_uri=drs_uri).one_or_none()
+            if new_drs is not None:
+                new_cohort.associated_drs.append(new_drs)
+        session.add(new_cohort)
+        session.commit()
+        result = session.query(Cohort).filter_by(id=obj['id']).one_or_none()
+        if result is not None:
+            return json.loads(str(result))
     return None
 
 
-def delete_cohort(cohort_id, tries=1):
-    if tries > MAX_TRIES:
-        raise Exception(f"Exception in delete_cohort {cohort_id}, too many tries")
-    elif tries > 1:
-        # if this isn't the first try, pause for a bit and then try again
-        sleep(randint(1,10)/2)
-    try:
-        with Session() as session:
-            cohort_objs = session.query(Cohort).filter_by(id=cohort_id).all()
-            for cohort_obj in cohort_objs:
-                for drs_obj in cohort_obj.associated_drs:
-                    session.delete(drs_obj)
-                    session.commit()
-                session.delete(cohort_obj)
+@retry()
+def delete_cohort(cohort_id):
+    with Session() as session:
+        cohort_objs = session.query(Cohort).filter_by(id=cohort_id).all()
+        for cohort_obj in cohort_objs:
+            for drs_obj in cohort_obj.associated_drs:
+                session.delete(drs_obj)
                 session.commit()
+            session.delete(cohort_obj)
             session.commit()
-            return json.loads(str(cohort_objs))
-    except Exception as e:
-        logger.debug(f"Exception in delete_cohort {cohort_id}: {str(e)}, trying again")
-        return delete_cohort(cohort_id, tries=tries+1)
+        session.commit()
+        return json.loads(str(cohort_objs))
     return None
 
 
@@ -597,6 +875,13 @@ def list_refseqs(reference_genome="hg38"):
         return None
 
 
+def list_all_refseqs():
+    # every refseq, for all reference genomes, including the chromosome entries
+    with Session() as session:
+        result = session.query(NCBIRefSeq).order_by(NCBIRefSeq.id).all()
+        return json.loads(str(result))
+
+
 def search_refseqs(query, type):
     with Session() as session:
         if type == "transcript_name":
@@ -627,53 +912,68 @@ def get_chromosome_for_refseq(refseq=None):
         return None
 
 
-def get_variantfile(variantfile_id, tries=1):
-    if tries > MAX_TRIES:
-        raise Exception(f"Exception in get_variantfile {variantfile_id}, too many tries")
-    elif tries > 1:
-        # if this isn't the first try, pause for a bit and then try again
-        sleep(randint(1,10)/2)
-    try:
-        with Session() as session:
-            result = session.query(VariantFile).filter_by(id=variantfile_id).one_or_none()
-            if result is not None:
-                new_obj = json.loads(str(result))
-                return new_obj
-    except Exception as e:
-        logger.debug(f"Exception in get_variantfile {variantfile_id}: {str(e)}, trying again")
-        return get_variantfile(variantfile_id, tries=tries+1)
+@retry()
+def get_variantfile(variantfile_id):
+    with Session() as session:
+        result = session.query(VariantFile).options(selectinload(VariantFile.samples)).filter_by(id=variantfile_id).one_or_none()
+        if result is not None:
+            new_obj = json.loads(str(result))
+            return new_obj
     return None
 
 
-def create_variantfile(obj, tries=1):
+@retry()
+def get_variantfiles(variantfile_ids):
+    # returns {variantfile_id: variantfile} for each of variantfile_ids that exists
+    variantfile_ids = set(variantfile_ids)
+    if len(variantfile_ids) == 0:
+        return {}
+    with Session() as session:
+        result = session.query(VariantFile).options(selectinload(VariantFile.samples)).filter(VariantFile.id.in_(variantfile_ids)).all()
+        new_obj = {}
+        for varfile in json.loads(str(result)):
+            new_obj[varfile['id']] = varfile
+        return new_obj
+
+
+@retry()
+def get_dataset_version():
+    # changes whenever drs objects or variantfiles are created, indexed or deleted
+    with Session() as session:
+        result = session.query(DatasetVersion.version).filter_by(id=1).scalar()
+        if result is None:
+            return 0
+        return result
+
+
+def bump_dataset_version(session):
+    # call this in the same session as the change, before committing it
+    updated = session.query(DatasetVersion).filter_by(id=1).update({DatasetVersion.version: DatasetVersion.version + 1}, synchronize_session=False)
+    if updated == 0:
+        logger.warning("the dataset_version table has no row: cached beacon results won't be refreshed until it's added")
+
+
+@retry(retry_on=sqlalchemy.exc.IntegrityError)
+def create_variantfile(obj):
     # obj = {"id", "reference_genome"}
-    if tries > MAX_TRIES:
-        raise Exception(f"Exception in create_variantfile {obj['id']}, too many tries")
-    elif tries > 1:
-        # if this isn't the first try, pause for a bit and then try again
-        sleep(randint(1,10)/2)
-    try:
-        with Session() as session:
-            new_variantfile = session.query(VariantFile).filter_by(id=obj['id']).one_or_none()
-            if new_variantfile is None:
-                new_variantfile = VariantFile()
-                new_variantfile.indexed = 0
-                new_variantfile.chr_prefix = ''
-            new_variantfile.id = obj['id']
-            new_variantfile.reference_genome = obj['reference_genome']
-            new_drs = session.query(DrsObject).filter_by(id=obj['id']).one_or_none()
-            if new_drs is not None:
-                new_variantfile.drs_object_id = new_drs.id
-            else:
-                raise Exception(f"Cannot create variantfile {obj['id']}: no corresponding DRS object")
-            session.add(new_variantfile)
-            session.commit()
-            result = session.query(VariantFile).filter_by(id=obj['id']).one_or_none()
-            if result is not None:
-                return json.loads(str(result))
-    except Exception as e:
-        logger.debug(f"Exception in create_variantfile {obj['id']}: {str(e)}, trying again")
-        return create_variantfile(obj, tries=tries+1)
+    with Session() as session:
+        new_variantfile = session.query(VariantFile).filter_by(id=obj['id']).one_or_none()
+        if new_variantfile is None:
+            new_variantfile = VariantFile()
+            new_variantfile.indexed = 0
+            new_variantfile.chr_prefix = ''
+        new_variantfile.id = obj['id']
+        new_variantfile.reference_genome = obj['reference_genome']
+        new_drs = session.query(DrsObject).filter_by(id=obj['id']).one_or_none()
+        if new_drs is not None:
+            new_variantfile.drs_object_id = new_drs.id
+        else:
+            raise Exception(f"Cannot create variantfile {obj['id']}: no corresponding DRS object")
+        session.add(new_variantfile)
+        session.commit()
+        result = session.query(VariantFile).filter_by(id=obj['id']).one_or_none()
+        if result is not None:
+            return json.loads(str(result))
     return None
 
 
@@ -683,6 +983,7 @@ def mark_variantfile_as_indexed(variantfile_id):
         if new_variantfile is not None:
             new_variantfile.indexed = 1
             session.add(new_variantfile)
+            bump_dataset_version(session)
             session.commit()
 
 
@@ -692,6 +993,7 @@ def mark_variantfile_as_not_indexed(variantfile_id):
         if new_variantfile is not None:
             new_variantfile.indexed = 0
             session.add(new_variantfile)
+            bump_dataset_version(session)
             session.commit()
 
 
@@ -713,6 +1015,7 @@ def delete_variantfile(variantfile_id):
     with Session() as session:
         new_object = session.query(VariantFile).filter_by(id=variantfile_id).one()
         session.delete(new_object)
+        bump_dataset_version(session)
         session.commit()
         return json.loads(str(new_object))
 
@@ -793,6 +1096,14 @@ def get_headers(obj):
         return new_obj
 
 
+def get_header_stamp(variantfile_id):
+    # [number of headers, newest header id] for a variantfile: this changes whenever its headers do
+    with Session() as session:
+        q = select(sqlalchemy.func.count(header_variantfile_association.c.header_id), sqlalchemy.func.max(header_variantfile_association.c.header_id)).where(header_variantfile_association.c.variantfile_id == variantfile_id)
+        row = session.execute(q).one()
+        return [row[0], row[1]]
+
+
 def add_header_for_variantfile(obj):
     # obj = {'text' or 'texts', 'variantfile_id'}
     headertexts = []
@@ -830,12 +1141,33 @@ def get_bucket_for_position(pos):
     return int(pos/BUCKET_SIZE) * BUCKET_SIZE
 
 
+def get_inner_buckets(region):
+    # the first and last pos_bucket_ids of the buckets that are entirely inside the region:
+    # all of the variants counted in those buckets are in the region.
+    # region['start'] is interbase, like in search; either can be None if there are no such buckets.
+    first = 0
+    last = None
+    # positions start at 1, so the first bucket is inside any region that starts at the beginning
+    if 'start' in region and region['start'] > 0:
+        first = get_bucket_for_position(region['start'] + BUCKET_SIZE)
+    if 'end' in region:
+        if region['end'] + 1 < BUCKET_SIZE:
+            return None, None
+        last = get_bucket_for_position(region['end'] + 1) - BUCKET_SIZE
+        if last < first:
+            return None, None
+    return first, last
+
+
+@retry(retry_on=sqlalchemy.exc.IntegrityError)
 def create_pos_bucket(obj):
     # obj = { 'variantfile_id',
     #         'pos_bucket_ids',
     #         'bucket_counts',
     #         'normalized_contigs'
     #       }
+    if PACKED_BUCKETS:
+        return create_pos_bucket_arrays(obj)
     with Session() as session:
         pos_bucket_ids = obj['pos_bucket_ids']
         contig_ids = obj['normalized_contigs']
@@ -874,6 +1206,47 @@ def create_pos_bucket(obj):
         return None
 
 
+def create_pos_bucket_arrays(obj):
+    # obj is the same as for create_pos_bucket: this replaces all of the
+    # variantfile's PositionBucketArrays with one per contig in obj
+    with Session() as session:
+        variantfile_id = obj['variantfile_id']
+        new_variantfile = session.query(VariantFile).filter_by(id=variantfile_id).one_or_none()
+        if new_variantfile is None:
+            return None
+        pos_bucket_ids = numpy.asarray(obj['pos_bucket_ids'], dtype=numpy.int64)
+        bucket_counts = numpy.asarray(obj['bucket_counts'], dtype=numpy.int64)
+        contig_ids = numpy.asarray(obj['normalized_contigs'], dtype=object)
+        session.query(PositionBucketArray).filter_by(variantfile_id=variantfile_id).delete()
+        for contig_id in dict.fromkeys(obj['normalized_contigs']):
+            in_contig = (contig_ids == contig_id) & (bucket_counts > 0)
+            if not in_contig.any():
+                continue
+            curr_contig = session.query(Contig).filter_by(id=contig_id).one_or_none()
+            if curr_contig is None:
+                continue
+            if new_variantfile not in curr_contig.associated_variantfiles:
+                curr_contig.associated_variantfiles.append(new_variantfile)
+            # a bucket can be listed more than once if the file isn't sorted: add those together
+            ids, inverse = numpy.unique(pos_bucket_ids[in_contig], return_inverse=True)
+            counts = numpy.bincount(inverse, weights=bucket_counts[in_contig])
+            new_array = PositionBucketArray()
+            new_array.variantfile_id = variantfile_id
+            new_array.contig_id = contig_id
+            new_array.bucket_ids = pack_bucket_array(ids)
+            new_array.bucket_counts = pack_bucket_array(counts)
+            session.add(new_array)
+        session.commit()
+        return None
+
+
+def delete_pos_bucket_arrays(variantfile_id):
+    with Session() as session:
+        session.query(PositionBucketArray).filter_by(variantfile_id=variantfile_id).delete()
+        session.commit()
+        return None
+
+
 def delete_pos_bucket(pos_bucket_id, normalized_contig_id):
     with Session() as session:
         new_object = session.query(PositionBucket).filter_by(id=pos_bucket_id, contig_id=normalized_contig_id).one()
@@ -903,6 +1276,8 @@ def list_pos_buckets():
 
 def get_variant_count_for_variantfile(obj):
     # obj = {id, referenceName, start, end}
+    if PACKED_BUCKETS:
+        return get_variant_count_for_variantfile_arrays(obj)
     with Session() as session:
         vfile = aliased(VariantFile)
         q = select(vfile.drs_object_id, PositionBucket.id, PositionBucket.pos_bucket_id, PositionBucketVariantFileAssociation.bucket_count).select_from(PositionBucket).join(PositionBucketVariantFileAssociation).where(vfile.drs_object_id == PositionBucketVariantFileAssociation.variantfile_id).where(vfile.drs_object_id == obj['id'])
@@ -922,6 +1297,28 @@ def get_variant_count_for_variantfile(obj):
         return result
 
 
+def get_variant_count_for_variantfile_arrays(obj):
+    # same as get_variant_count_for_variantfile, but for packed pos_buckets
+    with Session() as session:
+        q = select(PositionBucketArray.bucket_ids, PositionBucketArray.bucket_counts).where(PositionBucketArray.variantfile_id == obj['id'])
+        if 'referenceName' in obj and obj['referenceName'] is not None:
+            contig_id = normalize_contig(obj['referenceName'])
+            q = q.where(PositionBucketArray.contig_id == contig_id)
+        q = q.order_by(PositionBucketArray.contig_id)
+        result = []
+        for row in session.execute(q):
+            ids = unpack_bucket_array(row._mapping['bucket_ids'])
+            counts = unpack_bucket_array(row._mapping['bucket_counts'])
+            in_range = numpy.ones(len(ids), dtype=bool)
+            if 'start' in obj and obj['start'] > 0:
+                in_range &= ids >= obj['start']
+            if 'end' in obj and obj['end'] != -1:
+                in_range &= ids < obj['end']
+            for pos_bucket, count in zip(ids[in_range].tolist(), counts[in_range].tolist()):
+                result.append({'pos_bucket': pos_bucket, 'count': count})
+        return result
+
+
 def normalize_contig(contig_id):
     with Session() as session:
         contig = session.query(Contig).filter_by(id=contig_id).one_or_none()
@@ -934,6 +1331,22 @@ def normalize_contig(contig_id):
             return None
 
 
+def list_normalized_contigs():
+    # {contig id or alias: normalized contig id}, for everything normalize_contig can resolve
+    with Session() as session:
+        result = {}
+        for row in session.execute(select(Alias.id, Alias.contig_id)):
+            result[row[0]] = row[1]
+        for row in session.execute(select(Contig.id)):
+            result[row[0]] = row[0]
+        return result
+
+
+def normalized_contig_ids(contig_id):
+    # the same as normalize_contig, but as a subquery that can be used in a larger query
+    return select(Contig.id).where(Contig.id == contig_id).union(select(Alias.contig_id).where(Alias.id == contig_id))
+
+
 def get_contig_prefix(contig_id):
     normalized_contig = normalize_contig(contig_id)
     suffix = normalized_contig.replace("chr", "")
@@ -948,50 +1361,128 @@ def get_contig_name_in_variantfile(obj):
     return varfile['chr_prefix'] + normalized
 
 
-def search(obj, tries=1):
-    # obj = {'region', 'headers'}
-    if tries > MAX_TRIES:
-        raise Exception(f"Exception in search, too many tries")
-    elif tries > 1:
-        # if this isn't the first try, pause for a bit and then try again
-        sleep(randint(1,10)/2)
-    try:
-        with Session() as session:
-            vfile = aliased(VariantFile)
-            q = select(vfile.drs_object_id, vfile.reference_genome, PositionBucket.id, PositionBucket.pos_bucket_id).select_from(PositionBucket).join(vfile.associated_pos_buckets).join(vfile.associated_headers)
-            if 'headers' in obj:
-                for header in obj['headers']:
-                    q = q.where(Header.text.like(f"%{header}%"))
-            if 'region' in obj:
-                if 'referenceName' in obj['region']:
-                    contig_id = normalize_contig(obj['region']['referenceName'])
-                    q = q.where(PositionBucket.contig_id == contig_id)
-                else:
-                    return {"error": "no referenceName specified"}
-                if 'start' in obj['region']:
-                    q = q.where(PositionBucket.pos_bucket_id >= get_bucket_for_position(obj['region']['start']))
-                if 'end' in obj['region']:
-                    q = q.where(PositionBucket.pos_bucket_id <= get_bucket_for_position(obj['region']['end']))
-            q = q.distinct()
-            drs_obj_ids = set()
-            pos_bucket_ids = set()
-            raw_result = {}
-            results = []
-            for row in session.execute(q):
-                drs_obj = row._mapping['drs_object_id']
-                if drs_obj not in raw_result:
-                    raw_result[drs_obj] = []
-                raw_result[drs_obj].append(row._mapping['id'])
-            for drs_obj in raw_result.keys():
-                curr_result = {'drs_object_id': drs_obj, 'variantcount': 0}
-                curr_result['reference_genome'] = session.query(VariantFile).filter_by(id=drs_obj).one_or_none().reference_genome
-                bvs = session.query(PositionBucketVariantFileAssociation).where(PositionBucketVariantFileAssociation.pos_bucket_id.in_(raw_result[drs_obj])).where(PositionBucketVariantFileAssociation.variantfile_id == drs_obj).all()
-                if bvs is not None:
-                    for bv in bvs:
-                        curr_result['variantcount'] += bv.bucket_count
-                results.append(curr_result)
-            return results
-    except Exception as e:
-        logger.debug(f"Exception in search: {str(e)}, trying again")
-        return search(obj, tries=tries+1)
-    return None
\ No newline at end of file
+@retry()
+def search(obj):
+    # obj = {'region', 'headers', 'cohorts'}
+    # returns [{'drs_object_id', 'reference_genome', 'cohort', 'variantcount', 'innercount', 'records'}]:
+    # variantcount counts the variants in all pos_buckets that overlap the region,
+    # innercount only those in pos_buckets entirely inside the region.
+    # records is whether the file's records need to be processed: if cohorts are given, only
+    # files in those cohorts need more than their counts.
+    if PACKED_BUCKETS:
+        return search_arrays(obj)
+    if 'region' in obj and 'referenceName' not in obj['region']:
+        return {"error": "no referenceName specified"}
+    with Session() as session:
+        return get_search_results(obj, session.execute(get_search_query(obj, obj.get('region'))))
+    return None
+
+
+@retry()
+def search_regions(obj):
+    # obj = {'regions', 'headers', 'cohorts'}
+    # returns a list of search results, one for each region, from a single query
+    if PACKED_BUCKETS:
+        return search_regions_arrays(obj)
+    if len(obj['regions']) == 0:
+        return []
+    if any(map(lambda x: 'referenceName' not in x, obj['regions'])):
+        return {"error": "no referenceName specified"}
+    q = sqlalchemy.union_all(*[get_search_query(obj, obj['regions'][i], i) for i in range(len(obj['regions']))])
+    with Session() as session:
+        rows = session.execute(q).all()
+    return [get_search_results(obj, filter(lambda x: x._mapping['region'] == i, rows)) for i in range(len(obj['regions']))]
+
+
+def get_search_query(obj, region, index=0):
+    # the query that search runs for the region; its rows are labelled with index, so that
+    # the queries for several regions can be combined
+    innercount = sqlalchemy.literal(0)
+    if region is not None:
+        first, last = get_inner_buckets(region)
+        if first is not None:
+            inner = PositionBucket.pos_bucket_id >= first
+            if last is not None:
+                inner = sqlalchemy.and_(inner, PositionBucket.pos_bucket_id <= last)
+            innercount = sqlalchemy.case((inner, PositionBucketVariantFileAssociation.bucket_count), else_=0)
+    q = select(sqlalchemy.literal(index).label('region'), VariantFile.drs_object_id, VariantFile.reference_genome, DrsObject.cohort_id, sqlalchemy.func.sum(PositionBucketVariantFileAssociation.bucket_count).label('variantcount'), sqlalchemy.func.sum(innercount).label('innercount')).select_from(PositionBucketVariantFileAssociation).join(VariantFile, VariantFile.id == PositionBucketVariantFileAssociation.variantfile_id).outerjoin(DrsObject, DrsObject.id == VariantFile.drs_object_id)
+    if 'headers' in obj and len(obj['headers']) > 0:
+        q = q.where(VariantFile.associated_headers.any(sqlalchemy.and_(*[Header.text.like(f"%{header}%") for header in obj['headers']])))
+    if region is not None:
+        contig_ids = normalized_contig_ids(region['referenceName'])
+        q = q.join(PositionBucket, PositionBucket.id == PositionBucketVariantFileAssociation.pos_bucket_id).where(PositionBucket.contig_id.in_(contig_ids))
+        if 'start' in region:
+            q = q.where(PositionBucket.pos_bucket_id >= get_bucket_for_position(region['start']))
+        if 'end' in region:
+            q = q.where(PositionBucket.pos_bucket_id <= get_bucket_for_position(region['end']))
+    return q.group_by(VariantFile.drs_object_id, VariantFile.reference_genome, DrsObject.cohort_id)
+
+
+def get_search_results(obj, rows):
+    results = []
+    for row in rows:
+        results.append({
+            'drs_object_id': row._mapping['drs_object_id'],
+            'reference_genome': row._mapping['reference_genome'],
+            'cohort': row._mapping['cohort_id'],
+            'variantcount': int(row._mapping['variantcount'] or 0),
+            'innercount': int(row._mapping['innercount'] or 0),
+            'records': 'cohorts' not in obj or row._mapping['cohort_id'] in obj['cohorts']
+        })
+    return results
+
+
+@retry()
+def search_arrays(obj):
+    # same as search, but for packed pos_buckets
+    if 'region' not in obj or 'referenceName' not in obj['region']:
+        return {"error": "no referenceName specified"}
+    with Session() as session:
+        return get_search_arrays_results(obj, obj['region'], session.execute(get_search_arrays_query(obj, obj['region'])))
+
+
+@retry()
+def search_regions_arrays(obj):
+    # same as search_regions, but for packed pos_buckets
+    if len(obj['regions']) == 0:
+        return []
+    if any(map(lambda x: 'referenceName' not in x, obj['regions'])):
+        return {"error": "no referenceName specified"}
+    q = sqlalchemy.union_all(*[get_search_arrays_query(obj, obj['regions'][i], i) for i in range(len(obj['regions']))])
+    with Session() as session:
+        rows = session.execute(q).all()
+    return [get_search_arrays_results(obj, obj['regions'][i], filter(lambda x: x._mapping['region'] == i, rows)) for i in range(len(obj['regions']))]
+
+
+def get_search_arrays_query(obj, region, index=0):
+    contig_ids = normalized_contig_ids(region['referenceName'])
+    q = select(sqlalchemy.literal(index).label('region'), VariantFile.drs_object_id, VariantFile.reference_genome, DrsObject.cohort_id, PositionBucketArray.bucket_ids, PositionBucketArray.bucket_counts).join(PositionBucketArray, PositionBucketArray.variantfile_id == VariantFile.id).outerjoin(DrsObject, DrsObject.id == VariantFile.drs_object_id).where(PositionBucketArray.contig_id.in_(contig_ids))
+    if 'headers' in obj and len(obj['headers']) > 0:
+        q = q.where(VariantFile.associated_headers.any(sqlalchemy.and_(*[Header.text.like(f"%{header}%") for header in obj['headers']])))
+    return q
+
+
+def get_search_arrays_results(obj, region, rows):
+    start = None
+    end = None
+    if 'start' in region:
+        start = get_bucket_for_position(region['start'])
+    if 'end' in region:
+        end = get_bucket_for_position(region['end'])
+    first, last = get_inner_buckets(region)
+    results = []
+    for row in rows:
+        variantcount = sum_bucket_array(row._mapping['bucket_ids'], row._mapping['bucket_counts'], start, end)
+        if variantcount is not None:
+            innercount = None
+            if first is not None:
+                innercount = sum_bucket_array(row._mapping['bucket_ids'], row._mapping['bucket_counts'], first, last)
+            results.append({
+                'drs_object_id': row._mapping['drs_object_id'],
+                'reference_genome': row._mapping['reference_genome'],
+                'cohort': row._mapping['cohort_id'],
+                'variantcount': variantcount,
+                'innercount': innercount or 0,
+                'records': 'cohorts' not in obj or row._mapping['cohort_id'] in obj['cohorts']
+            })
+    return results
@@ -5,12 +5,11 @@ import os
 import os.path
 import re
 import authz
+import streaming
 from markupsafe import escape
 from pysam import VariantFile, AlignmentFile
 from urllib.parse import parse_qs, urlparse, urlencode
-from config import INDEXING_PATH
-from time import sleep
-from random import randint
+from config import INDEXING_PATH, STREAM_RESPONSES
 from candigv2_logging.logging import CanDIGLogger
 
 
@@ -66,6 +65,8 @@ def get_object_for_drs_uri(drs_uri):
 
 
 def list_objects(cohort_id=None):
+    if STREAM_RESPONSES:
+        return streaming.json_response(database.iterate_drs_objects(cohort_id=cohort_id))
     return database.list_drs_objects(cohort_id=cohort_id), 200
 
 
@@ -78,21 +79,13 @@ def get_access_url(object_id, access_id, request=request):
     return _get_access_url(access_id)
 
 
-def post_object(tries=1):
+def post_object():
     cohort_id = connexion.request.json["cohort"]
     object_id = connexion.request.json['id']
     if not authz.is_cohort_authorized(request, cohort_id):
         return {"message": "User is not authorized to POST"}, 403
-    if tries > 3:
-        raise Exception(f"Exception in post_object {object_id}, too many tries")
-    elif tries > 1:
-        # if this isn't the first try, pause for a bit and then try again
-        sleep(randint(1,10)/2)
-    try:
-        new_object = database.create_drs_object(connexion.request.json)
-    except Exception as e:
-        logger.debug(f"Exception in post_object {object_id}: {str(e)}, trying again")
-        return post_object(tries=tries+1)
+    # database.create_drs_object retries transient errors itself
+    new_object = database.create_drs_object(connexion.request.json)
     return new_object, 200
 
 
@@ -106,6 +99,8 @@ def delete_object(object_id):
         try:
             new_object = database.delete_drs_object(escape(object_id))
             return new_object, 200
+        except database.DatabaseUnavailable:
+            raise
         except Exception as e:
             return {"message": str(e)}, 500
     else:
@@ -121,6 +116,8 @@ def list_cohorts():
             return list(map(lambda x: x['id'], cohorts)), 200
         authorized_cohorts = authz.get_authorized_cohorts(request)
         return list(set(map(lambda x: x['id'], cohorts)).intersection(set(authorized_cohorts))), 200
+    except database.DatabaseUnavailable:
+        raise
     except Exception as e:
         return [], 500
 
@@ -147,6 +144,8 @@ def delete_cohort(cohort_id):
     try:
         new_cohort = database.delete_cohort(cohort_id)
         return new_cohort, 200
+    except database.DatabaseUnavailable:
+        raise
     except Exception as e:
         return {"message": str(e)}, 500
 
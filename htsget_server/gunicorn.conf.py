@@ -10,3 +10,11 @@ accesslog = '-'
 access_log_format = 'INFO\t%(m)s\t%(U)s\t%(b)s\t%(M)s\t%(s)s'
 capture_output = True
 syslog = True
+
+
+def post_fork(server, worker):
+    # database connections can't be shared between processes: if the app was
+    # loaded before forking, drop the inherited pool so this worker opens its own
+    import sys
+    if "database" in sys.modules:
+        sys.modules["database"].engine.dispose(close=False)
@@ -1,6 +1,7 @@
+import json
 import os
 import tempfile
-from flask import request, send_file, Flask
+from flask import request, send_file, Flask, Response
 from urllib.parse import urlencode
 import drs_operations
 import database
@@ -10,6 +11,7 @@ from markupsafe import escape
 import connexion
 import variants
 import indexing
+import refseq
 from pathlib import Path
 from candigv2_logging.logging import CanDIGLogger
 
@@ -115,6 +117,8 @@ def index_reads(id_=None):
 def verify_reads_genomic_drs_object(id_):
     try:
         _verify_genomic_drs_object(id_)
+    except database.DatabaseUnavailable:
+        raise
     except Exception as e:
         return {"result": False, "message": str(e)}, 200
     return {"result": True}, 200
@@ -133,12 +137,20 @@ def get_variants(id_=None, reference_name=None, start=None, end=None, class_=Non
 
 
 @app.route('/variants/data/<path:id_>')
-def get_variants_data(id_, reference_name=None, format_="VCF", start=None, end=None, class_=None):
+def get_variants_data(id_, reference_name=None, format_="VCF", start=None, end=None, class_=None, cursor=None, limit=None):
     if id_ is not None:
         auth_code = authz.is_authed(escape(id_), request)
         if auth_code == 200:
-            if format_ == "VCF-JSON":
-                return variants.parse_vcf_file(id_, reference_name=reference_name, start=start, end=end)
+            if format_ in ["VCF-JSON", "VCF-NDJSON"]:
+                if cursor is not None:
+                    try:
+                        variants.decode_cursor(cursor)
+                    except ValueError as e:
+                        return {"message": str(e)}, 400
+                if format_ == "VCF-NDJSON":
+                    variants_by_file, records = variants.open_vcf_file(id_, reference_name=reference_name, start=start, end=end, cursor=cursor)
+                    return Response(_stream_ndjson(variants_by_file, records, limit), mimetype="application/x-ndjson")
+                return variants.parse_vcf_file(id_, reference_name=reference_name, start=start, end=end, cursor=cursor, limit=limit)
             return _get_data(escape(id_), reference_name, start, end, class_, format_)
     else:
         return None, 404
@@ -153,6 +165,8 @@ def verify_variants_genomic_drs_object(id_):
             _verify_genomic_drs_object(id_)
         else:
             return {"message": "User is not authorized to verify variants"}, 403
+    except database.DatabaseUnavailable:
+        raise
     except Exception as e:
         return {"result": False, "message": str(e)}, 200
     return {"result": True}, 200
@@ -181,6 +195,8 @@ def index_variants(id_=None, force=False, do_not_index=False, genome='hg38'):
                     database.mark_variantfile_as_not_indexed(id_)
                 Path(f"{INDEXING_PATH}/{cohort}~{id_}").touch()
             return None, 200
+        except database.DatabaseUnavailable:
+            raise
         except Exception as e:
             return {"message": str(e)}, 500
     else:
@@ -188,44 +204,32 @@ def index_variants(id_=None, force=False, do_not_index=False, genome='hg38'):
 
 
 @app.route('/genes')
-def list_genes(type="gene_name"):
-    genes = database.list_refseqs()
-    results = set()
-    if genes is None:
-        return {"results": []}, 200
-    for gene in genes:
-        results.add(gene[type])
-    results = list(results)
-    results.sort()
-    return {"results": results}, 200
+def list_genes(genome="hg38", type="gene_name"):
+    results, etag = refseq.refseq_index.list_names(type, genome)
+    return _etagged({"results": results}, etag)
 
 
 @app.route('/transcripts')
-def list_transcripts():
-    return list_genes(type="transcript_name")
+def list_transcripts(genome="hg38"):
+    return list_genes(genome=genome, type="transcript_name")
 
 
 @app.route('/genes/<path:id_>')
 def get_matching_genes(id_=None, type="gene_name"):
-    genes = database.search_refseqs(id_.upper(), type)
+    query = id_.upper()
+    genes = refseq.refseq_index.search(query, type, limit=5)
     results = []
-    if genes is None:
-        return {"results": results}, 200
-    count = 0
-    curr_gene = ""
+    curr_gene = None
     for gene in genes:
         if gene[type] != curr_gene:
             curr_gene = gene[type]
-            count += 1
-            if count > 5:
-                break
             res = {
                 "gene_name": gene['gene_name'],
                 "transcript_name": gene['transcript_name'],
                 "regions": []
             }
             results.append(res)
-        if database.normalize_contig(gene['contig']) is not None:
+        if gene['normalized']:
             res['regions'].append({
                 'reference_genome': gene['reference_genome'],
                 'region': {
@@ -234,7 +238,7 @@ def get_matching_genes(id_=None, type="gene_name"):
                     'end': gene['end']
                 }
             })
-    return {"results": results}, 200
+    return _etagged({"results": results}, refseq.refseq_index.etag(type, query))
 
 
 @app.route('/transcripts/<path:id_>')
@@ -242,9 +246,40 @@ def get_matching_transcripts(id_=None):
     return get_matching_genes(id_=id_, type="transcript_name")
 
 
+@app.route('/regions/genes')
+def get_genes_in_region(genome="hg38", reference_name=None, start=None, end=None):
+    if reference_name is None:
+        return {"message": "no referenceName specified"}, 400
+    if start is None:
+        start = 0
+    if end is None:
+        end = start + 1
+    if end <= start:
+        return {"message": f"end {end} is not after start {start}"}, 400
+    results = []
+    for gene in refseq.refseq_index.overlapping(genome, reference_name, start, end):
+        results.append({
+            "gene_name": gene['gene_name'],
+            "transcript_name": gene['transcript_name'],
+            "regions": [
+                {
+                    'reference_genome': gene['reference_genome'],
+                    'region': {
+                        'referenceName': gene['contig'],
+                        'start': gene['start'],
+                        'end': gene['end']
+                    }
+                }
+            ]
+        })
+    return _etagged({"results": results}, refseq.refseq_index.etag("region", genome, reference_name, str(start), str(end)))
+
+
 @app.route('/samples/<path:id_>')
 def get_sample(id_=None):
     result, status_code = _get_sample(id_)
+    if status_code != 200:
+        return result, status_code
     if authz.is_authed(id_, request):
         return result, 200
     return {"message": f"Could not find sample {id_}"}, 404
@@ -269,8 +304,15 @@ def get_cohort_samples(cohort=None):
 def _get_samples(samples):
     result = []
     samples_by_cohort = {}
+    # fetch all of the SampleDrsObjects, then all of their GenomicDrsObjects, in two batches
+    sample_drs_objs = database.get_drs_objects(samples)
+    genomic_ids = set()
+    for sample_drs_obj in sample_drs_objs.values():
+        if "contents" in sample_drs_obj:
+            genomic_ids.update(map(lambda x: x["id"], sample_drs_obj["contents"]))
+    genomic_drs_objs = database.get_drs_objects(genomic_ids)
     for sample in samples:
-        res, status_code = _get_sample(sample)
+        res, status_code = _compile_sample(sample, sample_drs_objs.get(sample), genomic_drs_objs)
         if status_code == 200:
             if res["cohort"] not in samples_by_cohort:
                 samples_by_cohort[res["cohort"]] = []
@@ -291,6 +333,21 @@ def _get_samples(samples):
 
 
 def _get_sample(id_=None):
+    sample_drs_obj = database.get_drs_object(id_)
+    genomic_drs_objs = {}
+    if sample_drs_obj is not None and "contents" in sample_drs_obj:
+        genomic_drs_objs = database.get_drs_objects(map(lambda x: x["id"], sample_drs_obj["contents"]))
+    return _compile_sample(id_, sample_drs_obj, genomic_drs_objs)
+
+
+def _compile_sample(id_, sample_drs_obj, genomic_drs_objs):
+    """
+    Describe a sample from its already-fetched SampleDrsObject.
+
+    :param id_: ID of the sample
+    :param sample_drs_obj: the SampleDrsObject for the sample, or None
+    :param genomic_drs_objs: dict of GenomicDrsObjects by id, containing the sample's contents
+    """
     result = {
         "sample_id": id_,
         "genomes": [],
@@ -299,13 +356,12 @@ def _get_sample(id_=None):
         "reads": []
     }
 
-    # Get the SampleDrsObject. It will have a contents array of GenomicContentsObjects > GenomicDrsObjects.
+    # The SampleDrsObject will have a contents array of GenomicContentsObjects > GenomicDrsObjects.
     # Each of those GenomicDrsObjects will have a description that is either 'wgs' or 'wts'.
-    sample_drs_obj = database.get_drs_object(id_)
     if sample_drs_obj is not None and "contents" in sample_drs_obj and sample_drs_obj["description"] == "sample":
         result["cohort"] = sample_drs_obj["cohort"]
         for contents_obj in sample_drs_obj["contents"]:
-            drs_obj = database.get_drs_object(contents_obj["id"])
+            drs_obj = genomic_drs_objs.get(contents_obj["id"])
             if drs_obj is not None:
                 if drs_obj["description"] == "wgs":
                     result["genomes"].append(drs_obj["id"])
@@ -318,7 +374,8 @@ def _get_sample(id_=None):
                             result["variants"].append(drs_obj["id"])
                         elif content["id"] == "read":
                             result["reads"].append(drs_obj["id"])
-            return result, 200
+        return result, 200
+    return {"message": f"Could not find sample {id_}"}, 404
 
 
 def _get_htsget_url(id, reference_name, slice_start, slice_end, file_type, data=True):
@@ -585,3 +642,27 @@ def _verify_genomic_drs_object(id_):
         if len(drs_samples) > 1:
             raise Exception(f"GenomicDrsObject {id_} lists multiple samples, but only one can be in the read file")
     return None
+
+
+def _stream_ndjson(variants_by_file, records, limit=None):
+    # the file's headers first, then a line for each variant record,
+    # then a line with the next_cursor if the limit cut the records short
+    yield json.dumps(variants_by_file) + "\n"
+    count = 0
+    last_cursor = None
+    for variant_record, next_cursor in records:
+        if limit is not None and count >= limit:
+            yield json.dumps({"next_cursor": last_cursor}) + "\n"
+            break
+        yield json.dumps(variant_record) + "\n"
+        count += 1
+        last_cursor = next_cursor
+
+
+def _etagged(result, etag):
+    # answer with a 304 if the client already has this version of the result
+    if etag is None:
+        return result, 200
+    if etag in request.headers.get("If-None-Match", ""):
+        return "", 304, {"ETag": etag}
+    return result, 200, {"ETag": etag}
@@ -11,8 +11,6 @@ import hashlib
 import re
 import datetime
 from candigv2_logging.logging import initialize, CanDIGLogger
-from time import sleep
-from random import randint
 
 
 logger = CanDIGLogger(__file__)
@@ -87,17 +85,12 @@ def index_variants(file_name=None):
     return {"message": f"Indexing complete for variantfile {drs_obj_id}"}, 200
 
 
-def write_pos_bucket(obj, object_id, tries=1):
-    if tries > 3:
-        raise Exception(f"Exception in write_pos_bucket {object_id}, too many tries")
-    elif tries > 1:
-        # if this isn't the first try, pause for a bit and then try again
-        sleep(randint(1,10)/2)
+def write_pos_bucket(obj, object_id):
+    # database.create_pos_bucket retries transient errors itself
     try:
         database.create_pos_bucket(obj)
     except Exception as e:
-        logger.debug(f"Exception in write_pos_bucket {object_id}: {str(e)}, trying again")
-        return write_pos_bucket(obj, object_id, tries=tries+1)
+        raise Exception(f"Exception in write_pos_bucket {object_id}: {str(e)}") from e
 
 
 def create_position(obj):
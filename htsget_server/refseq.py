@@ -0,0 +1,168 @@
+import hashlib
+import numpy
+import threading
+from bisect import bisect_left
+import database
+from candigv2_logging.logging import CanDIGLogger
+
+
+logger = CanDIGLogger(__file__)
+
+
+# The ncbirefseq table only changes when create_db.sh loads it, so each worker
+# loads it once and answers gene, transcript and region lookups from memory.
+class RefSeqIndex:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.loaded = False
+        self.version = None
+        # {type: sorted list of (name, reference_genome, id)}
+        self.keys = {}
+        # {type: list of names, parallel to keys[type], for bisecting}
+        self.names = {}
+        # {type: {reference_genome: sorted list of distinct names}}
+        self.name_lists = {}
+        # {type: {reference_genome: etag}}
+        self.list_etags = {}
+        # {id: refseq}
+        self.refseqs = {}
+        # {contig id or alias: normalized contig id}
+        self.contigs = {}
+        # {(reference_genome, normalized contig): accession of the chromosome}
+        self.chromosomes = {}
+        # {(reference_genome, normalized contig): {'starts', 'ends', 'max_ends', 'ids'}},
+        # arrays sorted by start; max_ends[i] is the largest end in ends[0:i+1]
+        self.intervals = {}
+
+    def load(self):
+        with self.lock:
+            if self.loaded:
+                return
+            refseqs = database.list_all_refseqs()
+            contigs = database.list_normalized_contigs()
+            if len(refseqs) == 0:
+                # the table hasn't been loaded yet: try again next time
+                return
+            self.refseqs = {}
+            self.contigs = contigs
+            self.chromosomes = {}
+            digest = hashlib.sha1()
+            for refseq in refseqs:
+                refseq['normalized'] = refseq['contig'] in contigs
+                self.refseqs[refseq['id']] = refseq
+                # chromosome entries are the ones without gene names
+                if refseq['gene_name'] == "":
+                    self.chromosomes[(refseq['reference_genome'], refseq['contig'])] = refseq['transcript_name']
+                digest.update(f"{refseq['id']}\t{refseq['reference_genome']}\t{refseq['gene_name']}\t{refseq['transcript_name']}\t{refseq['contig']}\t{refseq['start']}\t{refseq['end']}\n".encode())
+            self.version = digest.hexdigest()[0:16]
+            for type in ["gene_name", "transcript_name"]:
+                self.keys[type] = sorted((refseq[type], refseq['reference_genome'], refseq['id']) for refseq in refseqs)
+                self.names[type] = [key[0] for key in self.keys[type]]
+                self.name_lists[type] = {}
+                self.list_etags[type] = {}
+                for refseq in refseqs:
+                    # chromosome entries don't have gene names and aren't listed
+                    if refseq['gene_name'] == "":
+                        continue
+                    if refseq['reference_genome'] not in self.name_lists[type]:
+                        self.name_lists[type][refseq['reference_genome']] = set()
+                    self.name_lists[type][refseq['reference_genome']].add(refseq[type])
+                for reference_genome in self.name_lists[type]:
+                    self.name_lists[type][reference_genome] = sorted(self.name_lists[type][reference_genome])
+                    self.list_etags[type][reference_genome] = f'"{self.version}-{type}-{reference_genome}"'
+            self.intervals = {}
+            by_contig = {}
+            for refseq in refseqs:
+                # chromosome entries span the whole contig: they aren't genes
+                if refseq['gene_name'] == "" or not refseq['normalized']:
+                    continue
+                key = (refseq['reference_genome'], contigs[refseq['contig']])
+                if key not in by_contig:
+                    by_contig[key] = []
+                by_contig[key].append(refseq)
+            for key in by_contig:
+                starts = numpy.array([refseq['start'] for refseq in by_contig[key]], dtype=numpy.int64)
+                ends = numpy.array([refseq['end'] for refseq in by_contig[key]], dtype=numpy.int64)
+                ids = numpy.array([refseq['id'] for refseq in by_contig[key]], dtype=numpy.int64)
+                order = numpy.argsort(starts, kind='stable')
+                self.intervals[key] = {
+                    'starts': starts[order],
+                    'ends': ends[order],
+                    'max_ends': numpy.maximum.accumulate(ends[order]),
+                    'ids': ids[order]
+                }
+            self.loaded = True
+            logger.debug(f"loaded {len(refseqs)} refseqs, version {self.version}")
+
+    def list_names(self, type, reference_genome):
+        """
+        Returns the sorted distinct names of this type for the reference genome, and their etag.
+        """
+        self.load()
+        if reference_genome not in self.name_lists.get(type, {}):
+            return [], None
+        return self.name_lists[type][reference_genome], self.list_etags[type][reference_genome]
+
+    def search(self, query, type, limit=None):
+        """
+        Returns the refseqs whose names of this type start with query, ordered by
+        name and reference genome, for up to limit distinct names.
+        """
+        self.load()
+        if type not in self.names:
+            return []
+        names = self.names[type]
+        keys = self.keys[type]
+        results = []
+        count = 0
+        curr_name = None
+        for i in range(bisect_left(names, query), len(names)):
+            if not names[i].startswith(query):
+                break
+            if names[i] != curr_name:
+                curr_name = names[i]
+                count += 1
+                if limit is not None and count > limit:
+                    break
+            results.append(self.refseqs[keys[i][2]])
+        return results
+
+    def overlapping(self, reference_genome, contig, start, end):
+        """
+        Returns the genes in the reference genome that overlap contig:start-end, ordered by start.
+        Like the refseq positions, start is 0-based and end is exclusive.
+        """
+        self.load()
+        if contig not in self.contigs:
+            return []
+        key = (reference_genome, self.contigs[contig])
+        if key not in self.intervals:
+            return []
+        interval = self.intervals[key]
+        # genes from hi on start at or after end; genes before lo all end at or before start
+        hi = numpy.searchsorted(interval['starts'], end, side='left')
+        lo = numpy.searchsorted(interval['max_ends'], start, side='right')
+        if hi <= lo:
+            return []
+        in_range = interval['ends'][lo:hi] > start
+        return [self.refseqs[id] for id in interval['ids'][lo:hi][in_range].tolist()]
+
+    def chromosome(self, reference_genome, contig):
+        """
+        Returns the refseq accession of the chromosome for contig in the reference genome, like
+        database.get_refseq_for_chromosome, or None.
+        """
+        self.load()
+        if contig not in self.contigs:
+            return None
+        return self.chromosomes.get((reference_genome, self.contigs[contig]))
+
+    def etag(self, *args):
+        self.load()
+        if self.version is None:
+            return None
+        key = hashlib.sha1("\t".join(args).encode()).hexdigest()[0:16]
+        return f'"{self.version}-{key}"'
+
+
+refseq_index = RefSeqIndex()
@@ -1,8 +1,10 @@
-from flask import Flask
+from flask import Flask, request
 from flask_cors import CORS
 import connexion
-from config import PORT, DEBUG_MODE
+from config import PORT, DEBUG_MODE, CIRCUIT_BREAKER_RESET
 import candigv2_logging.logging
+import database
+import authz
 
 candigv2_logging.logging.initialize()
 
@@ -14,6 +16,13 @@ app.add_api('htsget_openapi.yaml', pythonic_params=True, strict_validation=True)
 app.add_api('drs_openapi.yaml', pythonic_params=True, strict_validation=True)
 app.add_api('beacon_openapi.yaml', pythonic_params=True, strict_validation=True)
 
+
+# when the database is down, tell clients to come back later instead of returning a 500
+def database_unavailable(e):
+    return {"message": str(e)}, 503, {"Retry-After": str(int(CIRCUIT_BREAKER_RESET))}
+
+app.add_error_handler(database.DatabaseUnavailable, database_unavailable)
+
 # Just leaving this here as a note: these are all of the pythonic params that
 # will get shadowed by pythonic_params:
 # ['__name__', '__doc__', '__package__', '__loader__', '__spec__', '__build_class__', '__import__', 'abs', 'all', 'any', 'ascii', 'bin', 'breakpoint', 'callable', 'chr', 'compile', 'delattr', 'dir', 'divmod', 'eval', 'exec', 'format', 'getattr', 'globals', 'hasattr', 'hash', 'hex', 'id', 'input', 'isinstance', 'issubclass', 'iter', 'len', 'locals', 'max', 'min', 'next', 'oct', 'ord', 'pow', 'print', 'repr', 'round', 'setattr', 'sorted', 'sum', 'vars', 'None', 'Ellipsis', 'NotImplemented', 'False', 'True', 'bool', 'memoryview', 'bytearray', 'bytes', 'classmethod', 'complex', 'dict', 'enumerate', 'filter', 'float', 'frozenset', 'property', 'int', 'list', 'map', 'object', 'range', 'reversed', 'set', 'slice', 'staticmethod', 'str', 'super', 'tuple', 'type', 'zip', '__debug__', 'BaseException', 'Exception', 'TypeError', 'StopAsyncIteration', 'StopIteration', 'GeneratorExit', 'SystemExit', 'KeyboardInterrupt', 'ImportError', 'ModuleNotFoundError', 'OSError', 'EnvironmentError', 'IOError', 'EOFError', 'RuntimeError', 'RecursionError', 'NotImplementedError', 'NameError', 'UnboundLocalError', 'AttributeError', 'SyntaxError', 'IndentationError', 'TabError', 'LookupError', 'IndexError', 'KeyError', 'ValueError', 'UnicodeError', 'UnicodeEncodeError', 'UnicodeDecodeError', 'UnicodeTranslateError', 'AssertionError', 'ArithmeticError', 'FloatingPointError', 'OverflowError', 'ZeroDivisionError', 'SystemError', 'ReferenceError', 'MemoryError', 'BufferError', 'Warning', 'UserWarning', 'DeprecationWarning', 'PendingDeprecationWarning', 'SyntaxWarning', 'RuntimeWarning', 'FutureWarning', 'ImportWarning', 'UnicodeWarning', 'BytesWarning', 'ResourceWarning', 'ConnectionError', 'BlockingIOError', 'BrokenPipeError', 'ChildProcessError', 'ConnectionAbortedError', 'ConnectionRefusedError', 'ConnectionResetError', 'FileExistsError', 'FileNotFoundError', 'IsADirectoryError', 'NotADirectoryError', 'InterruptedError', 'PermissionError', 'ProcessLookupError', 'TimeoutError', 'open', 'quit', 'exit', 'copyright', 'credits', 'license', 'help', '_', 'False', 'None', 'True', 'and', 'as', 'assert', 'async', 'await', 'break', 'class', 'continue', 'def', 'del', 'elif', 'else', 'except', 'finally', 'for', 'from', 'global', 'if', 'import', 'in', 'is', 'lambda', 'nonlocal', 'not', 'or', 'pass', 'raise', 'return', 'try', 'while', 'with', 'yield'] j
@@ -23,5 +32,13 @@ app.add_api('beacon_openapi.yaml', pythonic_params=True, strict_validation=True)
 def index():
     return 'INDEX'
 
+
+# connection pool stats for the worker process that answers
+@app.route('/metrics/db-pool')
+def db_pool_metrics():
+    if not authz.is_site_admin(request):
+        return {"message": "User is not authorized to see pool metrics"}, 403
+    return database.get_pool_metrics()
+
 if __name__ == '__main__':
     app.run(port = PORT)
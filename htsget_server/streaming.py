@@ -0,0 +1,88 @@
+import json
+from flask import Response, stream_with_context
+from config import JSON_ENCODER
+from candigv2_logging.logging import CanDIGLogger
+
+
+logger = CanDIGLogger(__file__)
+
+
+# the number of characters of JSON to collect before writing them to the response
+STREAM_CHUNK_SIZE = 65536
+
+
+def get_dumps(encoder):
+    # returns a function that encodes an object as a JSON string, with the named encoder
+    if encoder == "orjson":
+        try:
+            import orjson
+            return lambda obj: orjson.dumps(obj).decode()
+        except ImportError:
+            logger.warning("JsonEncoder is orjson, but orjson isn't installed: using json")
+    elif encoder != "json":
+        logger.warning(f"unknown JsonEncoder {encoder}: using json")
+    return json.dumps
+
+
+dumps = get_dumps(JSON_ENCODER)
+
+
+def json_response(obj, key=None, status=200):
+    """
+    Returns a response that streams the JSON of obj as it's encoded. If key is given, obj is a dict and
+    obj[key] is an iterable that is encoded last, one item at a time; otherwise obj is an iterable
+    that is encoded as a list.
+    """
+    if key is None:
+        chunks = iterate_json_list(obj)
+    else:
+        chunks = iterate_json_object(obj, key)
+    return Response(stream_with_context(log_errors(buffer_chunks(chunks))), status=status, mimetype="application/json")
+
+
+def log_errors(chunks):
+    # the status and headers are sent with the first chunk, so an error after that can't become an error response,
+    # and the try/except in the handlers that return json_response doesn't cover the generator: the client just
+    # gets a truncated body with the original status. Log it, then let the server abort the connection.
+    try:
+        yield from chunks
+    except Exception as e:
+        logger.error(f"streamed response failed after it started: {type(e).__name__}: {e}")
+        raise
+
+
+def iterate_json_object(obj, key):
+    # the other keys of obj are written before obj[key], so that its items can be written as they're generated
+    yield "{"
+    for k in obj:
+        if k != key:
+            yield f"{dumps(k)}: {dumps(obj[k])}, "
+    yield f"{dumps(key)}: "
+    yield from iterate_json_list(obj[key])
+    yield "}"
+
+
+def iterate_json_list(items):
+    yield "["
+    first = True
+    for item in items:
+        if not first:
+            yield ", "
+        first = False
+        yield dumps(item)
+    yield "]"
+
+
+def buffer_chunks(chunks):
+    # joins small pieces of JSON into chunks of about STREAM_CHUNK_SIZE characters
+    buffer = []
+    size = 0
+    for chunk in chunks:
+        buffer.append(chunk)
+        size += len(chunk)
+        if size >= STREAM_CHUNK_SIZE:
+            yield "".join(buffer)
+            buffer = []
+            size = 0
+    if len(buffer) > 0:
+        yield "".join(buffer)
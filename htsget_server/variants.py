@@ -1,34 +1,63 @@
+import base64
+import copy
+import itertools
+import json
 import os
 import re
+import threading
+import numpy
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from flask import copy_current_request_context, g, has_request_context
 import database
+import refseq
 import drs_operations
+from config import VCF_FETCH_THREADS, VCF_FETCH_CONCURRENCY, HEADER_CACHE_SIZE
 from candigv2_logging.logging import CanDIGLogger
 
 
 logger = CanDIGLogger(__file__)
 
 
-def find_variants_in_region(reference_name=None, start=None, end=None):
+# threads are only started as they're needed, so this is safe to create before gunicorn forks
+fetch_pool = ThreadPoolExecutor(max_workers=max(1, VCF_FETCH_THREADS), thread_name_prefix="vcf-fetch")
+
+# IUPAC nucleotide codes (https://www.bioinformatics.org/sms/iupac.html) as masks of A=1, C=2, G=4, T=8
+IUPAC_MASKS = {
+    'A': 1, 'C': 2, 'G': 4, 'T': 8,
+    'R': 1 | 4, 'Y': 2 | 8, 'S': 4 | 2, 'W': 1 | 8, 'K': 4 | 8, 'M': 1 | 2,
+    'B': 2 | 4 | 8, 'D': 1 | 4 | 8, 'H': 1 | 2 | 8, 'V': 1 | 2 | 4, 'N': 1 | 2 | 4 | 8
+}
+# the same masks, indexed by ASCII code
+IUPAC_TABLE = numpy.zeros(256, dtype=numpy.uint8)
+for code in IUPAC_MASKS:
+    IUPAC_TABLE[ord(code)] = IUPAC_MASKS[code]
+
+# {variantfile_id: (header stamp, parsed headers)}, least recently used first
+header_cache = OrderedDict()
+header_cache_lock = threading.Lock()
+
+
+def find_variants_in_region(reference_name=None, start=None, end=None, format_keys=None, info_keys=None, genotypes=False, drs_object_ids=None):
     """
-    finds variant records in vcf files, returns an array of VcfJson objects
+    finds variant records in vcf files, returns an array of VcfJson objects.
+    If format_keys or info_keys are given, only those FORMAT keys are parsed for each sample, or INFO keys for each record.
+    If genotypes is True, each record's GTs are returned as arrays in 'genotypes' (see genotype_arrays) instead of in 'samples'.
+    If drs_object_ids is given, only those files are searched, e.g. the ones that count_variants_in_region found records for.
     """
 
-    region = {'referenceName': database.normalize_contig(reference_name)}
-    if start is not None:
-        region['start'] = int(start) - 1 # search for bases starting at the interbase half-a-base back
-    if end is not None:
-        region['end'] = int(end)
-    raw_result = database.search({
-        "region": region
-    })
-    # raw_result = [{'drs_object_id', 'variantcount', 'reference_genome'}]
-    # fetch all relevant results:
-    #   group results by variant (chr:start-end)
-    #   for boolean/count results, we can just count keys
-    #   resultsets require more processing
-    variants_by_file = {}
-    for result in raw_result:
-        variants_by_file[result['drs_object_id']] = parse_vcf_file(result['drs_object_id'], reference_name=region['referenceName'], start=region['start'], end=region['end'])
+    region = get_search_region(reference_name, start, end)
+    if drs_object_ids is None:
+        raw_result = database.search({
+            "region": region
+        })
+        # raw_result = [{'drs_object_id', 'variantcount', 'innercount', 'reference_genome'}]
+        # fetch all relevant results:
+        #   group results by variant (chr:start-end)
+        #   for boolean/count results, we can just count keys
+        #   resultsets require more processing
+        drs_object_ids = list(map(lambda x: x['drs_object_id'], raw_result))
+    variants_by_file = parse_vcf_files(drs_object_ids, reference_name=region['referenceName'], start=region['start'], end=region['end'], format_keys=format_keys, info_keys=info_keys, genotypes=genotypes)
 
     # if a file has no variants in it, we don't need to return it:
     final_variants_by_file = {}
@@ -38,75 +67,448 @@ def find_variants_in_region(reference_name=None, start=None, end=None):
     return final_variants_by_file
 
 
-def parse_vcf_file(drs_object_id, reference_name=None, start=None, end=None):
+def open_variants_in_region(reference_name=None, start=None, end=None, format_keys=None, info_keys=None, genotypes=False, drs_object_ids=None):
+    """
+    Like find_variants_in_region, but returns {drs_object_id: generator of VcfJson variant records}, so that the
+    records are only parsed as they're read. Only the files with any variant records in the region are returned.
+    """
+    region = get_search_region(reference_name, start, end)
+    if drs_object_ids is None:
+        raw_result = database.search({
+            "region": region
+        })
+        drs_object_ids = list(map(lambda x: x['drs_object_id'], raw_result))
+    records_by_file = {}
+    for drs_object_id in drs_object_ids:
+        variants_by_file, records = open_vcf_file(drs_object_id, reference_name=region['referenceName'], start=region['start'], end=region['end'], format_keys=format_keys, info_keys=info_keys, genotypes=genotypes)
+        records = map(lambda x: x[0], records)
+        # read the first record to see if there are any
+        first = next(records, None)
+        if first is not None:
+            records_by_file[drs_object_id] = itertools.chain([first], records)
+    return records_by_file
+
+
+def count_variants_in_region(reference_name=None, start=None, end=None, cohorts=None):
+    """
+    counts the indexed variant records in the region for each vcf file, without opening any files.
+    Returns [{'drs_object_id', 'reference_genome', 'cohort', 'variantcount', 'innercount', 'records'}], as database.search does:
+    if cohorts is given, only the files in those cohorts are marked as needing their records.
+    """
+    query = {
+        "region": get_search_region(reference_name, start, end)
+    }
+    if cohorts is not None:
+        query['cohorts'] = cohorts
+    return database.search(query)
+
+
+def count_variants_in_regions(regions, cohorts=None):
+    """
+    count_variants_in_region for each of a list of {'reference_name', 'start', 'end'} regions, in a single database search.
+    """
+    query = {
+        "regions": [get_search_region(region['reference_name'], region.get('start'), region.get('end')) for region in regions]
+    }
+    if cohorts is not None:
+        query['cohorts'] = cohorts
+    return database.search_regions(query)
+
+
+def has_variants_in_region(drs_object_id, reference_name=None, start=None, end=None):
+    """
+    Returns whether the file has any variant records in the region, without parsing them.
+    """
+    region = get_search_region(reference_name, start, end)
     gen_obj = drs_operations._get_genomic_obj(drs_object_id)
     if "message" in gen_obj:
-        raise Exception(f"error parsing vcf file for {drs_object_id}: {gen_obj['message']}")
+        raise Exception(f"error opening vcf file for {drs_object_id}: {gen_obj['message']}")
+    ref_name = database.get_contig_name_in_variantfile({'refname': region['referenceName'], 'variantfile_id': drs_object_id})
+    for record in gen_obj['file'].fetch(contig=ref_name, start=region.get('start'), end=region.get('end')):
+        return True
+    return False
+
+
+def get_search_region(reference_name=None, start=None, end=None):
+    region = {'referenceName': database.normalize_contig(reference_name)}
+    if start is not None:
+        region['start'] = int(start) - 1 # search for bases starting at the interbase half-a-base back
+    if end is not None:
+        region['end'] = int(end)
+    return region
+
+
+def parse_vcf_files(drs_object_ids, reference_name=None, start=None, end=None, format_keys=None, info_keys=None, genotypes=False):
+    """
+    runs parse_vcf_file for each drs_object_id on the fetch pool. Returns {drs_object_id: result}, in the same order as drs_object_ids.
+    """
+    results = run_on_fetch_pool(parse_vcf_file, drs_object_ids, reference_name=reference_name, start=start, end=end, format_keys=format_keys, info_keys=info_keys, genotypes=genotypes)
+    variants_by_file = {}
+    for i in range(len(drs_object_ids)):
+        variants_by_file[drs_object_ids[i]] = results[i]
+    return variants_by_file
+
+
+def run_on_fetch_pool(func, drs_object_ids, *args, **kwargs):
+    """
+    runs func(drs_object_id, *args, **kwargs) for each drs_object_id on the fetch pool, keeping at most
+    VCF_FETCH_CONCURRENCY files in flight. Each call runs in a copy of the current request's context, if there is one.
+    Returns the results in the same order as drs_object_ids.
+    """
+    results = [None] * len(drs_object_ids)
+    if VCF_FETCH_THREADS <= 1 or len(drs_object_ids) <= 1:
+        for i in range(len(drs_object_ids)):
+            results[i] = func(drs_object_ids[i], *args, **kwargs)
+    else:
+        in_flight = {}
+        next_index = 0
+        try:
+            while next_index < len(drs_object_ids) or len(in_flight) > 0:
+                while next_index < len(drs_object_ids) and len(in_flight) < VCF_FETCH_CONCURRENCY:
+                    future = fetch_pool.submit(in_request_context(func), drs_object_ids[next_index], *args, **kwargs)
+                    in_flight[future] = next_index
+                    next_index += 1
+                done, not_done = wait(in_flight.keys(), return_when=FIRST_COMPLETED)
+                for future in done:
+                    # if a file can't be parsed, raise its exception, like the sequential path would
+                    results[in_flight.pop(future)] = future.result()
+        finally:
+            for future in in_flight.keys():
+                future.cancel()
+    return results
+
+
+def in_request_context(func):
+    """
+    returns func wrapped to run on a fetch thread with a copy of the current request's context and g, so that its
+    authz lookups see the request and its database retries share the request's deadline.
+    """
+    if not has_request_context():
+        return func
+    database.get_retry_deadline()
+    request_g = {name: g.get(name) for name in g}
+
+    @copy_current_request_context
+    def run_in_request_context(*args, **kwargs):
+        for name in request_g:
+            setattr(g, name, request_g[name])
+        return func(*args, **kwargs)
+    return run_in_request_context
+
+
+def find_variants_in_regions(regions, format_keys=None, info_keys=None, genotypes=False):
+    """
+    Like find_variants_in_region, for several regions at once. regions is a list of {'reference_name', 'start', 'end', 'drs_object_ids'},
+    with the files to search in each region, and the result is a list of {drs_object_id: VcfJson object}, one for each region.
+    Each file is only opened once, and overlapping regions are read in a single pass, so records are only parsed once.
+    """
+    # {drs_object_id: [(index of region, search region)]}
+    regions_by_file = {}
+    for i in range(len(regions)):
+        search_region = get_search_region(regions[i]['reference_name'], regions[i].get('start'), regions[i].get('end'))
+        for drs_object_id in regions[i]['drs_object_ids']:
+            if drs_object_id not in regions_by_file:
+                regions_by_file[drs_object_id] = []
+            regions_by_file[drs_object_id].append((i, search_region))
+    drs_object_ids = list(regions_by_file.keys())
+    results = run_on_fetch_pool(parse_vcf_file_regions, drs_object_ids, regions_by_file, format_keys=format_keys, info_keys=info_keys, genotypes=genotypes)
+    results_by_file = dict(zip(drs_object_ids, results))
+    variants_by_region = []
+    for i in range(len(regions)):
+        variants_by_region.append({})
+        for drs_object_id in regions[i]['drs_object_ids']:
+            # if a file has no variants in the region, we don't need to return it
+            if len(results_by_file[drs_object_id][i]['variants']) > 0:
+                variants_by_region[i][drs_object_id] = results_by_file[drs_object_id][i]
+    return variants_by_region
+
+
+def parse_vcf_file_regions(drs_object_id, regions_by_file, format_keys=None, info_keys=None, genotypes=False):
+    # returns {index of region: VcfJson object} for the file's regions in regions_by_file
+    variants_by_file, file, samples, info_parser = get_vcf_reader(drs_object_id)
+    results = {}
+    # {contig: [(start, end, index of region)]}
+    by_contig = {}
+    for i, region in regions_by_file[drs_object_id]:
+        results[i] = dict(variants_by_file)
+        results[i]['variants'] = []
+        if region['referenceName'] not in by_contig:
+            by_contig[region['referenceName']] = []
+        by_contig[region['referenceName']].append((region.get('start', 0), region.get('end', float('inf')), i))
+    for contig in by_contig.keys():
+        ref_name = database.get_contig_name_in_variantfile({'refname': contig, 'variantfile_id': drs_object_id})
+        for span_start, span_end, span_regions in merge_regions(by_contig[contig]):
+            for record in file.fetch(contig=ref_name, start=span_start, end=None if span_end == float('inf') else span_end):
+                variant = None
+                for start, end, i in span_regions:
+                    # the same test that fetch uses for a region
+                    if record.start < end and record.stop > start:
+                        if variant is None:
+                            variant = parse_variant_record(record, samples, info_parser, format_keys=format_keys, info_keys=info_keys, genotypes=genotypes)
+                            results[i]['variants'].append(variant)
+                        else:
+                            results[i]['variants'].append(copy_variant_record(variant))
+    return results
+
+
+def merge_regions(regions):
+    # merges overlapping (start, end, index) regions into [(start, end, [regions])], ordered by start
+    spans = []
+    for region in sorted(regions):
+        if len(spans) > 0 and region[0] <= spans[-1][1]:
+            spans[-1] = (spans[-1][0], max(spans[-1][1], region[1]), spans[-1][2] + [region])
+        else:
+            spans.append((region[0], region[1], [region]))
+    return spans
+
+
+def copy_variant_record(variant):
+    # a copy of a variant record that can be changed separately; its genotype arrays are shared
+    return {k: v if k == 'genotypes' else copy.deepcopy(v) for k, v in variant.items()}
+
+
+def parse_vcf_file(drs_object_id, reference_name=None, start=None, end=None, format_keys=None, info_keys=None, cursor=None, limit=None, genotypes=False):
+    """
+    Returns a VcfJson object for the file's variants in the region. If limit is given, at most limit
+    variants are returned, and if there are more, next_cursor is the cursor to get the rest.
+    """
+    variants_by_file, records = open_vcf_file(drs_object_id, reference_name=reference_name, start=start, end=end, format_keys=format_keys, info_keys=info_keys, cursor=cursor, genotypes=genotypes)
+    variants_by_file['variants'] = []
+    last_cursor = None
+    for variant_record, next_cursor in records:
+        if limit is not None and len(variants_by_file['variants']) >= limit:
+            variants_by_file['next_cursor'] = last_cursor
+            break
+        variants_by_file['variants'].append(variant_record)
+        last_cursor = next_cursor
+    return variants_by_file
+
+
+def open_vcf_file(drs_object_id, reference_name=None, start=None, end=None, format_keys=None, info_keys=None, cursor=None, genotypes=False):
+    """
+    Returns a VcfJson object for the file without its variants, and a generator of its variant records in
+    the region, each with the cursor that resumes after it. If cursor is given, the records start after it.
+    The database and file lookups happen here, so the generator can run outside of the request.
+    """
+    variants_by_file, file, samples, info_parser = get_vcf_reader(drs_object_id)
+    after = None
+    if cursor is not None:
+        after = decode_cursor(cursor)
     if reference_name is not None:
         ref_name = database.get_contig_name_in_variantfile({'refname': reference_name, 'variantfile_id': drs_object_id})
-        records = gen_obj['file'].fetch(contig=ref_name, start=start, end=end)
+        if after is not None and after[0] == ref_name:
+            records = file.fetch(contig=ref_name, start=max(start or 0, after[1] - 1), end=end)
+        else:
+            records = file.fetch(contig=ref_name, start=start, end=end)
+    elif after is not None:
+        records = fetch_from(file, after[0], after[1] - 1)
     else:
-        records = gen_obj['file'].fetch()
-    headers = parse_headers(database.get_headers({'variantfile_id': drs_object_id}))
+        records = file.fetch()
+    return variants_by_file, iterate_vcf_records(records, samples, info_parser, format_keys=format_keys, info_keys=info_keys, after=after, genotypes=genotypes)
+
+
+def get_vcf_reader(drs_object_id):
+    """
+    Opens the file: returns a VcfJson object for it without its variants, the pysam VariantFile,
+    the names of its samples, in order, and the InfoParser for its INFO headers.
+    """
+    gen_obj = drs_operations._get_genomic_obj(drs_object_id)
+    if "message" in gen_obj:
+        raise Exception(f"error parsing vcf file for {drs_object_id}: {gen_obj['message']}")
+    file = gen_obj['file']
+    parsed_headers = get_parsed_headers(drs_object_id)
 
     variants_by_file = {
         "id": drs_object_id,
-        "headers": headers,
-        "variants": []
+        "headers": dict(parsed_headers['headers'])
     }
+    for k in ['fileformat', 'assembly', 'info', 'filter', 'format', 'alt', 'contig']:
+        if k in parsed_headers:
+            variants_by_file[k] = parsed_headers[k]
+    # the samples are in the same order in every record
+    samples = []
+    for s in file.header.samples:
+        if "samples" in gen_obj and s in gen_obj['samples']:
+            samples.append(gen_obj['samples'][s])
+        else:
+            samples.append(s)
+    return variants_by_file, file, samples, parsed_headers['info_parser']
+
+
+def iterate_vcf_records(records, samples, info_parser, format_keys=None, info_keys=None, after=None, genotypes=False):
+    # after = [contig, pos, number of records at pos that were already returned]
+    contig = None
+    pos = None
+    count = 0
+    for r in records:
+        if r.contig == contig and r.pos == pos:
+            count += 1
+        else:
+            contig = r.contig
+            pos = r.pos
+            count = 1
+        if after is not None and contig == after[0]:
+            # skip the records that were returned before the cursor
+            if pos < after[1] or (pos == after[1] and count <= after[2]):
+                continue
+        yield parse_variant_record(r, samples, info_parser, format_keys=format_keys, info_keys=info_keys, genotypes=genotypes), encode_cursor(contig, pos, count)
+
+
+def fetch_from(file, contig, start):
+    # fetch the records in the file from contig:start on, through the rest of the file's contigs
+    contigs = list(file.header.contigs)
+    if contig not in contigs:
+        raise ValueError(f"invalid cursor: {contig} is not in the file")
+    for c in contigs[contigs.index(contig):]:
+        try:
+            if c == contig:
+                records = file.fetch(contig=c, start=start)
+            else:
+                records = file.fetch(contig=c)
+        except ValueError:
+            # this contig has no records in the index
+            continue
+        for r in records:
+            yield r
+
+
+def encode_cursor(contig, pos, count):
+    return base64.urlsafe_b64encode(json.dumps([contig, pos, count]).encode()).decode()
+
+
+def decode_cursor(cursor):
+    # returns [contig, pos, number of records at pos that were already returned]
+    try:
+        after = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        if len(after) == 3 and isinstance(after[0], str) and isinstance(after[1], int) and isinstance(after[2], int):
+            return after
+    except Exception:
+        pass
+    raise ValueError(f"invalid cursor: {cursor}")
+
+
+def get_parsed_headers(drs_object_id):
+    """
+    Returns the variantfile's parsed headers, with the fileformat, assembly, INFO, FILTER, FORMAT, ALT
+    and contig headers split out, and an InfoParser for its INFO headers. These are cached until the
+    variantfile's headers change, e.g. when it is re-indexed. Don't modify the results.
+    """
+    stamp = database.get_header_stamp(drs_object_id)
+    with header_cache_lock:
+        if drs_object_id in header_cache and header_cache[drs_object_id][0] == stamp:
+            header_cache.move_to_end(drs_object_id)
+            return header_cache[drs_object_id][1]
+    headers = parse_headers(database.get_headers({'variantfile_id': drs_object_id}))
+    parsed_headers = {}
     if 'fileformat' in headers:
-        variants_by_file['fileformat'] = headers.pop('fileformat').pop()
+        parsed_headers['fileformat'] = headers.pop('fileformat').pop()
     if 'assembly' in headers:
-        variants_by_file['assembly'] = headers.pop('assembly').pop()
+        parsed_headers['assembly'] = headers.pop('assembly').pop()
     if 'INFO' in headers:
-        variants_by_file['info'] = headers.pop('INFO')
+        parsed_headers['info'] = headers.pop('INFO')
     if 'FILTER' in headers:
-        variants_by_file['filter'] = headers.pop('FILTER')
+        parsed_headers['filter'] = headers.pop('FILTER')
     if 'FORMAT' in headers:
-        variants_by_file['format'] = headers.pop('FORMAT')
+        parsed_headers['format'] = headers.pop('FORMAT')
     if 'ALT' in headers:
-        variants_by_file['alt'] = headers.pop('ALT')
+        parsed_headers['alt'] = headers.pop('ALT')
     if 'contig' in headers:
-        variants_by_file['contig'] = headers.pop('contig')
-    for r in records:
-        samples = []
-        for s in r.samples:
-            if "samples" in gen_obj and s in gen_obj['samples']:
-                samples.append(gen_obj['samples'][s])
-            else:
-                samples.append(s)
-        variant_record = parse_variant_record(str(r), samples, variants_by_file['info'])
-        variants_by_file['variants'].append(variant_record)
-    return variants_by_file
+        parsed_headers['contig'] = headers.pop('contig')
+    parsed_headers['headers'] = headers
+    parsed_headers['info_parser'] = InfoParser(parsed_headers.get('info', []))
+    with header_cache_lock:
+        header_cache[drs_object_id] = (stamp, parsed_headers)
+        header_cache.move_to_end(drs_object_id)
+        while len(header_cache) > HEADER_CACHE_SIZE:
+            header_cache.popitem(last=False)
+    return parsed_headers
+
+
+def parse_variant_record(record, samples, info_parser, format_keys=None, info_keys=None, genotypes=False):
+    """
+    Converts a pysam VariantRecord into a VcfJson variant record, with values written as they would be in the VCF text.
+    samples are the names to give the record's samples, in order. If format_keys or info_keys are given, only those FORMAT and INFO keys are included.
+    If genotypes is True, GT is left out of the samples and returned as arrays in 'genotypes' instead.
+    """
+    variant = {
+        'chrom': record.chrom,
+        'pos': str(record.pos),
+        'id': format_vcf_value(record.id),
+        'ref': record.ref,
+        'alt': ['.'],
+        'qual': format_vcf_value(record.qual),
+        'filter': ';'.join(record.filter.keys()) or '.',
+        'info': {},
+        'samples': {}
+    }
+    if record.alts is not None:
+        variant['alt'] = list(record.alts)
+    keys = list(record.format.keys())
+    if format_keys is not None:
+        keys = [k for k in keys if k in format_keys]
+    if genotypes and 'GT' in keys:
+        keys.remove('GT')
+        variant['genotypes'] = genotype_arrays(record, samples)
+    if len(keys) > 0:
+        for s, sample in zip(samples, record.samples.values()):
+            variant['samples'][s] = {}
+            for k in keys:
+                if k == 'GT':
+                    separator = '|' if sample.phased else '/'
+                    variant['samples'][s][k] = separator.join(map(format_vcf_value, sample['GT']))
+                else:
+                    variant['samples'][s][k] = format_vcf_value(sample[k])
+    # pysam keeps END out of info: it's only visible as a record length that differs from the ref's
+    end = None
+    if record.rlen != len(record.ref):
+        end = record.stop
+    variant['info'] = info_parser.parse(record.info, end=end, info_keys=info_keys)
+    return variant
 
 
-def parse_variant_record(record, samples, info_headers_obj):
-    # chr21\t5030551\t.\tA\tC\t.\tPASS\tDP=100;SOMATIC;SS=2;SSC=3;GPV=1;SPV=0.5\tGT:GQ:DP:RD:AD:FREQ:DP4\t0/0:.:55:55:0:0%:25,14,0,0\t0/1:.:90:90:2:2.27%:48,38,1,1\n
-    # CHROM POS ID REF ALT QUAL FILTER INFO
-    vcf_parse = re.match(r'(.+?)\t(.+?)\t(.+?)\t(.+?)\t(.+?)\t(.+?)\t(.+?)\t(.+?)\t(.+)', record)
-    if vcf_parse is not None:
-        variant = {
-            'chrom': vcf_parse.group(1),
-            'pos': vcf_parse.group(2),
-            'id': vcf_parse.group(3),
-            'ref': vcf_parse.group(4),
-            'alt': vcf_parse.group(5).split(','),
-            'qual': vcf_parse.group(6),
-            'filter': vcf_parse.group(7),
-            'info': vcf_parse.group(8),
-            'samples': {}
-        }
-        if vcf_parse.group(9) is not None and vcf_parse.group(9) != "":
-            sample_parse = vcf_parse.group(9).split("\t")
-            format = sample_parse.pop(0).split(":")
-            for s in samples:
-                variant['samples'][s] = {}
-                sample_parts = sample_parse.pop(0).split(":")
-                for f in format:
-                    variant['samples'][s][f] = sample_parts.pop(0)
-        variant['info'] = process_info_fields(variant['info'], info_headers_obj)
-        return variant
-    return None
+def genotype_arrays(record, samples):
+    """
+    Returns the record's GTs as arrays, one row per sample:
+    {
+        'samples': the sample names,
+        'alleles': int array of allele indices, padded with -2 for samples of lower ploidy, with -1 for missing alleles,
+        'phased': bool array
+    }
+    """
+    sample_records = list(record.samples.values())
+    gts = [sample['GT'] for sample in sample_records]
+    phased = numpy.array([sample.phased for sample in sample_records], dtype=bool)
+    ploidy = max(map(len, gts), default=0)
+    if any(len(gt) != ploidy for gt in gts):
+        gts = [gt + (-2,) * (ploidy - len(gt)) for gt in gts]
+    # None becomes nan in a float array
+    alleles = numpy.array(gts, dtype=float).reshape(len(gts), ploidy)
+    alleles[numpy.isnan(alleles)] = -1
+    return {
+        'samples': samples,
+        'alleles': alleles.astype(numpy.int32),
+        'phased': phased
+    }
+
+
+def format_genotype(alleles, phased):
+    # write a row of a genotype_arrays alleles array as a VCF GT value
+    separator = '|' if phased else '/'
+    return separator.join('.' if a == -1 else str(a) for a in alleles if a != -2)
+
+
+def format_vcf_value(value):
+    # write a value read by pysam the way it would appear in a VCF
+    if type(value) is str:
+        return value
+    if value is None:
+        return '.'
+    if type(value) is tuple:
+        return ','.join(map(format_vcf_value, value))
+    if type(value) is float:
+        # htslib writes floats with %g
+        return f"{value:g}"
+    return str(value)
 
 
 def parse_headers(headers):
@@ -141,108 +543,133 @@ def parse_header(text):
     if metadata_parse is not None:
         if metadata_parse.group(1) is not None:
             new_meta['structured'] = True
-            fields = metadata_parse.group(2).split(",", 1)
-            while len(fields) > 0:
-                curr_field = fields.pop(0)
-                if "=" in curr_field:
-                    [k,v] = curr_field.split("=", 1)
-                    if v.startswith('"'):
-                        # we're inside a quoted value, so any commas in here are still part of the same value
-                        fields.insert(0, v)
-                        curr_value = ','.join(fields)
-                        curr_value = curr_value[1:] # get rid of opening quote
-                        # continue eating through until we get to an unescaped quote
-                        new_value = curr_value[0]
-                        curr_value = curr_value[1:]
-                        while len(curr_value) > 0:
-                            if curr_value.startswith('"'):
-                                if not new_value.endswith('\\'): # this wasn't an escaped quote
-                                    curr_value = curr_value[2:] # 2 because of the next comma
-                                    break
-                                # it was an escaped quote, so keep going...
-                            new_value += curr_value[0]
-                            curr_value = curr_value[1:]
-                        new_meta[k] = new_value
-                        fields = [curr_value]
-                        continue
-                    else:
-                        new_meta[k] = v
-                if len(fields) > 0:
-                    fields = fields.pop().split(",", 1)
+            # scan the fields left to right, so long quoted values are only read once
+            fields = metadata_parse.group(2)
+            i = 0
+            while i < len(fields):
+                next_comma = fields.find(",", i)
+                if next_comma == -1:
+                    next_comma = len(fields)
+                equals = fields.find("=", i, next_comma)
+                if equals == -1:
+                    # not a key=value field
+                    i = next_comma + 1
+                    continue
+                k = fields[i:equals]
+                if fields.startswith('"', equals + 1):
+                    # we're inside a quoted value, so any commas in here are still part of the same value:
+                    # it ends at the next unescaped quote
+                    end_quote = fields.find('"', equals + 2)
+                    while end_quote != -1 and fields[end_quote - 1] == '\\' and end_quote > equals + 2:
+                        end_quote = fields.find('"', end_quote + 1)
+                    if end_quote == -1:
+                        end_quote = len(fields)
+                    new_meta[k] = fields[equals + 2:end_quote]
+                    i = end_quote + 2 # 2 because of the next comma
+                else:
+                    new_meta[k] = fields[equals + 1:next_comma]
+                    i = next_comma + 1
         else:
             new_meta['structured'] = False
             new_meta['value'] = text
     return new_meta
 
 
-def process_info_fields(text, info_headers_obj):
-    info_headers = {}
-    for h in info_headers_obj:
-        info_headers[h['id']] = h
-    # reserved info headers (from VCF spec):
-    reserved = [
-        ["AA", "1", "String", "Ancestral allele"],
-        ["AC", "A", "Integer", "Allele count in genotypes, for each ALT allele, in the same order as listed"],
-        ["AD", "R", "Integer", "Total read depth for each allele"],
-        ["ADF", "R", "Integer", "Read depth for each allele on the forward strand"],
-        ["ADR", "R", "Integer", "Read depth for each allele on the reverse strand"],
-        ["AF", "A", "Float", "Allele frequency for each ALT allele in the same order as listed (estimated from primary data, not called genotypes)"],
-        ["AN", "1", "Integer", "Total number of alleles in called genotypes"],
-        ["BQ", "1", "Float", "RMS base quality"],
-        ["CIGAR", "A", "String", "Cigar string describing how to align an alternate allele to the reference allele"],
-        ["DB", "0", "Flag", "dbSNP membership"],
-        ["DP", "1", "Integer", "Combined depth across samples"],
-        ["END", "1", "Integer", "End position on CHROM (used with symbolic alleles; see below)"],
-        ["H2", "0", "Flag", "HapMap2 membership"],
-        ["H3", "0", "Flag", "HapMap3 membership"],
-        ["MQ", "1", "Float", "RMS mapping quality"],
-        ["MQ0", "1", "Integer", "Number of MAPQ == 0 reads"],
-        ["NS", "1", "Integer", "Number of samples with data"],
-        ["SB", "4", "Integer", "Strand bias"],
-        ["SOMATIC", "0", "Flag", "Somatic mutation (for cancer genomics)"],
-        ["VALIDATED", "0", "Flag", "Validated by follow-up experiment"],
-        ["1000G", "0", "Flag", "1000 Genomes membership"]
-    ]
-    for r in reserved:
-        info_headers[r[0]] = {
-            "number": r[1],
-            "type": r[2],
-            "description": r[3]
-        }
-    info_pieces = text.split(';')
-    info_obj = {}
-    for info in info_pieces:
-        kv = info.split('=', 2)
-        if kv[0] in info_headers:
-            info_obj[kv[0]] = {
-                'type': info_headers[kv[0]]['type'],
-                'number': info_headers[kv[0]]['number'],
-                'description': info_headers[kv[0]]['description'],
+# reserved info headers (from VCF spec):
+RESERVED_INFO_HEADERS = {}
+for r in [
+    ["AA", "1", "String", "Ancestral allele"],
+    ["AC", "A", "Integer", "Allele count in genotypes, for each ALT allele, in the same order as listed"],
+    ["AD", "R", "Integer", "Total read depth for each allele"],
+    ["ADF", "R", "Integer", "Read depth for each allele on the forward strand"],
+    ["ADR", "R", "Integer", "Read depth for each allele on the reverse strand"],
+    ["AF", "A", "Float", "Allele frequency for each ALT allele in the same order as listed (estimated from primary data, not called genotypes)"],
+    ["AN", "1", "Integer", "Total number of alleles in called genotypes"],
+    ["BQ", "1", "Float", "RMS base quality"],
+    ["CIGAR", "A", "String", "Cigar string describing how to align an alternate allele to the reference allele"],
+    ["DB", "0", "Flag", "dbSNP membership"],
+    ["DP", "1", "Integer", "Combined depth across samples"],
+    ["END", "1", "Integer", "End position on CHROM (used with symbolic alleles; see below)"],
+    ["H2", "0", "Flag", "HapMap2 membership"],
+    ["H3", "0", "Flag", "HapMap3 membership"],
+    ["MQ", "1", "Float", "RMS mapping quality"],
+    ["MQ0", "1", "Integer", "Number of MAPQ == 0 reads"],
+    ["NS", "1", "Integer", "Number of samples with data"],
+    ["SB", "4", "Integer", "Strand bias"],
+    ["SOMATIC", "0", "Flag", "Somatic mutation (for cancer genomics)"],
+    ["VALIDATED", "0", "Flag", "Validated by follow-up experiment"],
+    ["1000G", "0", "Flag", "1000 Genomes membership"]
+]:
+    RESERVED_INFO_HEADERS[r[0]] = {
+        "number": r[1],
+        "type": r[2],
+        "description": r[3]
+    }
+
+
+class InfoParser:
+    """
+    A file's INFO schema, compiled once from its INFO headers: the headers by id (with the
+    reserved headers from the VCF spec taking precedence) and the field layout of any VEP CSQ annotations.
+    """
+    def __init__(self, info_headers_obj):
+        self.info_headers = {}
+        for h in info_headers_obj:
+            self.info_headers[h['id']] = h
+        self.info_headers.update(RESERVED_INFO_HEADERS)
+        # find a CSQ header, as a special case:
+        self.csq_parts = None
+        if 'CSQ' in self.info_headers:
+            csq_match = re.match(r".+Format: (.+)", self.info_headers['CSQ']['description'])
+            if csq_match is not None:
+                self.csq_parts = csq_match.group(1).split('|')
+
+    def parse(self, info, end=None, info_keys=None):
+        """
+        Turns a pysam VariantRecordInfo into a VcfJson info object. end is the record's END, if it has one.
+        If info_keys is given, only those keys are included.
+        """
+        if info_keys is None:
+            info_items = list(info.items())
+            if end is not None:
+                info_items.append(('END', end))
+        else:
+            info_items = [(key, info[key]) for key in info_keys if key in info]
+            if end is not None and 'END' in info_keys:
+                info_items.append(('END', end))
+        info_headers = self.info_headers
+        info_obj = {}
+        for key, value in info_items:
+            if key not in info_headers:
+                continue
+            header = info_headers[key]
+            info_obj[key] = {
+                'type': header['type'],
+                'number': header['number'],
+                'description': header['description'],
                 'value': None
             }
-            if len(kv) > 1:
-                vals = kv[1].split(',')
-                if info_obj[kv[0]]['number'] == '1':
-                    info_obj[kv[0]]['value'] = [kv[1]]
-                else:
-                    info_obj[kv[0]]['value'] = vals
+            # flags don't have values
+            if type(value) is bool:
+                continue
+            if header['number'] == '1':
+                info_obj[key]['value'] = [format_vcf_value(value)]
+            elif type(value) is tuple:
+                info_obj[key]['value'] = list(map(format_vcf_value, value))
+            else:
+                info_obj[key]['value'] = format_vcf_value(value).split(',')
 
-    # find a CSQ header, as a special case:
-    csq_header = None
-    if 'CSQ' in info_headers:
-        csq_header = info_headers['CSQ']['description']
-    if 'CSQ' in text and csq_header is not None:
-        info_obj['CSQ']['description'] = "Consequence annotations from Ensembl VEP."
-        info_obj['CSQ']['value'] = parse_vep_annotation(info_obj['CSQ']['value'], csq_header)
-        info_obj['CSQ']['number'] = 'K' # obj keyed by allele
+        if 'CSQ' in info_obj and info_obj['CSQ']['value'] is not None and self.csq_parts is not None:
+            info_obj['CSQ']['description'] = "Consequence annotations from Ensembl VEP."
+            info_obj['CSQ']['value'] = parse_vep_annotation(info_obj['CSQ']['value'], self.csq_parts)
+            info_obj['CSQ']['number'] = 'K' # obj keyed by allele
 
-    return info_obj
+        return info_obj
 
 
-def parse_vep_annotation(info, csq_header):
+def parse_vep_annotation(info, csq_parts):
+    # csq_parts are the CSQ fields listed in the CSQ header's Format
     result = {}
-    csq_match = re.match(r".+Format: (.+)", csq_header)
-    csq_parts = csq_match.group(1).split('|')
     for i in range(len(info)):
         this_info = {}
         info_pieces = info[i].split('|')
@@ -267,68 +694,46 @@ def get_genotype_index(a, b):
 
 
 def seq_match(a, b):
-    return len(set(expand_iupac(a)).intersection(set(expand_iupac(b)))) > 0
-
-
-def expand_iupac(base_str):
-    result = []
-    # Find ambiguous nucleotide sequences (https://www.bioinformatics.org/sms/iupac.html) in the given sequence.
-    ambig_match = re.match(r"(^.*?)([RYSWKMBDHVN])(.*$)", base_str)
-    if ambig_match is None:
-        return [base_str]
-    # while there is an ambiguity char in group 2, append the expanded seqs to result, then run expand_iupac on each of those results
-    # ooh, apparently python 3.10 has match/case:
-    match ambig_match.group(2):
-        case 'R':
-            result.append(f"{ambig_match.group(1)}A{ambig_match.group(3)}")
-            result.append(f"{ambig_match.group(1)}G{ambig_match.group(3)}")
-        case 'Y':
-            result.append(f"{ambig_match.group(1)}C{ambig_match.group(3)}")
-            result.append(f"{ambig_match.group(1)}T{ambig_match.group(3)}")
-        case 'S':
-            result.append(f"{ambig_match.group(1)}G{ambig_match.group(3)}")
-            result.append(f"{ambig_match.group(1)}C{ambig_match.group(3)}")
-        case 'W':
-            result.append(f"{ambig_match.group(1)}A{ambig_match.group(3)}")
-            result.append(f"{ambig_match.group(1)}T{ambig_match.group(3)}")
-        case 'K':
-            result.append(f"{ambig_match.group(1)}G{ambig_match.group(3)}")
-            result.append(f"{ambig_match.group(1)}T{ambig_match.group(3)}")
-        case 'M':
-            result.append(f"{ambig_match.group(1)}A{ambig_match.group(3)}")
-            result.append(f"{ambig_match.group(1)}C{ambig_match.group(3)}")
-        case 'B':
-            result.append(f"{ambig_match.group(1)}A{ambig_match.group(3)}")
-            result.append(f"{ambig_match.group(1)}G{ambig_match.group(3)}")
-            result.append(f"{ambig_match.group(1)}T{ambig_match.group(3)}")
-        case 'D':
-            result.append(f"{ambig_match.group(1)}C{ambig_match.group(3)}")
-            result.append(f"{ambig_match.group(1)}G{ambig_match.group(3)}")
-            result.append(f"{ambig_match.group(1)}T{ambig_match.group(3)}")
-        case 'H':
-            result.append(f"{ambig_match.group(1)}A{ambig_match.group(3)}")
-            result.append(f"{ambig_match.group(1)}C{ambig_match.group(3)}")
-            result.append(f"{ambig_match.group(1)}T{ambig_match.group(3)}")
-        case 'V':
-            result.append(f"{ambig_match.group(1)}A{ambig_match.group(3)}")
-            result.append(f"{ambig_match.group(1)}C{ambig_match.group(3)}")
-            result.append(f"{ambig_match.group(1)}G{ambig_match.group(3)}")
-        case 'N':
-            result.append(f"{ambig_match.group(1)}A{ambig_match.group(3)}")
-            result.append(f"{ambig_match.group(1)}C{ambig_match.group(3)}")
-            result.append(f"{ambig_match.group(1)}G{ambig_match.group(3)}")
-            result.append(f"{ambig_match.group(1)}T{ambig_match.group(3)}")
-    final = []
-    while len(result) > 0:
-        final.extend(expand_iupac(result.pop(0)))
-    return final
+    # two sequences match if, at every position, their bases are equal or
+    # their ambiguity codes have a base in common
+    if a == b:
+        return True
+    if len(a) != len(b):
+        return False
+    for x, y in zip(a, b):
+        if x != y and IUPAC_MASKS.get(x, 0) & IUPAC_MASKS.get(y, 0) == 0:
+            return False
+    return True
+
+
+def seq_matches(seqs, query):
+    """
+    Returns a list of whether each of seqs matches query, like seq_match, comparing the
+    sequences that are the same length as query all at once.
+    """
+    result = [False] * len(seqs)
+    same_length = [i for i in range(len(seqs)) if len(seqs[i]) == len(query)]
+    if len(same_length) == 0:
+        return result
+    try:
+        query_bytes = numpy.frombuffer(query.encode('ascii'), dtype=numpy.uint8)
+        seq_bytes = numpy.frombuffer("".join(seqs[i] for i in same_length).encode('ascii'), dtype=numpy.uint8).reshape(len(same_length), len(query))
+    except UnicodeEncodeError:
+        for i in same_length:
+            result[i] = seq_match(seqs[i], query)
+        return result
+    # IUPAC_TABLE is 0 for anything that isn't an IUPAC code, so those only match themselves
+    matched = ((IUPAC_TABLE[seq_bytes] & IUPAC_TABLE[query_bytes]) != 0) | (seq_bytes == query_bytes)
+    for i, match in zip(same_length, matched.all(axis=1).tolist()):
+        result[i] = match
+    return result
 
 
 def convert_hgvsid_to_location(hgvsid, reference_genome='hg38'):
     result = {}
     hgvs_parse = re.match(r'(.+):[gc].(\d+)(.+)', hgvsid)
     if hgvs_parse is not None:
-        genes = database.search_refseqs(hgvs_parse.group(1), 'transcript_name')
+        genes = refseq.refseq_index.search(hgvs_parse.group(1), 'transcript_name')
         if genes is None or len(genes) == 0:
             return None
         if len(genes) > 1:
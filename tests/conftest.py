@@ -0,0 +1,2 @@
+def pytest_configure(config):
+    config.addinivalue_line("markers", "database: calls the server's modules directly, so it needs the server's config.ini and database")
@@ -0,0 +1,38 @@
+# Measures the latency and peak memory of compiling a beacon resultset for a region, and of turning it into
+# the records of a response. Run it from the htsget_server directory, against an indexed database:
+#   python ../tests/snippets/beaconbench.py 21 1 48000000
+import sys
+import time
+import tracemalloc
+import beacon_operations
+import variants
+
+
+def measure(func, *args, **kwargs):
+    # returns the result of func, the seconds it took, and the peak and retained MB it allocated
+    tracemalloc.start()
+    start = time.perf_counter()
+    result = func(*args, **kwargs)
+    seconds = time.perf_counter() - start
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return result, seconds, peak / 1e6, current / 1e6
+
+
+def find_resultset(reference_name, start, end, reference_genome):
+    variants_by_file = variants.find_variants_in_region(reference_name=reference_name, start=start, end=end, format_keys=['GT'], info_keys=['CSQ'], genotypes=True)
+    return beacon_operations.compile_beacon_resultset(variants_by_file, reference_genome=reference_genome)
+
+
+def main(reference_name, start, end, reference_genome="hg38", repeats=3):
+    for i in range(repeats):
+        # the records are freed once they're compiled, so what's retained is the resultset that would be cached
+        resultset, seconds, peak, retained = measure(find_resultset, reference_name, start, end, reference_genome)
+        print(f"find_resultset: {len(resultset)} results, {seconds:.3f}s, peak {peak:.1f}MB, retained {retained:.1f}MB")
+        response, seconds, peak, retained = measure(beacon_operations.add_case_level_data, resultset, [])
+        cases = sum(len(result['caseLevelData']) for result in response)
+        print(f"add_case_level_data: {cases} cases, {seconds:.3f}s, peak {peak:.1f}MB")
+
+
+if __name__ == "__main__":
+    main(sys.argv[1], int(sys.argv[2]), int(sys.argv[3]), *sys.argv[4:])
@@ -1,3 +1,4 @@
+import copy
 import json
 import os
 import re
@@ -459,6 +460,39 @@ def test_gene_search():
     assert len(response.json()['results']) == 2
 
 
+def test_gene_list_etag():
+    url = f"{HOST}/htsget/v1/genes"
+    response = requests.get(url, headers=get_headers())
+    assert response.status_code == 200
+    assert "BRCA1" in response.json()['results']
+    etag = response.headers['ETag']
+
+    # the client already has this list, so it shouldn't get it again
+    headers = get_headers()
+    headers['If-None-Match'] = etag
+    response = requests.get(url, headers=headers)
+    assert response.status_code == 304
+
+    # each reference genome has its own list
+    response = requests.get(url, params={'genome': 'hg37'}, headers=headers)
+    assert response.status_code == 200
+    assert response.headers['ETag'] != etag
+
+
+def test_gene_region_search():
+    url = f"{HOST}/htsget/v1/regions/genes"
+    params = {'referenceName': 'chr17', 'start': 43000000, 'end': 43200000}
+    response = requests.get(url, params=params, headers=get_headers())
+    print(response.text)
+    genes = list(map(lambda x: x['gene_name'], response.json()['results']))
+    assert 'BRCA1' in genes
+
+    # BRCA1 starts at 43044294: a single base just before it shouldn't overlap it
+    params = {'referenceName': '17', 'start': 43044293}
+    response = requests.get(url, params=params, headers=get_headers())
+    assert 'BRCA1' not in map(lambda x: x['gene_name'], response.json()['results'])
+
+
 def test_beacon_get_search():
     # for an authed user, this short allele form request should work:
     # return two variations, one ref, one alt, for a single position.
@@ -502,6 +536,23 @@ def get_beacon_post_search():
                     "apiVersion": "v2"
                 }
             }, 5, 2
+        ),
+        (
+            # 3 variations, corresponding to a ref and 2 alts in sample.compressed
+            # first variation has three cases, one of which has a haploid genotype
+            {
+                "query": {
+                    "requestParameters": {
+                        "start": [1],
+                        "end": [1000],
+                        "assemblyId": "hg38",
+                        "referenceName": "X"
+                    }
+                },
+                "meta": {
+                    "apiVersion": "v2"
+                }
+            }, 3, 3
         )
     ]
 
@@ -516,6 +567,165 @@ def test_beacon_post_search(body, count, cases):
     assert len(response.json()['response'][0]['caseLevelData']) == cases
 
 
+@pytest.mark.parametrize('body, count, cases', get_beacon_post_search())
+def test_beacon_granularity(body, count, cases):
+    """
+    Boolean and count answers, which can come from the pos_bucket index, should agree with the records.
+    """
+    url = f"{HOST}/beacon/v2/g_variants"
+    records = requests.post(url, json=body, headers=get_headers()).json()
+    for granularity in ['boolean', 'count']:
+        body['meta']['requestedGranularity'] = granularity
+        response = requests.post(url, json=body, headers=get_headers()).json()
+        assert response['responseSummary']['exists'] == records['responseSummary']['exists']
+        assert 'response' not in response
+    body['query']['requestParameters']['referenceName'] = 'chr22'
+    for granularity in ['boolean', 'count']:
+        body['meta']['requestedGranularity'] = granularity
+        response = requests.post(url, json=body, headers=get_headers()).json()
+        assert not response['responseSummary']['exists']
+
+
+def test_beacon_cache():
+    """
+    Repeated searches, which can come from the cache, should get the same response.
+    """
+    url = f"{HOST}/beacon/v2/g_variants"
+    body = get_beacon_post_search()[0][0]
+    first = requests.post(url, json=body, headers=get_headers()).json()
+    body = get_beacon_post_search()[0][0]
+    second = requests.post(url, json=body, headers=get_headers()).json()
+    assert first == second
+    assert len(second['response'][0]['caseLevelData']) == 2
+
+
+def test_beacon_variant_filters():
+    """
+    Length and allele filters should only let through the matching alt variations.
+    """
+    url = f"{HOST}/beacon/v2/g_variants"
+    body = {
+        "query": {
+            "requestParameters": {
+                "referenceName": "1",
+                "start": [1],
+                "end": [20000000],
+                "variantMinLength": 2
+            }
+        },
+        "meta": {
+            "apiVersion": "v2"
+        }
+    }
+    response = requests.post(url, json=body, headers=get_headers()).json()
+    alts = [var['variantInternalId'] for var in response['response'] if not var['variantInternalId'].endswith("=")]
+    assert len(alts) == 3
+    assert "NC_000001.11:g.1107718_1107720delinsCC" in alts
+
+    body['query']['requestParameters'].pop('variantMinLength')
+    body['query']['requestParameters']['alternateBases'] = "T"
+    response = requests.post(url, json=body, headers=get_headers()).json()
+    alts = [var['variantInternalId'] for var in response['response'] if not var['variantInternalId'].endswith("=")]
+    assert sorted(alts) == ["NC_000001.11:g.16565784G>T", "NC_000001.11:g.9041920C>T"]
+
+
+def test_beacon_pagination():
+    """
+    Following the nextPage tokens should return the same results as an unpaged search, in order.
+    """
+    url = f"{HOST}/beacon/v2/g_variants"
+
+    def get_body(pagination):
+        return {
+            "query": {
+                "requestParameters": {
+                    "referenceName": "1",
+                    "start": [1],
+                    "end": [20000000]
+                }
+            },
+            "meta": {
+                "apiVersion": "v2"
+            },
+            "pagination": pagination
+        }
+
+    def get_pages():
+        pages = []
+        pagination = {"limit": 4}
+        while True:
+            response = requests.post(url, json=get_body(pagination), headers=get_headers()).json()
+            pages.append(response)
+            if 'nextPage' not in response['meta']['returnedPagination']:
+                return pages
+            pagination = {"limit": 4, "currentPage": response['meta']['returnedPagination']['nextPage']}
+
+    # the first time, the pages are compiled as they're needed; the second time, they come from the whole resultset
+    for i in range(2):
+        pages = get_pages()
+        results = [result for page in pages for result in page['response']]
+        assert len(pages) == 4
+        assert pages[0]['responseSummary']['numTotalResults'] == ">=5"
+        assert pages[-1]['responseSummary']['numTotalResults'] == 15
+        unpaged = requests.post(url, json=get_body({"limit": 0}), headers=get_headers()).json()
+        assert results == unpaged['response']
+        starts = [result['variation']['location']['interval']['start']['value'] for result in results]
+        assert starts == sorted(starts)
+
+    # skip is a number of pages
+    response = requests.post(url, json=get_body({"skip": 1, "limit": 4}), headers=get_headers()).json()
+    assert response['response'] == results[4:8]
+
+    response = requests.post(url, json=get_body({"limit": 4, "currentPage": "notatoken"}), headers=get_headers()).json()
+    assert response['error']['errorCode'] == 400
+
+    response = requests.post(url, json=get_body({"skip": 1}), headers=get_headers()).json()
+    assert response['error']['errorCode'] == 400
+
+    # GET searches are only paged if they ask for a limit or a page
+    response = requests.get(f"{url}?referenceName=1&start=1&end=20000000", headers=get_headers()).json()
+    assert response['response'] == results
+    response = requests.get(f"{url}?referenceName=1&start=1&end=20000000&limit=4", headers=get_headers()).json()
+    assert response['response'] == results[0:4]
+
+
+def test_beacon_batch_search():
+    """
+    A batch search should get the same response for each search as searching them one at a time.
+    """
+    url = f"{HOST}/beacon/v2/g_variants"
+    request_parameters = [body['query']['requestParameters'] for body, count, cases in get_beacon_post_search()]
+    # overlapping regions in the same files, and searches that find their regions in other ways
+    request_parameters.append({"start": [5030500], "end": [5030600], "referenceName": "21"})
+    request_parameters.append({"geneId": "NBPF1"})
+    request_parameters.append({"genomicAlleleShortForm": "NC_000021.9:g.5030847T>A"})
+    request_parameters.append({"referenceName": "chr22", "start": [1], "end": [1000]})
+    for granularity in ['record', 'count', 'boolean']:
+        body = {
+            "query": {
+                "requestParameters": copy.deepcopy(request_parameters)
+            },
+            "meta": {
+                "apiVersion": "v2",
+                "requestedGranularity": granularity
+            }
+        }
+        batch = requests.post(f"{url}/batch", json=body, headers=get_headers()).json()
+        assert len(batch['responses']) == len(request_parameters)
+        for i in range(len(request_parameters)):
+            body = {
+                "query": {
+                    "requestParameters": copy.deepcopy(request_parameters[i])
+                },
+                "meta": {
+                    "apiVersion": "v2",
+                    "requestedGranularity": granularity
+                }
+            }
+            response = requests.post(url, json=body, headers=get_headers()).json()
+            assert batch['responses'][i] == response
+
+
 # if we search for NBPF1, we should find records in test.vcf that contain NBPF1 in their VEP annotations.
 def test_beacon_search_annotations():
     url = f"{HOST}/beacon/v2/g_variants"
@@ -549,6 +759,53 @@ def test_vcf_json():
     assert len(res.json()['variants']) == 7
 
 
+def test_vcf_json_cursor():
+    url = f"{HOST}/htsget/v1/variants/data/test"
+    all_variants = requests.request("GET", url, params={'format': 'VCF-JSON'}, headers=get_headers()).json()['variants']
+
+    # page through the variants with a limit
+    params = {'format': 'VCF-JSON', 'limit': 3}
+    variants = []
+    pages = 0
+    while True:
+        res = requests.request("GET", url, params=params, headers=get_headers())
+        assert res.status_code == 200
+        assert len(res.json()['variants']) <= 3
+        variants.extend(res.json()['variants'])
+        pages += 1
+        if 'next_cursor' not in res.json():
+            break
+        params['cursor'] = res.json()['next_cursor']
+    assert pages == 3
+    assert variants == all_variants
+
+    # the NDJSON stream has the headers, then the variants, then the cursor
+    params = {'format': 'VCF-NDJSON', 'limit': 5}
+    res = requests.request("GET", url, params=params, headers=get_headers())
+    assert res.status_code == 200
+    lines = [json.loads(line) for line in res.text.splitlines()]
+    assert lines[0]['id'] == 'test'
+    assert 'variants' not in lines[0]
+    assert lines[1:6] == all_variants[0:5]
+    params['cursor'] = lines[6]['next_cursor']
+    res = requests.request("GET", url, params=params, headers=get_headers())
+    lines = [json.loads(line) for line in res.text.splitlines()]
+    assert lines[1:] == all_variants[5:]
+
+    params['cursor'] = "not a cursor"
+    res = requests.request("GET", url, params=params, headers=get_headers())
+    assert res.status_code == 400
+
+
+def test_db_pool_metrics():
+    url = f"{HOST}/metrics/db-pool"
+    res = requests.request("GET", url)
+    assert res.status_code == 403
+    res = requests.request("GET", url, headers=get_headers())
+    assert res.status_code == 200
+    assert "pool_size" in res.json()
+
+
 @pytest.fixture
 def cohorts():
     return ["test-htsget", "1000genomes"]
@@ -0,0 +1,466 @@
+import json
+import os
+import sys
+import pytest
+from test_htsget_server import index_variants
+
+# These tests call the server's modules directly instead of its API, so they need the server's config.ini and
+# access to its database. They use the data that test_htsget_server.py loads, so they run after it.
+# To run only the API tests: pytest -m "not database"
+REPO_DIR = os.path.abspath(f"{os.path.dirname(os.path.realpath(__file__))}/..")
+sys.path.insert(0, os.path.abspath(f"{REPO_DIR}/htsget_server"))
+
+pytestmark = pytest.mark.database
+
+
+def count_queries(func, *args, **kwargs):
+    """
+    Call func against the server's database module, returning the number of SQL statements it ran.
+    """
+    import database
+    from sqlalchemy import event
+    statements = []
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+    event.listen(database.engine, "before_cursor_execute", before_cursor_execute)
+    try:
+        func(*args, **kwargs)
+    finally:
+        event.remove(database.engine, "before_cursor_execute", before_cursor_execute)
+    return len(statements)
+
+
+def test_drs_object_query_count():
+    """
+    Getting a DrsObject should not lazy-load its relationships one query at a time,
+    and listing DrsObjects should take the same number of queries no matter how many there are.
+    """
+    import database
+    assert count_queries(database.get_drs_object, "NA18537") <= 2
+    all_count = count_queries(database.list_drs_objects)
+    cohort_count = count_queries(database.list_drs_objects, cohort_id="test-htsget")
+    assert len(database.list_drs_objects()) > len(database.list_drs_objects(cohort_id="1000genomes"))
+    assert all_count == cohort_count
+    assert all_count <= 4
+
+
+def test_batch_drs_object_query_count():
+    """
+    Batched lookups should be a fixed number of queries, however many ids are asked for.
+    """
+    import database
+    samples = index_variants()
+    drs_objs = database.get_drs_objects(samples + ["not-a-drs-object"])
+    assert set(drs_objs.keys()) == set(samples)
+    assert drs_objs["NA18537"] == database.get_drs_object("NA18537")
+    assert count_queries(database.get_drs_objects, samples) == count_queries(database.get_drs_objects, samples[0:1])
+    varfiles = database.get_variantfiles(samples)
+    assert varfiles["NA18537"] == database.get_variantfile("NA18537")
+    assert count_queries(database.get_variantfiles, samples) <= 2
+
+
+def test_search_query_count():
+    """
+    A region search should be a single query, however many files match.
+    """
+    import database
+    region = {'referenceName': 'chr21', 'start': 0, 'end': 50000000}
+    results = database.search({'region': region})
+    assert len(results) > 1
+    for result in results:
+        assert result['variantcount'] > 0
+    assert count_queries(database.search, {'region': region}) == 1
+    assert count_queries(database.search, {'region': region, 'headers': ['FORMAT']}) == 1
+
+
+def test_pos_bucket_array():
+    """
+    Packed pos_bucket arrays should give the same counts as the pos_bucket rows.
+    """
+    import database
+    rows = database.get_variant_count_for_variantfile({'id': 'sample.compressed', 'referenceName': '21', 'start': 0, 'end': -1})
+    assert len(rows) > 0
+    try:
+        database.create_pos_bucket_arrays({
+            'variantfile_id': 'sample.compressed',
+            'pos_bucket_ids': [row['pos_bucket'] for row in rows],
+            'bucket_counts': [row['count'] for row in rows],
+            'normalized_contigs': ['21'] * len(rows)
+        })
+        arrays = database.get_variant_count_for_variantfile_arrays({'id': 'sample.compressed', 'referenceName': '21', 'start': 0, 'end': -1})
+        assert arrays == rows
+        region = {'referenceName': '21', 'start': rows[0]['pos_bucket'], 'end': rows[-1]['pos_bucket']}
+        searched = list(filter(lambda x: x['drs_object_id'] == 'sample.compressed', database.search({'region': region})))
+        searched_arrays = database.search_arrays({'region': region})
+        assert searched_arrays == searched
+        assert searched_arrays[0]['variantcount'] == sum(row['count'] for row in rows)
+    finally:
+        # the fixture only had pos_bucket rows, so the arrays are removed before any other test searches it
+        database.delete_pos_bucket_arrays('sample.compressed')
+    assert database.get_variant_count_for_variantfile_arrays({'id': 'sample.compressed', 'referenceName': '21', 'start': 0, 'end': -1}) == []
+    # sum_bucket_array's range is inclusive of both ends
+    assert database.sum_bucket_array(database.pack_bucket_array([10, 20, 30]), database.pack_bucket_array([1, 2, 3]), 20, 30) == 5
+    assert database.sum_bucket_array(database.pack_bucket_array([10, 20, 30]), database.pack_bucket_array([1, 2, 3]), 40, 50) is None
+
+
+def test_dataset_version():
+    """
+    Re-indexing a variantfile should change the dataset version, so that cached beacon results are dropped,
+    but registering other objects shouldn't.
+    """
+    import database
+    # throwaway objects, so that the fixture data isn't changed
+    id = "test_dataset_version"
+    version = database.get_dataset_version()
+    try:
+        database.create_drs_object({"id": f"{id}_sample", "description": "sample", "cohort": "test-htsget"})
+        database.create_drs_object({"id": id, "description": "wgs", "reference_genome": "hg38", "cohort": "test-htsget"})
+        assert database.get_dataset_version() == version
+        database.mark_variantfile_as_indexed(id)
+        assert database.get_dataset_version() > version
+        version = database.get_dataset_version()
+        database.delete_drs_object(f"{id}_sample")
+        assert database.get_dataset_version() == version
+    finally:
+        database.delete_drs_object(id)
+        if database.get_drs_object(f"{id}_sample") is not None:
+            database.delete_drs_object(f"{id}_sample")
+    assert database.get_dataset_version() > version
+
+
+def test_nested_retry():
+    """
+    A retried operation that calls another one shouldn't retry its failures again, or reset the circuit breaker.
+    """
+    import database
+    import sqlalchemy.exc
+    calls = []
+
+    @database.retry(base_delay=0, max_delay=0)
+    def inner():
+        calls.append("inner")
+        raise sqlalchemy.exc.OperationalError("SELECT 1", None, Exception("connection refused"))
+
+    @database.retry(base_delay=0, max_delay=0)
+    def outer():
+        calls.append("outer")
+        return inner()
+
+    circuit_breaker = database.circuit_breaker
+    database.circuit_breaker = database.CircuitBreaker(threshold=100)
+    try:
+        with pytest.raises(database.RetriesExhausted):
+            outer()
+        assert calls.count("outer") == 1
+        assert calls.count("inner") == database.MAX_TRIES
+        assert database.circuit_breaker.failures == database.MAX_TRIES
+    finally:
+        database.circuit_breaker = circuit_breaker
+
+
+def test_database_unavailable_handlers():
+    """
+    Handlers that turn their errors into a 500 should let DatabaseUnavailable through to the server's 503 handler.
+    """
+    import authz
+    import beacon_operations
+    import database
+    import htsget_operations
+
+    circuit_breaker = database.circuit_breaker
+    database.circuit_breaker = database.CircuitBreaker(threshold=1)
+    database.circuit_breaker.record_failure()
+    try:
+        with beacon_operations.app.test_request_context(headers={"Authorization": f"Bearer {authz.TEST_KEY}"}):
+            with pytest.raises(database.DatabaseUnavailable):
+                beacon_operations.get_search(reference_name="21", start=5030000, end=5030847)
+            with pytest.raises(database.DatabaseUnavailable):
+                htsget_operations.verify_variants_genomic_drs_object("multisample_1")
+    finally:
+        database.circuit_breaker = circuit_breaker
+
+
+def test_fetch_pool_request_context():
+    """
+    Files read on the fetch pool should see the request that asked for them, and share its retry deadline.
+    """
+    import authz
+    import database
+    import variants
+    from flask import Flask, g, request
+
+    def read(drs_object_id):
+        return (drs_object_id, request.headers.get("Authorization"), g.db_retry_deadline)
+
+    with Flask(__name__).test_request_context(headers={"Authorization": f"Bearer {authz.TEST_KEY}"}):
+        deadline = database.get_retry_deadline()
+        results = variants.run_on_fetch_pool(read, ["a", "b", "c"])
+    assert results == [(i, f"Bearer {authz.TEST_KEY}", deadline) for i in ["a", "b", "c"]]
+
+
+def test_search_cohorts():
+    """
+    Only the files in the given cohorts should need their records processed; the others are just counted.
+    """
+    import database
+    region = {'referenceName': '21', 'start': 5030000, 'end': 5030847}
+    results = database.search({'region': region})
+    assert len(results) > 0
+    assert all(map(lambda x: x['records'], results))
+    results = database.search({'region': region, 'cohorts': ['not-a-cohort']})
+    assert len(results) > 0
+    assert not any(map(lambda x: x['records'], results))
+    assert all(map(lambda x: x['variantcount'] > 0, results))
+
+
+def test_beacon_index_count():
+    """
+    A count answered from the pos_bucket index is a lower bound, not the number of variant records.
+    """
+    import authz
+    import beacon_operations
+    import variants
+    actual_params = {'reference_genome': 'hg38', 'reference_name': '21', 'start': 0, 'end': 50000000}
+    counts = variants.count_variants_in_region(reference_name='21', start=0, end=50000000)
+    assert any(map(lambda x: x['innercount'] > 0, counts))
+    with beacon_operations.app.test_request_context(headers={"Authorization": f"Bearer {authz.TEST_KEY}"}):
+        for granularity in ['boolean', 'count']:
+            response = {'meta': {'returnedGranularity': granularity}, 'responseSummary': {'exists': False, 'numTotalResults': 0}}
+            response = beacon_operations.search_bucket_index(actual_params, response, counts)
+            assert response['responseSummary']['exists']
+            if granularity == 'count':
+                assert response['responseSummary']['numTotalResults'] == ">=1"
+            else:
+                assert 'numTotalResults' not in response['responseSummary']
+
+
+def test_beacon_counted_cohorts():
+    """
+    The files of cohorts the user can't see records for should still count towards the total, and towards whether
+    anything exists, without their records ever being compiled.
+    """
+    import authz
+    import beacon_operations
+    import variants
+    compiled = []
+    compile_beacon_resultset = beacon_operations.compile_beacon_resultset
+    iterate_beacon_resultset = beacon_operations.iterate_beacon_resultset
+
+    def compile_recorded(variants_by_obj, **kwargs):
+        compiled.extend(variants_by_obj.keys())
+        return compile_beacon_resultset(variants_by_obj, **kwargs)
+
+    def iterate_recorded(records_by_obj, **kwargs):
+        compiled.extend(records_by_obj.keys())
+        return iterate_beacon_resultset(records_by_obj, **kwargs)
+
+    def search(pagination, counted):
+        # multisample_1 has a different alt at 5030847, and only multisample_2 has G>C at 5031153
+        raw_req = {
+            "query": {"requestParameters": {"reference_name": "21", "start": [5030847], "end": [5031153], "alternate_bases": "C"}},
+            "meta": {"apiVersion": "v2", "requestedGranularity": "record"},
+            "pagination": pagination
+        }
+        response, actual_params = beacon_operations.get_search_params(raw_req)
+        counts = variants.count_variants_in_region(reference_name="21", start=5030847, end=5031153, cohorts=["test-htsget"])
+        for count in counts:
+            if count['drs_object_id'] in counted:
+                count['records'] = False
+        beacon_operations.beacon_cache.clear()
+        return beacon_operations.search_region(raw_req, response, actual_params, counts=counts)
+
+    beacon_operations.compile_beacon_resultset = compile_recorded
+    beacon_operations.iterate_beacon_resultset = iterate_recorded
+    try:
+        with beacon_operations.app.test_request_context(headers={"Authorization": f"Bearer {authz.TEST_KEY}"}):
+            expected = search({}, [])['responseSummary']
+            assert expected['exists']
+            for pagination in [{}, {"limit": 2}]:
+                compiled.clear()
+                response = search(pagination, ["multisample_2"])
+                assert "multisample_2" not in compiled
+                # the page is shorter than the limit, so the total is exact
+                assert response['responseSummary'] == expected
+                assert all(map(lambda x: "G>C" not in x['variantInternalId'], response['response']))
+                compiled.clear()
+                response = search(pagination, ["multisample_1", "multisample_2"])
+                assert compiled == []
+                assert response['responseSummary']['exists']
+    finally:
+        beacon_operations.compile_beacon_resultset = compile_beacon_resultset
+        beacon_operations.iterate_beacon_resultset = iterate_beacon_resultset
+
+
+def test_beacon_batch_counted_cohorts():
+    """
+    A batch should read the files of the cohorts it only counts in the same pass as the others, not again for each search.
+    """
+    import authz
+    import beacon_operations
+    import variants
+    count_variants_in_regions = variants.count_variants_in_regions
+    find_variants_in_region = variants.find_variants_in_region
+    read = []
+
+    def count_counted(regions, cohorts=None):
+        counts = count_variants_in_regions(regions, cohorts=cohorts)
+        for region_counts in counts:
+            for count in region_counts:
+                if count['drs_object_id'] == "multisample_2":
+                    count['records'] = False
+        return counts
+
+    def find_recorded(**kwargs):
+        read.append(kwargs.get('drs_object_ids'))
+        return find_variants_in_region(**kwargs)
+
+    batch = {
+        "query": {"requestParameters": [
+            {"reference_name": "21", "start": [5030847], "end": [5031153], "alternate_bases": "C"},
+            {"reference_name": "21", "start": [5030000], "end": [5031153]}
+        ]},
+        "meta": {"apiVersion": "v2", "requestedGranularity": "record"}
+    }
+    variants.count_variants_in_regions = count_counted
+    variants.find_variants_in_region = find_recorded
+    try:
+        with beacon_operations.app.test_request_context(headers={"Authorization": f"Bearer {authz.TEST_KEY}"}):
+            beacon_operations.beacon_cache.clear()
+            responses = beacon_operations.batch_search(json.loads(json.dumps(batch)))['responses']
+            assert read == []
+            assert all(map(lambda x: x['responseSummary']['exists'], responses))
+            # the G>C at 5031153 is only in multisample_2, so it's counted but not returned
+            assert all(map(lambda x: "G>C" not in x['variantInternalId'], responses[0]['response']))
+            assert responses[0]['responseSummary']['numTotalResults'] > len(responses[0]['response'])
+    finally:
+        variants.count_variants_in_regions = count_variants_in_regions
+        variants.find_variants_in_region = find_variants_in_region
+
+
+def test_authz_cache():
+    """
+    An authorization lookup should only be made once per token until it expires from the cache.
+    """
+    import authz
+    calls = []
+
+    def lookup(token):
+        calls.append(token)
+        return [token]
+
+    for token in ["a", "a", "b"]:
+        with authz.app.test_request_context(headers={"Authorization": f"Bearer {token}"}) as context:
+            assert authz.cached_lookup(context.request, ("test_lookup",), lookup, token) == [token]
+            assert authz.cached_lookup(context.request, ("test_lookup",), lookup, token) == [token]
+    assert calls == ["a", "b"]
+
+
+def test_streaming_json():
+    """
+    Streamed JSON should parse to the same object, however it's split into chunks.
+    """
+    import streaming
+    obj = {"meta": {"a": 1}, "response": [{"b": [1, 2]}, "c", None]}
+    chunk_size = streaming.STREAM_CHUNK_SIZE
+    try:
+        for size in [chunk_size, 1]:
+            streaming.STREAM_CHUNK_SIZE = size
+            assert json.loads("".join(streaming.buffer_chunks(streaming.iterate_json_object(obj, 'response')))) == obj
+            empty = {"meta": {}, "response": []}
+            assert json.loads("".join(streaming.buffer_chunks(streaming.iterate_json_object(empty, 'response')))) == empty
+            generated = {"meta": {}, "response": (x for x in obj['response'])}
+            assert json.loads("".join(streaming.buffer_chunks(streaming.iterate_json_object(generated, 'response')))) == {"meta": {}, "response": obj['response']}
+    finally:
+        streaming.STREAM_CHUNK_SIZE = chunk_size
+
+    # an error partway through a stream is raised from the response's body
+    def fail():
+        yield "a"
+        raise ValueError("partway")
+
+    with pytest.raises(ValueError):
+        "".join(streaming.log_errors(streaming.iterate_json_list(fail())))
+
+
+def test_streaming_drs_objects():
+    """
+    Streaming the DRS objects should give the same list as listing them.
+    """
+    import database
+    import streaming
+    listed = database.list_drs_objects()
+    assert len(listed) > 0
+    assert json.loads("".join(streaming.buffer_chunks(streaming.iterate_json_list(database.iterate_drs_objects())))) == listed
+    listed = database.list_drs_objects(cohort_id="test-htsget")
+    assert json.loads("".join(streaming.buffer_chunks(streaming.iterate_json_list(database.iterate_drs_objects(cohort_id="test-htsget"))))) == listed
+
+
+def test_parse_header():
+    import variants
+    header = variants.parse_header('<ID=X,Number=1,Type=String,Description="a, \\"quoted\\" value",Source=dbsnp,Version=1>')
+    assert header['Description'] == 'a, \\"quoted\\" value'
+    assert header['Source'] == 'dbsnp'
+    assert header['Version'] == '1'
+    assert variants.parse_header('<ID=Y,Description="">')['Description'] == ''
+
+
+def test_seq_match():
+    import variants
+    assert variants.seq_match('ACGT', 'ACGT')
+    assert variants.seq_match('ANGT', 'ACGT')
+    assert variants.seq_match('ARGT', 'AGGT')
+    assert not variants.seq_match('ARGT', 'ACGT')
+    assert not variants.seq_match('ACG', 'ACGT')
+    assert variants.seq_match('B', 'C')
+    assert not variants.seq_match('B', 'A')
+    # long runs of N are compared base by base
+    assert variants.seq_match('N' * 100, 'ACGT' * 25)
+    assert variants.seq_matches(['N' * 4, 'ACGT', 'ACGA', 'ACG', '<DEL>'], 'ACGT') == [True, True, False, False, False]
+    assert variants.seq_matches(['<DEL>', 'NNNNN'], '<DEL>') == [True, False]
+
+
+def test_header_cache():
+    """
+    Parsed headers should be reused until the variantfile's headers change.
+    """
+    import variants
+    import database
+    parsed = variants.get_parsed_headers('multisample_1')
+    assert variants.get_parsed_headers('multisample_1') is parsed
+    assert 'info' in parsed
+    database.add_header_for_variantfile({'text': '##test_header_cache=yes', 'variantfile_id': 'multisample_1'})
+    try:
+        reparsed = variants.get_parsed_headers('multisample_1')
+        assert reparsed is not parsed
+        assert reparsed['headers']['test_header_cache'] == ['yes']
+    finally:
+        database.delete_header('##test_header_cache=yes')
+    assert 'test_header_cache' not in variants.get_parsed_headers('multisample_1')['headers']
+
+
+def test_beacon_zygosity():
+    """
+    A call with a missing allele should be heterozygous without a secondary allele, not compound heterozygous.
+    """
+    import numpy
+    import beacon_operations
+    allele_ids = ['ref', 'alt1', 'alt2']
+    resultset = {id: beacon_operations.BeaconResult(id, 0, 1, "", "") for id in allele_ids}
+    # -1 is a missing allele and -2 pads a haploid call
+    genotypes = {
+        'alleles': numpy.array([[0, 1], [1, 1], [1, 2], [-1, 1], [1, -2]]),
+        'phased': numpy.array([False] * 5),
+        'samples': ['het', 'hom', 'compound', 'missing', 'haploid']
+    }
+    beacon_operations.add_genotypes_to_variations(resultset, allele_ids, [True] * 3, genotypes, "test", "test-htsget")
+    results = beacon_operations.add_case_level_data([resultset['alt1']], ['test-htsget'])
+    genotypes = {cld['biosampleId']: cld['genotype'] for cld in results[0]['caseLevelData']}
+    assert genotypes['test-htsget~het']['zygosity']['label'] == 'simple heterozygous'
+    assert genotypes['test-htsget~het']['secondaryAlleleIds'] == ['ref']
+    assert genotypes['test-htsget~hom']['zygosity']['label'] == 'homozygous'
+    assert genotypes['test-htsget~compound']['zygosity']['label'] == 'compound heterozygous'
+    assert genotypes['test-htsget~compound']['secondaryAlleleIds'] == ['alt2']
+    assert genotypes['test-htsget~missing']['zygosity']['label'] == 'heterozygous'
+    assert genotypes['test-htsget~missing']['value'] == './1'
+    assert 'secondaryAlleleIds' not in genotypes['test-htsget~missing']
+    assert genotypes['test-htsget~haploid']['zygosity']['label'] == 'homozygous'